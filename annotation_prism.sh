@@ -14,11 +14,12 @@ function get_opts() {
    ANNOTATION_PARAMETERS=none
    ANALYSIS_NAME=taxonomy
    WEIGHTING_METHOD=none
+   TAXONOMY_INDEX=
 
 
    help_text="
 \n
-./annotation_prism.sh  [-h] [-n] [-d] [-p options ] [-w weighting_method] [-a analysis_name] -O outdir [-C local|slurm ] input_file_names\n
+./annotation_prism.sh  [-h] [-n] [-d] [-p options ] [-w weighting_method] [-a analysis_name] [-t taxonomy_index_dir] -O outdir [-C local|slurm ] input_file_names\n
 \n
 \n
 example:\n
@@ -26,7 +27,7 @@ example:\n
 "
 
    # defaults:
-   while getopts ":nhfO:C:s:M:p:a:w:" opt; do
+   while getopts ":nhfO:C:s:M:p:a:w:t:" opt; do
    case $opt in
        n)
          DRY_RUN=yes
@@ -56,6 +57,9 @@ example:\n
        a)
          ANALYSIS_NAME=$OPTARG
          ;;
+       t)
+         TAXONOMY_INDEX=$OPTARG   # optional index built by taxonomy_index.py, used to resolve lineages
+         ;;
        \?)
          echo "Invalid option: -$OPTARG" >&2
          exit 1
@@ -106,6 +110,13 @@ function check_opts() {
       exit 1
    fi
 
+   if [ ! -z "$TAXONOMY_INDEX" ]; then
+      if [ ! -f $TAXONOMY_INDEX/taxonomy_index.json ]; then
+         echo "could not find taxonomy_index.json in the taxonomy index folder specified ( $TAXONOMY_INDEX )"
+         exit 1
+      fi
+   fi
+
 }
 
 function echo_opts() {
@@ -116,6 +127,7 @@ function echo_opts() {
   echo ANNOTATION_PARAMETERS=$ANNOTATION_PARAMETERS 
   echo ANALYSIS_NAME=$ANALYSIS_NAME  
   echo WEIGHTING_METHOD=$WEIGHTING_METHOD  
+  echo TAXONOMY_INDEX=$TAXONOMY_INDEX
 }
 
 #
@@ -128,6 +140,9 @@ function configure_env() {
    cp ./annotation_prism.mk $OUT_DIR
    cp ./taxonomy_prism.py $OUT_DIR
    cp ./locus_prism.py $OUT_DIR
+   cp ./prism_instrument.py $OUT_DIR
+   cp ./blast_results.py $OUT_DIR
+   cp ./taxonomy_index.py $OUT_DIR
    cp ./data_prism.py $OUT_DIR
    cp ./taxonomy_prism.r $OUT_DIR
    cp ./locus_summary_heatmap.r $OUT_DIR
@@ -185,6 +200,9 @@ function get_targets() {
       if [ $WEIGHTING_METHOD == "tag_count" ]; then
          args_phrase="--weighting_method tag_count"
       fi
+      if [[ ! -z "$TAXONOMY_INDEX" && $ANALYSIS_NAME == "taxonomy" ]]; then
+         args_phrase="$args_phrase --taxonomy_index $TAXONOMY_INDEX"
+      fi
 
       echo "#!/bin/bash
 if [ $ANALYSIS_NAME == "taxonomy" ]; then
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import io
+import gzip
+import collections
+import operator
+import itertools
+
+#********************************************************************
+# streaming parser for blast tabular results with comment lines
+# (-outfmt 7), as used by taxonomy_prism.py and locus_prism.py - e.g.
+#
+# # BLASTN 2.6.0+
+# # Query: seq_21074 count=204
+# # Database: /bifo/scratch/datacache/ncbi/indexes/blast/capra_hircus_ncbi_PRJNA290100.fasta
+# # Fields: query acc.ver, subject acc.ver, % identity, alignment length, ...
+# # 17 hits found
+# seq_21074       CM004590.1      100.000 64      0       0       1       64      4028254 4028191 1.14e-25        119
+# .
+# .
+#
+# The file is read in a single pass. Comment lines are recognised by their
+# prefix (no regular expressions), and hit lines are split on tabs and
+# just the required columns kept. A query_block is yielded for each query,
+# with the query (i.e. the rest of the Query line), the database, the
+# weight of the query (parsed once per query, from e.g. count=204 on the
+# Query line, if weighting by tag count), whether blast reported 0 hits,
+# and the list of hits - each a tuple of the required columns (None
+# for any missing columns)
+#********************************************************************
+
+query_block = collections.namedtuple("query_block", ["query", "database", "weight", "no_hits", "hits"])
+
+WEIGHT_PATTERN = re.compile("count=(\d*\.*\d*)\s*$")
+
+def get_query_weight(query, weighting_method, default_weight=1):
+    """
+    returns the weight of a query - if weighting by tag count, the count on the Query line (e.g. seq_26674 count=16), otherwise the default
+    """
+    if weighting_method == "tag_count":
+        weighting_match = WEIGHT_PATTERN.search(query)
+        if weighting_match is not None:
+            return float(weighting_match.groups()[0])
+    return default_weight
+
+def get_database_name(database):
+    """
+    returns the name of a database from its path - e.g. /bifo/indexes/blast/capra_hircus.fasta -> capra_hircus
+    """
+    if database is None:
+        return None
+    return os.path.splitext(os.path.basename(database))[0]
+
+def get_line_stream(filename):
+    """
+    returns a (buffered) stream of the lines of a results file, which is optionally compressed with gzip - or 
+    of a chunk of a results file (see below)
+    """
+    if isinstance(filename, results_chunk):
+        return lines_from_chunk(filename)
+    if filename.endswith(".gz"):
+        stream = io.BufferedReader(gzip.open(filename, "rb"))
+    else:
+        stream = io.open(filename, "rb")
+    if sys.version_info >= (3,0):
+        return io.TextIOWrapper(stream)
+    return stream
+
+def query_blocks_from_file(filename, columns, weighting_method=None, default_weight=1):
+    """
+    yields a query_block for each query in a results file, with hits containing the given columns (0-based). (Any hits
+    before the first Query line are yielded in a block with an empty query)
+    """
+    columns = tuple(columns)
+    column_getter = operator.itemgetter(*columns)
+    column_count = max(columns) + 1
+
+    query = ""
+    database = None
+    weight = get_query_weight(query, weighting_method, default_weight)
+    no_hits = False
+    hits = []
+    in_block = False
+    for line in get_line_stream(filename):
+        if line[0:1] == "#":
+            comment = line[1:].strip()
+            if comment.startswith("Query:"):
+                if in_block or len(hits) > 0:
+                    yield query_block(query, database, weight, no_hits, hits)
+                query = comment[6:].strip()
+                weight = get_query_weight(query, weighting_method, default_weight)
+                no_hits = False
+                hits = []
+                in_block = True
+            elif comment.startswith("Database:"):
+                database_path = comment[9:].strip()
+                if len(database_path.split()) == 1:
+                    database = database_path
+            elif comment.lower().startswith("0 hits"):
+                no_hits = True
+            continue
+
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) == 1 and len(fields[0].strip()) == 0:
+            continue
+        if len(fields) >= column_count:
+            hit = column_getter(fields)
+            if len(columns) == 1:
+                hit = (hit,)
+        else:
+            hit = tuple( fields[column] if column < len(fields) else None for column in columns )
+        hits.append(hit)
+
+    if in_block or len(hits) > 0:
+        yield query_block(query, database, weight, no_hits, hits)
+
+
+#********************************************************************
+# split-and-merge parsing of large results files. A results file is split
+# into chunks of whole queries, which are parsed (and their top hits selected
+# and turned into spectrum values) by a pool of worker processes. The
+# spectrum values are then added to the prism in file order, so that the
+# distribution is identical to one built serially (including the rounding
+# of fractional weights).
+# - uncompressed files are split into byte ranges, which each worker reads
+#   itself
+# - gzip files can only be decompressed serially, so are decompressed once
+#   (by the main process) and handed out in chunks of lines
+# Chunks start at a Query line, and only where the query id differs from
+# that of the previous query - so that a top hit provider, which groups
+# consecutive hits by query, sees the same groups as when reading the whole file
+#********************************************************************
+
+results_chunk = collections.namedtuple("results_chunk", ["filename", "start", "end", "lines"])
+
+CHUNKS_PER_PROCESS = 4          # uncompressed files are split into this many chunks per worker process (to balance the load)
+GZIP_CHUNK_LINES = 200000       # (approximate) number of lines per chunk of a gzip file
+
+def lines_from_chunk(chunk):
+    """
+    yields the lines of a chunk of a results file - either those handed out with the chunk, or those starting in its byte range
+    """
+    if chunk.lines is not None:
+        for line in chunk.lines.splitlines(True):
+            yield line
+        return
+    stream = io.open(chunk.filename, "rb")
+    try:
+        stream.seek(chunk.start)
+        position = chunk.start
+        for line in stream:
+            if position >= chunk.end:
+                break
+            position += len(line)
+            if sys.version_info >= (3,0):
+                line = line.decode()
+            yield line
+    finally:
+        stream.close()
+
+def get_query_id(line):
+    """
+    returns the query id (i.e. first word of the query) from a Query line, or None if the line is not a Query line
+    """
+    if line[0:1] != "#":
+        return None
+    comment = line[1:].strip()
+    if not comment.startswith("Query:"):
+        return None
+    query_words = comment[6:].split()
+    if len(query_words) == 0:
+        return ""
+    return query_words[0]
+
+def find_chunk_start(stream, position):
+    """
+    returns the offset of the first Query line at or after position (in a binary stream of an uncompressed results file),
+    whose query id differs from that of the previous Query line - or None if there is none
+    """
+    stream.seek(position)
+    if position > 0:
+        position += len(stream.readline())   # i.e. from the start of the next line
+    previous_query_id = None
+    for line in stream:
+        if sys.version_info >= (3,0):
+            query_id = get_query_id(line.decode())
+        else:
+            query_id = get_query_id(line)
+        if query_id is not None:
+            if previous_query_id is not None and query_id != previous_query_id:
+                return position
+            previous_query_id = query_id
+        position += len(line)
+    return None
+
+def get_file_chunks(filename, num_chunks):
+    """
+    returns a list of chunks (byte ranges, each of whole queries) of an uncompressed results file
+    """
+    file_size = os.path.getsize(filename)
+    starts = [0]
+    stream = io.open(filename, "rb")
+    try:
+        for chunk_number in range(1, num_chunks):
+            start = find_chunk_start(stream, max(starts[-1], chunk_number * file_size // num_chunks))
+            if start is None:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    finally:
+        stream.close()
+    return [ results_chunk(filename, start, end, None) for (start, end) in zip(starts, starts[1:] + [file_size]) ]
+
+def get_gzip_chunks(filename, chunk_lines=GZIP_CHUNK_LINES):
+    """
+    yields chunks (of whole queries) of the lines of a gzip compressed results file
+    """
+    lines = []
+    previous_query_id = None
+    for line in get_line_stream(filename):
+        query_id = get_query_id(line)
+        if query_id is not None:
+            if len(lines) >= chunk_lines and query_id != previous_query_id:
+                yield results_chunk(filename, None, None, "".join(lines))
+                lines = []
+            previous_query_id = query_id
+        lines.append(line)
+    if len(lines) > 0:
+        yield results_chunk(filename, None, None, "".join(lines))
+
+def get_results_chunks(filename, num_processes):
+    if filename.endswith(".gz"):
+        return get_gzip_chunks(filename)
+    return get_file_chunks(filename, CHUNKS_PER_PROCESS * num_processes)
+
+def get_chunk_spectrum_values(chunk_args):
+    """
+    worker method - returns the list of spectrum values of a chunk of a results file 
+    """
+    (chunk, file_to_stream_func, file_to_stream_func_xargs, spectrum_value_provider_func, spectrum_value_provider_func_xargs) = chunk_args
+    spectrum_values = []
+    for record in file_to_stream_func(chunk, *file_to_stream_func_xargs):
+        spectrum_values += spectrum_value_provider_func(record, *spectrum_value_provider_func_xargs)
+    return spectrum_values
+
+def spectrum_values_from_chunks(datafile, *args):
+    """
+    yields the spectrum values of the chunks of a results file, in file order, as they are returned by the pool of workers. 
+    Chunks are handed out in waves, so that only a few chunks per worker are held in memory at a time
+    """
+    (pool, chunk_args_func, num_processes) = args[0:3]
+    chunk_iter = iter(get_results_chunks(datafile, num_processes))
+    chunk_wave = list(itertools.islice(chunk_iter, 2 * num_processes))
+    while len(chunk_wave) > 0:
+        for spectrum_values in pool.map(get_chunk_spectrum_values, [ chunk_args_func(chunk) for chunk in chunk_wave ]):
+            for spectrum_value in spectrum_values:
+                yield spectrum_value
+        chunk_wave = list(itertools.islice(chunk_iter, 2 * num_processes))
+
+def spectrum_value_from_spectrum_value(spectrum_value, *args):
+    return (spectrum_value,)
+
+def build_split_prism(split_prism, num_processes):
+    """
+    builds a prism (configured with a file_to_stream_func such as a top hit provider, which takes a results filename) 
+    by splitting each results file into chunks which are parsed by a pool of worker processes, and adding their
+    spectrum values to the prism in file order. Returns the spectrum, as build does
+    """
+    from data_prism import build
+    from multiprocessing import Pool
+
+    configuration = (split_prism.file_to_stream_func, split_prism.file_to_stream_func_xargs, split_prism.spectrum_value_provider_func, \
+                     split_prism.spectrum_value_provider_func_xargs)
+    chunk_args_func = lambda chunk : (chunk,) + configuration
+    pool = Pool(num_processes)
+    try:
+        split_prism.file_to_stream_func = spectrum_values_from_chunks
+        split_prism.file_to_stream_func_xargs = [pool, chunk_args_func, num_processes]
+        split_prism.spectrum_value_provider_func = spectrum_value_from_spectrum_value
+        split_prism.spectrum_value_provider_func_xargs = []
+        spectrum_data = build(split_prism, "singlethread")
+    finally:
+        pool.close()
+        pool.join()
+        # (the prism is saved as if it had been built serially)
+        (split_prism.file_to_stream_func, split_prism.file_to_stream_func_xargs, split_prism.spectrum_value_provider_func, \
+         split_prism.spectrum_value_provider_func_xargs) = configuration
+    return spectrum_data
+
+#********************************************************************
+# streaming best hit selection. The hits of each query are scored as they
+# are read, and just the running best hit (and, optionally, the lowest
+# common ancestor of the hits tied with it) kept, rather than collecting
+# and sorting all the hits of a query. Criteria :
+#
+# evalue   - smallest evalue
+# bitscore - largest bit score
+# pident   - largest % identity
+# combined - smallest evalue, with ties broken by largest bit score (if
+#            there is a bit score column) and then largest % identity
+#
+# Hits with equal scores are tied - the first (i.e. in blast's order) is
+# selected. With lca, the lineage of the selected hit (i.e. its columns
+# after the query id, taken to be ranks from the most general, e.g.
+# kingdom then name) is truncated to the ranks on which all the tied hits
+# agree, with the other ranks reported as LCA_UNRESOLVED
+#********************************************************************
+
+SELECTION_CRITERIA = ["evalue", "bitscore", "pident", "combined"]
+LCA_UNRESOLVED = "Unresolved"
+
+class best_hit_selector(object):
+    def __init__(self, criterion="evalue", evalue_column=None, bitscore_column=None, pident_column=None, lca=False):
+        super(best_hit_selector, self).__init__()
+        if criterion not in SELECTION_CRITERIA:
+            raise Exception("error - unknown best hit criterion %s"%criterion)
+        self.criterion = criterion
+        self.lca = lca
+        # (column, sign) of each score, with scores compared in order and larger being better
+        self.scores = []
+        if criterion in ["evalue", "combined"]:
+            self.scores.append((evalue_column, -1.0))
+        if criterion == "bitscore" or (criterion == "combined" and bitscore_column is not None):
+            self.scores.append((bitscore_column, 1.0))
+        if criterion == "pident" or (criterion == "combined" and pident_column is not None):
+            self.scores.append((pident_column, 1.0))
+        if None in [ column for (column, sign) in self.scores ]:
+            raise Exception("error - the %s criterion needs the column number of each of its scores"%criterion)
+
+    def get_score_columns(self):
+        """
+        returns the columns (of the results file) needed to score a hit
+        """
+        return [ column for (column, sign) in self.scores ]
+
+    def get_score(self, score_fields):
+        """
+        returns a comparable score (larger is better) from the score columns of a hit
+        """
+        return tuple( sign * float(field) for ((column, sign), field) in zip(self.scores, score_fields) )
+
+    def select(self, item_iter, output_length):
+        """
+        takes a stream of (hit, weight) items, in which each hit is the output columns (starting with the query id) followed by 
+        the score columns, and yields the best (hit, weight) item (without the score columns) of each group of consecutive 
+        items with the same query id. (Items with too few columns to be scored - e.g. "No hits", or a hit line missing some
+        columns, which the parser pads with None - are only selected if nothing else in their group is)
+        """
+        group_key = None
+        best = None    # [score, item, lineage]
+        for (hit, weight) in item_iter:
+            if best is not None and hit[0] != group_key:
+                yield self.get_selected_item(best)
+                best = None
+            group_key = hit[0]
+            score = None
+            score_fields = hit[output_length:output_length + len(self.scores)]
+            if len(score_fields) == len(self.scores) and None not in score_fields:
+                score = self.get_score(score_fields)
+            if best is None or (score is not None and (best[0] is None or score > best[0])):
+                best = [score, (hit[:output_length], weight), list(hit[1:output_length])]
+            elif self.lca and score == best[0]:
+                best[2] = get_common_lineage(best[2], hit[1:output_length])
+        if best is not None:
+            yield self.get_selected_item(best)
+
+    def get_selected_item(self, best):
+        (score, (hit, weight), lineage) = best
+        if not self.lca:
+            return (hit, weight)
+        return (hit[0:1] + tuple( LCA_UNRESOLVED if rank is None else rank for rank in lineage ), weight)
+
+def get_common_lineage(lineage, other_lineage):
+    """
+    returns the ranks of a lineage (a list of ranks, from the most general) which agree with another lineage, with the 
+    first rank that doesn't agree, and all the more specific ranks, replaced by None
+    """
+    common_lineage = list(lineage)
+    for rank_number in range(len(common_lineage)):
+        if rank_number >= len(other_lineage) or common_lineage[rank_number] != other_lineage[rank_number]:
+            common_lineage[rank_number:] = (len(common_lineage) - rank_number) * [None]
+            break
+    return common_lineage
@@ -14,14 +14,16 @@ function get_opts() {
    USE_BASE=TRUE
    RESULT_FORMAT=taxa
    DB_DIR=/dataset/gseq_processing/scratch/taxonomizr
+   INDEX_DIR=
    help_text="
 \n
-get_taxonomy.sh  [-h] [-c (accession column, default 1)] [-b (use base, TRUE|FALSE default TRUE)] [-f (result format, taxa|taxid, default taxa)] [-d (db dir default /dataset/gseq_processing/scratch/taxonomizr) ]  -O outdir input_file_names\n
+get_taxonomy.sh  [-h] [-c (accession column, default 1)] [-b (use base, TRUE|FALSE default TRUE)] [-f (result format, taxa|taxid, default taxa)] [-d (db dir default /dataset/gseq_processing/scratch/taxonomizr) ] [-I (taxonomy index dir - use taxonomy_index.py rather than taxonomizr) ]  -O outdir input_file_names\n
 \n
 \n
 example:\n
 get_taxonomy.sh -c 2 -b TRUE -f taxid  -O ~ test.dat \n
 get_taxonomy.sh -c 2 -b TRUE -f taxa  -O ~ test1.dat test2.dat test3.dat\n
+get_taxonomy.sh -c 2 -f taxa -I /dataset/gseq_processing/scratch/taxonomy_index -O ~ test1.dat test2.dat test3.dat\n
 \n
 example input:\n
 \n
@@ -30,10 +32,20 @@ example input:\n
 879     CP028287.1\n
 880     CP032707.1\n
 \n
+note that the output of the taxonomy index (-I) is not quoted - e.g.\n
+\n
+879     CP017297.1      Bacteria        ...\n
+\n
+whereas taxonomizr output (written by R) quotes the text columns, e.g.\n
+\n
+879     \"CP017297.1\"    \"Bacteria\"      ...\n
+\n
+(and R may also reformat numeric columns). NA is not quoted by either.\n
+\n
 "
 
    # defaults:
-   while getopts ":hO:b:f:d:c:" opt; do
+   while getopts ":hO:b:f:d:c:I:" opt; do
    case $opt in
        h)
          echo -e $help_text
@@ -54,6 +66,9 @@ example input:\n
        d)
          DB_DIR=$OPTARG
          ;;
+       I)
+         INDEX_DIR=$OPTARG
+         ;;
        \?)
          echo "Invalid option: -$OPTARG" >&2
          exit 1
@@ -106,7 +121,16 @@ function check_opts() {
       exit 1
    fi
 
-   if [ ! -f $DB_DIR/accessionTaxa.sql ]; then
+   if [ ! -z "$INDEX_DIR" ]; then
+      if [ ! -f $INDEX_DIR/taxonomy_index.json ]; then
+         echo "could not find taxonomy_index.json in the taxonomy index folder specified ( $INDEX_DIR )"
+         exit 1
+      fi
+      if [ $USE_BASE != "TRUE" ]; then
+         echo "the taxonomy index only supports looking up base accessions ( -b TRUE )"
+         exit 1
+      fi
+   elif [ ! -f $DB_DIR/accessionTaxa.sql ]; then
       echo "could not find database file accessionTaxa.sql in the database folder specified ( $DB_DIR )"
       exit 1
    fi
@@ -119,6 +143,7 @@ function echo_opts() {
   echo USE_BASE=$USE_BASE
   echo RESULT_FORMAT=$RESULT_FORMAT
   echo DB_DIR=$DB_DIR
+  echo INDEX_DIR=$INDEX_DIR
 }
 
 #
@@ -142,6 +167,12 @@ function run() {
       infile=${files_array[$j]}
       outbase=`basename $infile`
       set -x
+      if [ ! -z "$INDEX_DIR" ]; then
+         # the index is memory mapped rather than a database connection, so can be used on any node
+         tardis -c 5000 --hpctype $HPC_TYPE python $SEQ_PRISMS_BIN/taxonomy_index.py --index_dir $INDEX_DIR --column $((ACC_COL-1)) --result_format $RESULT_FORMAT _condition_text_input_$infile \>_condition_uncompressedtext_output_$OUT_DIR/${outbase}.taxonomy 2\>_condition_uncompressedtext_output_$OUT_DIR/${outbase}.stderr
+         set +x
+         continue
+      fi
       tardis -c 5000 --hpctype local --shell-include-file $SEQ_PRISMS_BIN/etc/r-taxonomizr_env.inc  Rscript --vanilla $SEQ_PRISMS_BIN/get_taxonomy.r in_file=_condition_text_input_$infile acc_col=$ACC_COL use_base=$USE_BASE result_format=$RESULT_FORMAT db_dir=$DB_DIR \>_condition_uncompressedtext_output_$OUT_DIR/${outbase}.taxonomy 2\>_condition_uncompressedtext_output_$OUT_DIR/${outbase}.stderr
       set +x
    done
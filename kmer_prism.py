@@ -7,9 +7,17 @@ import itertools
 import string
 if sys.version_info <= (2, 8):
    from exceptions import Exception
-from random import random
+from random import Random
 from multiprocessing import Pool
 import subprocess
+import tempfile
+import collections
+import gzip
+import zlib
+import struct
+import hashlib
+import time
+import math
 import argparse
 from data_prism import prism , build, bin_discrete_value, get_text_stream , get_file_type,  PROC_POOL_SIZE
 
@@ -35,6 +43,9 @@ def kmer_count_from_sequence(sequence, *args):
 
     reverse_complement = args[0]
     pattern_window_length = args[1]  # optional - for fixed length patterns e.g. 6-mers etc, to speed up search
+    if isinstance(pattern_window_length, (list, tuple)):
+        # multiple kmer sizes - chain the counts for each size 
+        return itertools.chain(*[ kmer_count_from_sequence(sequence, reverse_complement, kmer_size, *args[2:]) for kmer_size in pattern_window_length ])
     if callable(args[2]):
         weight=args[2](sequence)
     else:
@@ -46,10 +57,13 @@ def kmer_count_from_sequence(sequence, *args):
     #print "DEBUG reverse_complement%s"%str(reverse_complement)
     #print "DEBUG patterns%s"%str(patterns)
 
-    if pattern_window_length is None:
+    if len(patterns) == 1 and isinstance(patterns[0], motif_automaton):
+        # literal / IUPAC patterns are all counted in a single scan of the sequence 
+        kmer_count_iter = patterns[0].get_motif_counts(get_sequence_string(sequence), weight, reverse_complement)
+    elif pattern_window_length is None:
         # search for each pattern. Note that this does not count multiple instances 
         # of a pattern that overlap - for example in TTTTTTT , the pattern TTTTTT will only count once. 
-        kmer_iters = tuple((re.finditer(pattern, str(sequence.seq), re.I) for pattern in patterns))
+        kmer_iters = tuple((re.finditer(pattern, get_sequence_string(sequence), re.I) for pattern in patterns))
         kmer_iters = (match.group() for match in itertools.chain(*kmer_iters))
         if not reverse_complement:
             kmer_count_iter = ( ( weight * len(list(kmer_iter)),kmer) for (kmer,kmer_iter) in itertools.groupby(kmer_iters, lambda kmer:kmer) )
@@ -60,7 +74,7 @@ def kmer_count_from_sequence(sequence, *args):
         # the above regexp based search, this would count multiple instances of a pattern
         # that overlap - for example in TTTTTTT , the pattern TTTTTT would count twice.
         # overlap_patterns is used to emulate the regexp behaviour 
-        strseq = str(sequence.seq)
+        strseq = get_sequence_string(sequence)
         kmer_dict = {}
         overlap_patterns = pattern_window_length * [""]        
         kmer_iter = (strseq[i:i+pattern_window_length] for i in range(0,1+len(strseq)-pattern_window_length))
@@ -84,18 +98,56 @@ def kmer_count_from_sequence(sequence, *args):
 
 def seq_from_sequence_file(datafile, *args):
     """
-    yields either all or a random sample of seqs from a sequence file
+    yields either all or a random sample of seqs from a sequence file. 
+
+    By default fasta and fastq files are read by the raw record reader below, which yields 
+    lightweight records (just the sequence, as bytes, and optionally the description), rather
+    than full Biopython SeqRecords. Other formats (or record_reader "biopython") are parsed by Bio.SeqIO
     """
-    from Bio import SeqIO
     (filetype, sampling_proportion) = args[0:2]
-    seq_iter = SeqIO.parse(get_text_stream(datafile), filetype)
+    record_reader = "raw"
+    with_description = True
+    if len(args) > 2:
+        (record_reader, with_description) = args[2:4]
+    sampler = None
+    if len(args) > 4:
+        sampler = args[4]
+    elif sampling_proportion is not None:
+        sampler = record_sampler(sampling_proportion)
+
+    if record_reader == "raw" and filetype in RAW_RECORD_FILETYPES:
+        if sampler is not None and sampler.is_skip_ahead():
+            # only the sampled records are parsed
+            return RAW_RECORD_FILETYPES[filetype](raw_lines_from_file(datafile), with_description, datafile, sampler.get_sample_indexes())
+        seq_iter = RAW_RECORD_FILETYPES[filetype](raw_lines_from_file(datafile), with_description, datafile)
+    else:
+        from Bio import SeqIO
+        seq_iter = SeqIO.parse(get_text_stream(datafile), filetype)
 
-    if sampling_proportion is not None:
-        seq_iter = (record for record in seq_iter if random() <= sampling_proportion)
-        
+    if sampler is not None:
+        seq_iter = sampler.sample(seq_iter)
         
     return seq_iter
 
+def get_sequence_string(sequence):
+    """
+    returns the sequence of a record as a string. Records are either Biopython SeqRecords, or
+    raw_sequence_records from the raw record reader (which have the sequence as bytes) 
+    """
+    if isinstance(sequence.seq, bytes):
+        if sys.version_info >= (3,0):
+            return sequence.seq.decode("ascii")
+        return sequence.seq
+    return str(sequence.seq)
+
+def get_sequence_bytes(sequence):
+    """
+    returns the sequence of a record as bytes (see get_sequence_string)
+    """
+    if isinstance(sequence.seq, bytes):
+        return sequence.seq
+    return to_byte_string(str(sequence.seq))
+
 def parse_weight_from_sequence_description(sequence):
     """
     this is used where the fasta file is marked up with a count , and this ends up in the 
@@ -113,6 +165,653 @@ def parse_weight_from_sequence_description(sequence):
     return weight
 
 
+#********************************************************************
+# sampling of records. By default the gap to the next sampled record is drawn 
+# from a geometric distribution, so that only one random number is drawn 
+# per sampled record, and the raw record readers can skip over the records 
+# in between without parsing them. If a minimum sample size is given, a 
+# reservoir of that many records is also kept (using Algorithm L) until 
+# the proportional sample reaches the minimum size - if it never does 
+# (i.e. the input is small), the reservoir is used instead. Either way 
+# the input is read once. Each stream (e.g. a partition of a file read by a 
+# worker process) gets its own random state, derived from the seed if one 
+# is given 
+#********************************************************************
+
+class record_sampler(object):
+    def __init__(self, sampling_proportion, minimum_sample_size=0, seed=None):
+        super(record_sampler, self).__init__()
+        self.sampling_proportion = sampling_proportion
+        self.minimum_sample_size = minimum_sample_size
+        self.seed = seed
+
+    def is_skip_ahead(self):
+        return self.minimum_sample_size == 0
+
+    def get_random(self, stream_number=0):
+        """
+        returns a random state for a stream - reproducible if a seed was given, otherwise seeded from the system (so that 
+        worker processes, which inherit the random state of their parent, don't all draw the same sample) 
+        """
+        if self.seed is None:
+            return Random()
+        return Random("%s:%d"%(self.seed, stream_number))
+
+    def get_skip_iter(self, rng):
+        """
+        yields the number of records to skip before each sampled record
+        """
+        if self.sampling_proportion >= 1:
+            return itertools.repeat(0)
+        elif self.sampling_proportion <= 0:
+            return iter([])
+        log_complement = math.log(1.0 - self.sampling_proportion)
+        return ( int(math.log(1.0 - rng.random()) / log_complement) for i in itertools.count() )
+
+    def get_sample_indexes(self, stream_number=0):
+        """
+        yields the (0-based) indexes of the sampled records, in increasing order
+        """
+        index = -1
+        for skip in self.get_skip_iter(self.get_random(stream_number)):
+            index += skip + 1
+            yield index
+
+    def sample(self, record_iter, stream_number=0):
+        """
+        yields a sample of records from an iterator of records 
+        """
+        if self.is_skip_ahead():
+            return self.sample_skip_ahead(record_iter, stream_number)
+        return self.sample_reservoir(record_iter, stream_number)
+
+    def sample_skip_ahead(self, record_iter, stream_number=0):
+        record_iter = iter(record_iter)
+        for skip in self.get_skip_iter(self.get_random(stream_number)):
+            record = next(itertools.islice(record_iter, skip, None), None)
+            if record is None:
+                break
+            yield record
+
+    def sample_reservoir(self, record_iter, stream_number=0):
+        rng = self.get_random(stream_number)
+        skip_iter = self.get_skip_iter(rng)
+        next_sampled = next(skip_iter, None)
+        sample = []
+        reservoir = []
+        weight = math.exp(math.log(rng.random()) / self.minimum_sample_size)
+        next_reservoir = self.minimum_sample_size
+        for (index, record) in enumerate(record_iter):
+            if index == next_sampled:
+                if reservoir is None:
+                    yield record
+                else:
+                    sample.append(record)
+                skip = next(skip_iter, None)
+                next_sampled = None if skip is None else index + skip + 1
+            if reservoir is None:
+                continue
+            if len(sample) >= self.minimum_sample_size:
+                # the proportional sample is big enough, so there is no further need for the reservoir 
+                for sampled_record in sample:
+                    yield sampled_record
+                (sample, reservoir) = (None, None)
+            elif index < self.minimum_sample_size:
+                reservoir.append(record)
+            elif index == next_reservoir:
+                reservoir[rng.randrange(self.minimum_sample_size)] = record
+                weight *= math.exp(math.log(rng.random()) / self.minimum_sample_size)
+                next_reservoir += int(math.log(1.0 - rng.random()) / math.log(1.0 - weight)) + 1
+            if index + 1 == self.minimum_sample_size:
+                next_reservoir = index + int(math.log(1.0 - rng.random()) / math.log(1.0 - weight)) + 1
+
+        if reservoir is not None:
+            for record in reservoir:
+                yield record
+
+def get_record_sampler(sampling_proportion, minimum_sample_size=0, seed=None):
+    """
+    returns a record_sampler, or None if no sampling is required
+    """
+    if sampling_proportion is None:
+        return None
+    return record_sampler(sampling_proportion, minimum_sample_size, seed)
+
+def is_partitionable_sampler(sampler):
+    """
+    partitions of a file can be sampled independently, unless a minimum sample size (of the whole file) is required
+    """
+    return sampler is None or sampler.is_skip_ahead()
+
+#********************************************************************
+# raw record reader for fasta and fastq files. Files (plain or gzipped) are 
+# read in large blocks which are split into lines, and only the sequence 
+# (and if needed the description) of each record is kept
+#********************************************************************
+
+RAW_READ_SIZE = 4 * 1024 * 1024   # bytes per bulk read
+
+raw_sequence_record = collections.namedtuple("raw_sequence_record", ["seq", "description"])
+
+def get_raw_file_format(datafile):
+    """
+    returns plain, gzip or bgzf (blocked gzip, as written by bgzip, which can be read from any block)
+    """
+    with open(datafile, "rb") as probe:
+        header = probe.read(18)
+    if header[0:2] != b"\x1f\x8b":
+        return "plain"
+    elif len(header) == 18 and (bytearray(header)[3] & 4) and header[12:14] == b"BC":
+        return "bgzf"
+    return "gzip"
+
+def raw_blocks_from_file(datafile):
+    """
+    yields blocks of bytes from a plain or gzipped file, read in bulk
+    """
+    if get_raw_file_format(datafile) == "plain":
+        stream = open(datafile, "rb")
+    else:
+        stream = gzip.open(datafile, "rb")
+    try:
+        block = stream.read(RAW_READ_SIZE)
+        while len(block) > 0:
+            yield block
+            block = stream.read(RAW_READ_SIZE)
+    finally:
+        stream.close()
+
+def raw_lines_from_blocks(block_iter):
+    """
+    yields lists of lines (bytes, without line endings) from an iterator of blocks of bytes
+    """
+    partial_line = []     # the pieces of a line which spans blocks (joined once the line ends)
+    for block in block_iter:
+        if b"\r" in block:
+            block = block.replace(b"\r", b"")
+        if b"\n" not in block:
+            partial_line.append(block)
+            continue
+        lines = block.split(b"\n")
+        if len(partial_line) > 0:
+            lines[0] = b"".join(partial_line + [lines[0]])
+        partial_line = [lines.pop()]
+        yield lines
+    partial_line = b"".join(partial_line)
+    if len(partial_line) > 0:
+        yield [partial_line]
+
+raw_block_instrument = None   # while an instrumented build is running, the build_instrument that times reading blocks (see prism_instrument.py)
+
+def get_instrumented_blocks(block_iter):
+    if raw_block_instrument is None:
+        return block_iter
+    return raw_block_instrument.time_iter(block_iter, "decompress", byte_count_func=len)
+
+def raw_lines_from_file(datafile):
+    """
+    yields lists of lines (bytes, without line endings) from a plain or gzipped file, read in bulk 
+    """
+    return raw_lines_from_blocks(get_instrumented_blocks(raw_blocks_from_file(datafile)))
+
+def decode_description(description):
+    if sys.version_info >= (3,0):
+        return description.decode("latin-1")
+    return description
+
+def raw_records_from_fastq(line_lists, with_description, name, sample_indexes=None):
+    """
+    yields raw_sequence_records from lists of lines of a fastq file. Records are assumed to be 4 lines (i.e. sequence and 
+    quality not wrapped) - if not, the file should be read using the biopython record reader. If sample_indexes
+    (an increasing iterator of record indexes) is given, only those records are yielded
+    """
+    pending_lines = []
+    record_base = 0
+    next_sampled = None
+    if sample_indexes is not None:
+        next_sampled = next(sample_indexes, None)
+        if next_sampled is None:
+            return
+    for lines in line_lists:
+        if len(pending_lines) > 0:
+            lines = pending_lines + lines
+        record_end = 4 * (len(lines) // 4)
+        pending_lines = lines[record_end:]
+        if record_end == 0:
+            continue
+        if lines[0][0:1] != b"@" or lines[2][0:1] != b"+" or lines[record_end-4][0:1] != b"@" or lines[record_end-2][0:1] != b"+":
+            raise kmer_prism_exception("error - %s does not look like 4-line fastq - try --record_reader biopython"%name)
+        if sample_indexes is not None:
+            # pick out just the sampled records in these lines
+            record_count = record_end // 4
+            while next_sampled < record_base + record_count:
+                offset = 4 * (next_sampled - record_base)
+                description = None
+                if with_description:
+                    description = decode_description(lines[offset][1:])
+                yield raw_sequence_record(lines[offset + 1], description)
+                next_sampled = next(sample_indexes, None)
+                if next_sampled is None:
+                    return
+            record_base += record_count
+            continue
+        sequences = lines[1:record_end:4]
+        if with_description:
+            descriptions = [ decode_description(header[1:]) for header in lines[0:record_end:4] ]
+        else:
+            descriptions = len(sequences) * [None]
+        for record in zip(sequences, descriptions):
+            yield raw_sequence_record(*record)
+
+    if len([ line for line in pending_lines if len(line.strip()) > 0 ]) > 0:
+        raise kmer_prism_exception("error - %s has an incomplete fastq record at the end"%name)
+
+def raw_records_from_fasta(line_lists, with_description, name, sample_indexes=None):
+    """
+    yields raw_sequence_records from lists of lines of a fasta file (sequences may be wrapped over several lines). If 
+    sample_indexes (an increasing iterator of record indexes) is given, only those records are yielded (and the 
+    sequence lines of other records are not kept)
+    """
+    description = None
+    sequence_lines = []
+    record_index = -1
+    next_sampled = None
+    if sample_indexes is not None:
+        next_sampled = next(sample_indexes, None)
+        if next_sampled is None:
+            return
+    for lines in line_lists:
+        for line in lines:
+            if line[0:1] == b">":
+                if description is not None:
+                    yield raw_sequence_record(b"".join(sequence_lines), description)
+                    if sample_indexes is not None:
+                        next_sampled = next(sample_indexes, None)
+                        if next_sampled is None:
+                            return
+                record_index += 1
+                description = None
+                sequence_lines = None
+                if sample_indexes is None or record_index == next_sampled:
+                    if with_description:
+                        description = decode_description(line[1:].rstrip())
+                    else:
+                        description = ""
+                    sequence_lines = []
+            elif sequence_lines is not None:
+                sequence_lines.append(line.rstrip())
+    if description is not None:
+        yield raw_sequence_record(b"".join(sequence_lines), description)
+
+RAW_RECORD_FILETYPES = {
+    "fasta" : raw_records_from_fasta,
+    "fastq" : raw_records_from_fastq
+}
+
+#********************************************************************
+# partitioned reading of fasta and fastq files, so that each of a number of
+# worker processes reads and parses a disjoint part of the file :
+# - uncompressed files are split into byte ranges
+# - bgzf files are split into ranges of compressed blocks
+# - other gzip files can only be decompressed serially, so are decompressed once 
+#   (by the main process) and handed out in blocks of whole records 
+# A worker starts at the first record that starts after its range start
+# (or at the start of the file), and reads past its range end to the end 
+# of the last record that starts in its range.
+#********************************************************************
+
+def find_record_start(buffer, position, filetype, at_eof):
+    """
+    returns the offset in buffer of the first record that starts after position (i.e. on a 
+    line starting after a newline at or after position). Returns None if more data is 
+    needed to tell - or, if at_eof, the length of the buffer if there is no such record.
+    In fastq, a line starting with @ may be a quality line, so a record start is confirmed
+    by checking that the line after next starts with + 
+    """
+    return scan_record_start(buffer, position, filetype, at_eof)[0]
+
+def scan_record_start(buffer, position, filetype, at_eof):
+    """
+    as find_record_start, but returns (offset, resume position) - where more data is needed, the
+    search can be resumed from the resume position once it has been added to the buffer (so that 
+    a long record is not rescanned from its start as each block is added)
+    """
+    while True:
+        newline = buffer.find(b"\n", position)
+        if newline < 0 or newline + 1 >= len(buffer):
+            if at_eof:
+                return (len(buffer), position)
+            return (None, position)
+        candidate = newline + 1
+        if filetype == "fasta":
+            if buffer[candidate:candidate+1] == b">":
+                return (candidate, position)
+        elif buffer[candidate:candidate+1] == b"@":
+            sequence_end = buffer.find(b"\n", candidate)
+            plus_end = -1
+            if sequence_end >= 0:
+                plus_end = buffer.find(b"\n", sequence_end + 1)
+            if plus_end < 0 or plus_end + 1 >= len(buffer):
+                if not at_eof:
+                    return (None, position)
+            elif buffer[plus_end+1:plus_end+2] == b"+":
+                return (candidate, position)
+        position = candidate
+
+def bgzf_block_offsets(datafile):
+    """
+    returns the offsets of the blocks in a bgzf file (read from the block headers)
+    """
+    offsets = []
+    with open(datafile, "rb") as stream:
+        offset = 0
+        header = stream.read(18)
+        while len(header) == 18:
+            offsets.append(offset)
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            offset += block_size
+            stream.seek(offset)
+            header = stream.read(18)
+    return offsets
+
+def bgzf_blocks_from_offset(datafile, start):
+    """
+    yields (offset, decompressed block) tuples for the blocks of a bgzf file, from offset start
+    """
+    with open(datafile, "rb") as stream:
+        stream.seek(start)
+        offset = start
+        header = stream.read(18)
+        while len(header) == 18:
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            block = header + stream.read(block_size - 18)
+            yield (offset, zlib.decompressobj(31).decompress(block))
+            offset += block_size
+            header = stream.read(18)
+
+def get_file_partitions(datafile, num_partitions):
+    """
+    returns a list of (file_format, start, end) partitions of a plain or bgzf file. For plain files
+    start and end are byte offsets, for bgzf files they are block offsets. Returns None
+    for other (gzip) files 
+    """
+    file_format = get_raw_file_format(datafile)
+    if file_format == "plain":
+        file_size = os.path.getsize(datafile)
+        bounds = [ file_size * part // num_partitions for part in range(num_partitions + 1) ]
+        return [ (file_format, bounds[part], bounds[part+1]) for part in range(num_partitions) if bounds[part] < bounds[part+1] ]
+    elif file_format == "bgzf":
+        offsets = bgzf_block_offsets(datafile)
+    else:
+        return None
+    bounds = [ len(offsets) * part // num_partitions for part in range(num_partitions + 1) ]
+    partitions = []
+    for part in range(num_partitions):
+        if bounds[part] < bounds[part + 1]:
+            end = offsets[bounds[part+1]] if bounds[part+1] < len(offsets) else os.path.getsize(datafile)
+            partitions.append((file_format, offsets[bounds[part]], end))
+    return partitions
+
+def blocks_from_partition(datafile, partition):
+    """
+    yields (block, in_range) tuples of the (decompressed) bytes of a file from the start of a 
+    partition - in_range is False once the end of the partition has been reached 
+    """
+    (file_format, start, end) = partition
+    if file_format == "bgzf":
+        for (offset, block) in bgzf_blocks_from_offset(datafile, start):
+            yield (block, offset < end)
+    else:
+        with open(datafile, "rb") as stream:
+            stream.seek(start)
+            position = start
+            block = stream.read(RAW_READ_SIZE)
+            while len(block) > 0:
+                if position < end < position + len(block):
+                    yield (block[:end-position], True)
+                    yield (block[end-position:], False)
+                else:
+                    yield (block, position < end)
+                position += len(block)
+                block = stream.read(RAW_READ_SIZE)
+
+def record_blocks_from_partition(datafile, filetype, partition):
+    """
+    yields blocks of bytes containing the whole records that start in a partition of a file 
+    (the buffer is a bytearray, extended in place, so that a record spanning many blocks is not copied
+    as each block is added)
+    """
+    (file_format, start, end) = partition
+    block_iter = blocks_from_partition(datafile, partition)
+    buffer = bytearray()
+    range_end = None       # offset of the end of the partition in buffer, once reached
+    record_start = 0 if start == 0 else None
+    start_position = 0     # where the search for the first record start resumes
+    end_position = None    # where the search for the end of the last record resumes
+    at_eof = False
+    while True:
+        try:
+            (block, in_range) = next(block_iter)
+            if not in_range and range_end is None:
+                range_end = len(buffer)
+            buffer += block
+        except StopIteration:
+            at_eof = True
+            if range_end is None:
+                range_end = len(buffer)
+
+        if record_start is None:
+            # skip the partial record at the start of the partition
+            (record_start, start_position) = scan_record_start(buffer, start_position, filetype, at_eof)
+            if record_start is None:
+                continue
+            if range_end is not None and record_start > range_end:
+                return      # no records start in this partition
+            del buffer[:record_start]
+            range_end = None if range_end is None else range_end - record_start
+
+        if range_end is None:
+            # all of the buffer is in the partition 
+            if len(buffer) > 0:
+                yield bytes(buffer)
+                del buffer[:]
+        else:
+            # find the end of the last record that starts in the partition
+            if end_position is None:
+                end_position = range_end
+            (record_end, end_position) = scan_record_start(buffer, end_position, filetype, at_eof)
+            if record_end is not None:
+                if record_end > 0:
+                    yield bytes(buffer[:record_end])
+                return
+        if at_eof:
+            return
+
+def record_blocks_from_gzip(datafile, filetype):
+    """
+    yields blocks of decompressed bytes from a gzip file, each containing whole records (the buffer 
+    is a bytearray, extended in place, so that a record spanning many blocks is not copied as each
+    block is added)
+    """
+    buffer = bytearray()
+    for block in get_instrumented_blocks(raw_blocks_from_file(datafile)):
+        buffer += block
+        record_end = find_record_start(buffer, max(0, len(buffer) - RAW_READ_SIZE // 16), filetype, False)
+        if record_end is not None and record_end > 0:
+            yield bytes(buffer[:record_end])
+            del buffer[:record_end]
+    if len(buffer) > 0:
+        yield bytes(buffer)
+
+def get_partition_records(datafile, filetype, partition, sampler, with_description, partition_number=0):
+    """
+    yields either all or a random sample of the records in a partition of a sequence file, or a block of records.
+    (Each partition is sampled using its own random state)
+    """
+    if isinstance(partition, bytes):
+        block_iter = [partition]
+    else:
+        block_iter = record_blocks_from_partition(datafile, filetype, partition)
+    sample_indexes = None
+    if sampler is not None:
+        sample_indexes = sampler.get_sample_indexes(partition_number)
+    return RAW_RECORD_FILETYPES[filetype](raw_lines_from_blocks(block_iter), with_description, datafile, sample_indexes)
+
+def get_partition_kmer_counts(partition_args):
+    """
+    worker method - returns a partial spectrum for a partition of a sequence file, or a block of records 
+    """
+    (datafile, filetype, partition, partition_number, sampler, with_description, batch_size, spectrum_value_provider_func, spectrum_value_provider_func_xargs) = partition_args
+    record_iter = get_partition_records(datafile, filetype, partition, sampler, with_description, partition_number)
+    if batch_size is not None:
+        record_iter = get_batch_iter(record_iter, batch_size)
+    return get_chunk_kmer_counts((record_iter, spectrum_value_provider_func, spectrum_value_provider_func_xargs))
+
+def get_partitioned_sequence_prism(sequence_prism, datafile, num_processes):
+    """
+    builds the spectrum of a fasta or fastq file using a pool of worker processes, each of which reads and counts 
+    a disjoint partition of the file, and merges the partial spectra. (Total decoding work does not increase 
+    with the number of processes.) Returns a prism for the merged spectrum 
+    """
+    (filetype, sampling_proportion, record_reader, with_description, sampler) = sequence_prism.file_to_stream_func_xargs[0:5]
+    batch_size = None
+    if sequence_prism.file_to_stream_func == seq_batch_from_sequence_file:
+        batch_size = sequence_prism.file_to_stream_func_xargs[-1]
+
+    partitions = get_file_partitions(datafile, num_processes)
+    if partitions is None:
+        print("(%s is gzip (not bgzf) compressed, so is decompressed by one process and handed out to the others in blocks)"%datafile)
+        partitions = record_blocks_from_gzip(datafile, filetype)
+    partition_args_iter = ( (datafile, filetype, partition, partition_number, sampler, with_description, batch_size, \
+                             sequence_prism.spectrum_value_provider_func, sequence_prism.spectrum_value_provider_func_xargs) for (partition_number, partition) in enumerate(partitions) )
+    spectrum = get_pooled_spectrum(get_partition_kmer_counts, partition_args_iter, num_processes)
+    return get_spectrum_prism(spectrum, datafile)
+
+#********************************************************************
+# paired-end reads. The R1 and R2 files of a pair are read in lockstep,
+# so that a pair is built in one pass, either as a single combined spectrum,
+# or as a spectrum for each mate. (The pair is the prism's input stream -
+# each record is a (R1, R2) tuple of mates.) Optionally, where the mates
+# overlap (i.e. the 3' end of R1 matches the reverse complement of the
+# 3' end of R2, because the fragment is shorter than the two reads), the
+# overlapping end of R2 is trimmed off, so that only the non-overlapping
+# part of R2 is counted
+#********************************************************************
+
+MINIMUM_MATE_OVERLAP = 20   # default minimum (exactly matching) overlap of mates for R2 to be trimmed
+
+def get_mate_overlap(sequence, mate_sequence, minimum_overlap):
+    """
+    returns the length of the (longest, exactly matching, and at least minimum_overlap long) overlap of
+    the 3' end of a read with the reverse complement of its mate, or 0 if they do not overlap
+    """
+    sequence = sequence.upper()
+    mate_reverse_complement = get_reverse_complement(mate_sequence)
+    if minimum_overlap < 1 or len(mate_reverse_complement) < minimum_overlap:
+        return 0
+    seed = mate_reverse_complement[0:minimum_overlap]
+    position = sequence.find(seed)
+    while position >= 0:
+        overlap = min(len(sequence) - position, len(mate_reverse_complement))
+        if sequence[position:position + overlap] == mate_reverse_complement[0:overlap]:
+            return overlap
+        position = sequence.find(seed, position + 1)
+    return 0
+
+def trim_mate_overlap(sequence_pair, minimum_overlap):
+    """
+    returns a pair of mates, with the end of R2 that overlaps R1 (if any) trimmed off
+    """
+    (record, mate_record) = sequence_pair
+    overlap = get_mate_overlap(get_sequence_string(record), get_sequence_string(mate_record), minimum_overlap)
+    if overlap == 0:
+        return sequence_pair
+    if isinstance(mate_record, raw_sequence_record):
+        return (record, raw_sequence_record(mate_record.seq[0:len(mate_record.seq) - overlap], mate_record.description))
+    return (record, mate_record[0:len(mate_record.seq) - overlap])
+
+def get_lockstep_pairs(record_iter, mate_record_iter, datafile, mate_file):
+    """
+    yields (R1, R2) tuples of mates from iterators of the records of the R1 and R2 files
+    """
+    mate_record_iter = iter(mate_record_iter)
+    for record in record_iter:
+        mate_record = next(mate_record_iter, None)
+        if mate_record is None:
+            raise kmer_prism_exception("error - %s has fewer records than %s - are they paired ?"%(mate_file, datafile))
+        yield (record, mate_record)
+    if next(mate_record_iter, None) is not None:
+        raise kmer_prism_exception("error - %s has more records than %s - are they paired ?"%(mate_file, datafile))
+
+def seq_pairs_from_sequence_files(datafile, *args):
+    """
+    yields either all or a random sample of (R1, R2) pairs of mates from a pair of sequence files, optionally
+    with the overlap of the mates trimmed off R2, and optionally in batches (lists) of pairs.
+    Args are mate_file, filetype, record_reader, with_description, sampler, minimum_mate_overlap, and optionally the batch size
+    """
+    (mate_file, filetype, record_reader, with_description, sampler, minimum_mate_overlap) = args[0:6]
+    if sampler is not None and sampler.is_skip_ahead() and record_reader == "raw" and filetype in RAW_RECORD_FILETYPES:
+        # both files are read with the same sample indexes, so only the sampled pairs are parsed
+        (sample_indexes, mate_sample_indexes) = itertools.tee(sampler.get_sample_indexes())
+        pair_iter = get_lockstep_pairs(RAW_RECORD_FILETYPES[filetype](raw_lines_from_file(datafile), with_description, datafile, sample_indexes), \
+                                       RAW_RECORD_FILETYPES[filetype](raw_lines_from_file(mate_file), with_description, mate_file, mate_sample_indexes), \
+                                       datafile, mate_file)
+    else:
+        pair_iter = get_lockstep_pairs(seq_from_sequence_file(datafile, filetype, None, record_reader, with_description, None), \
+                                       seq_from_sequence_file(mate_file, filetype, None, record_reader, with_description, None), \
+                                       datafile, mate_file)
+        if sampler is not None:
+            pair_iter = sampler.sample(pair_iter)
+
+    if minimum_mate_overlap is not None:
+        pair_iter = ( trim_mate_overlap(sequence_pair, minimum_mate_overlap) for sequence_pair in pair_iter )
+
+    if len(args) > 6:
+        return get_batch_iter(pair_iter, args[6])
+    return pair_iter
+
+def kmer_count_from_sequence_pair(sequence_pair, *args):
+    """
+    yields counts of kmers in a pair of mates (or a batch of pairs), using the given kmer count provider (the second arg)
+    for the mates. If the spectrum is per mate (paired is "mates"), each (count, kmer) is followed by the mate number (1 or 2).
+    The remaining args are passed to the wrapped provider
+    """
+    (paired, kmer_count_provider) = args[0:2]
+    if isinstance(sequence_pair, list):
+        mates = ( [ pair[0] for pair in sequence_pair ], [ pair[1] for pair in sequence_pair ] )
+    else:
+        mates = sequence_pair
+    if paired == "combined":
+        if isinstance(sequence_pair, list):
+            return kmer_count_provider(mates[0] + mates[1], *args[2:])   # count both mates in one batch
+        return itertools.chain(*[ kmer_count_provider(mate, *args[2:]) for mate in mates ])
+    return itertools.chain(*[ get_mate_kmer_counts(kmer_count_provider(mate, *args[2:]), mate_number) for (mate_number, mate) in enumerate(mates, 1) ])
+
+def get_mate_kmer_counts(kmer_count_iter, mate_number):
+    return ( (count, kmer, mate_number) for (count, kmer) in kmer_count_iter )
+
+def get_mate_spectra(spectrum):
+    """
+    splits the spectrum of a pair built per mate (with keys like ('CGCCGC', 1)) into a spectrum for each mate (with keys like ('CGCCGC',))
+    """
+    mate_spectra = ({}, {})
+    for ((kmer, mate_number), count) in spectrum.items():
+        mate_spectra[mate_number - 1][(kmer,)] = count
+    return mate_spectra
+
+def get_pair_name(datafile):
+    """
+    returns the name from which the names of the spectra of a combined pair are derived - e.g.
+    sample_R1.fastq.gz -> sample_R1.fastq.gz.paired (so the spectrum is sample_R1.fastq.gz.paired.kmerdist.pickle)
+    """
+    return "%s.paired"%datafile
+
+def get_input_pairs(file_names):
+    """
+    returns a list of (R1, R2) tuples from a list of files given as consecutive pairs
+    """
+    return list(zip(file_names[0::2], file_names[1::2]))
+
 #********************************************************************
 # methods for getting kmer counts from tag count files 
 #********************************************************************
@@ -134,6 +833,9 @@ indicates how many of that tag there are
 
     """
     (input_driver_config, sampling_proportion) = args[0:2]
+    sampler = None
+    if len(args) > 2:
+        sampler = args[2]
 
     if input_driver_config is None:
         raise kmer_prism_exception("""
@@ -145,56 +847,69 @@ cat <$f1
 """)
     else:
         remove_prefix=True  # hard coded true for now but may pass in as part of drive config at some point
-        common_prefix=""
         cat_tag_count_command = [input_driver_config, "%s"%datafile]
 
-
-        # if we are to remove a common prefix (e.g. TGCA in the above example), then
-        # scan the tags to identify the prefix
-        if remove_prefix:
-            print("scanning tags for a common prefix to remove...")
-
-            proc = subprocess.Popen(cat_tag_count_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = proc.communicate()
-            if proc.returncode == 0:
-                tuple_iter = (re.split("\s+",record.strip().upper()) for record in re.split("\n", stdout))    # parse the 3 elements 
-                tuple_iter = ((my_tuple[0], int(my_tuple[1]), int(my_tuple[2]))  for my_tuple in tuple_iter if len(my_tuple) == 3)  # skip the header and make ints
-                tuple_iter = (my_tuple[0][0:my_tuple[1]] for my_tuple in tuple_iter)  # use the tag-length to substring the tag then throw away the numbers
-                sorted_tuples = sorted(tuple_iter)
-                # find the longest common start-string in the first and last elements
-                common_prefix_length = 0
-                match = True
-                while( common_prefix_length < min(len(sorted_tuples[0]), len(sorted_tuples[-1])) ):
-                    # try length + 1
-                    if sorted_tuples[0][0:common_prefix_length+1] == sorted_tuples[-1][0:common_prefix_length+1]:
-                        common_prefix_length += 1
-                    else:
-                        break
-            else:
-                raise kmer_prism_exception("Error encountered running %s - return code was %s, stderr:%s stdout:%s"%(" ".join(cat_tag_count_command),proc.returncode,stderr,stdout))
+        # the driver (e.g. a tassel BinaryToText run) is run once, and its output streamed through a pipe. 
+        # As the tags are read, they are spilled to a temporary file, and the smallest and largest 
+        # tags are tracked - the longest common start-string of these is the prefix common to all 
+        # tags (e.g. TGCA in the above example), which is removed when the spilled tags are replayed
+        print("reading tags and scanning for a common prefix to remove...")
+        spill_file = tempfile.TemporaryFile(mode="w+")
+        error_file = tempfile.TemporaryFile(mode="w+")
+        proc = subprocess.Popen(cat_tag_count_command, stdout=subprocess.PIPE, stderr=error_file, universal_newlines=True)
+        min_tag = None
+        max_tag = None
+        for record in proc.stdout:
+            my_tuple = record.strip().upper().split()   # parse the 3 elements
+            if len(my_tuple) != 3:
+                continue       # skip the header
+            tag = my_tuple[0][0:int(my_tuple[1])]    # use the tag-length to substring the tag
+            if min_tag is None or tag < min_tag:
+                min_tag = tag
+            if max_tag is None or tag > max_tag:
+                max_tag = tag
+            spill_file.write("%s\t%d\n"%(tag, int(my_tuple[2])))
+        proc.stdout.close()
+        proc.wait()
+
+        if proc.returncode != 0:
+            error_file.seek(0)
+            raise kmer_prism_exception("Error encountered running %s - return code was %s, stderr:%s"%(" ".join(cat_tag_count_command),proc.returncode,error_file.read()))
+        error_file.close()
+
+        common_prefix_length = 0
+        if remove_prefix and min_tag is not None:
+            # find the longest common start-string in the smallest and largest tags
+            while( common_prefix_length < min(len(min_tag), len(max_tag)) ):
+                if min_tag[common_prefix_length] == max_tag[common_prefix_length]:
+                    common_prefix_length += 1
+                else:
+                    break
 
             if common_prefix_length > 0 :
-                common_prefix = sorted_tuples[0][0:common_prefix_length]
-                print("found common prefix %s - will exclude from analysis"%common_prefix)
+                print("found common prefix %s - will exclude from analysis"%min_tag[0:common_prefix_length])
             else:
                 print("(no common prefix found)")
 
         print("summarising tags...")
-        proc = subprocess.Popen(cat_tag_count_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout, stderr) = proc.communicate()
-        if proc.returncode == 0:
-            tagcount_iter = (re.split("\s+",record.strip().upper()) for record in re.split("\n", stdout))    # parse the 3 elements 
-            tagcount_iter = ((my_tuple[0], int(my_tuple[1]), int(my_tuple[2]))  for my_tuple in tagcount_iter if len(my_tuple) == 3)  # skip the header and make ints
-            tagcount_iter = ( (my_tuple[0][common_prefix_length:my_tuple[1]], my_tuple[2]) for my_tuple in tagcount_iter)  # use the tag-length to substring the tag, also remove common prefix, and throw away tag length
-            #for record in tagcount_iter:
-            #    print "DEBUG %s"%str(record)
-            #    sys.exit(1)
-        else:
-            raise kmer_prism_exception("Error encountered running %s"%" ".join(cat_tag_count_command))
+        spill_file.seek(0)
+        tagcount_iter = replay_tag_counts(spill_file, common_prefix_length)
+        if sampler is not None:
+            tagcount_iter = sampler.sample(tagcount_iter)
 
     #print "DEBUG got tag count iter"
     return tagcount_iter
 
+def replay_tag_counts(spill_file, common_prefix_length):
+    """
+    yields (tag, count) tuples from a file of spilled tag counts, removing the common prefix from 
+    each tag. The file is closed (and so removed) once all tags have been yielded
+    """
+    for record in spill_file:
+        (tag, tag_count) = record.split("\t")
+        yield (tag[common_prefix_length:], int(tag_count))
+    spill_file.close()
+
 def kmer_count_from_tag_count(tag_count_tuple, *args):
     """
     yields an interator through counts of kmers in a tag - but multiplied
@@ -202,13 +917,19 @@ def kmer_count_from_tag_count(tag_count_tuple, *args):
     """
     reverse_complement = args[0]
     pattern_window_length = args[1]  # optional - for fixed length patterns e.g. 6-mers etc, to speed up search
+    if isinstance(pattern_window_length, (list, tuple)):
+        # multiple kmer sizes - chain the counts for each size 
+        return itertools.chain(*[ kmer_count_from_tag_count(tag_count_tuple, reverse_complement, kmer_size, *args[2:]) for kmer_size in pattern_window_length ])
     weight = args[2]  # un-used currently
     patterns = args[3:]
     (tag,tag_count) = tag_count_tuple
 
     #print "DEBUG args, tag count%s"%str(args, tag_count_tuple)
 
-    if pattern_window_length is None:
+    if len(patterns) == 1 and isinstance(patterns[0], motif_automaton):
+        # literal / IUPAC patterns are all counted in a single scan of the tag 
+        kmer_count_iter = patterns[0].get_motif_counts(tag, tag_count, reverse_complement)
+    elif pattern_window_length is None:
         # search for each pattern. Note that this does not count multiple instances 
         # of a pattern that overlap - for example in TTTTTTT , the pattern TTTTTT will only count once. 
         kmer_iters = tuple((re.finditer(pattern, tag, re.I) for pattern in patterns))
@@ -243,17 +964,530 @@ def kmer_count_from_tag_count(tag_count_tuple, *args):
         
     return kmer_count_iter
 
+def kmer_count_canonical(record, *args):
+    """
+    wraps one of the kmer count providers above (the first arg), collapsing each kmer
+    and its reverse complement into a single (canonical) kmer - the lesser of the two.
+    The remaining args are passed to the wrapped provider
+    """
+    kmer_count_provider = args[0]
+    kmer_dict = {}
+    for (count, kmer) in kmer_count_provider(record, *args[1:]):
+        canonical_kmer = get_canonical_kmer(kmer)
+        kmer_dict[canonical_kmer] = count + kmer_dict.setdefault(canonical_kmer,0)
+    return ( (kmer_dict[kmer], kmer) for kmer in kmer_dict )
+
 #********************************************************************
-# general analysis / summary methods 
+# motif counting. Literal and IUPAC-degenerate patterns (e.g. restriction
+# sites, adapters, barcodes) are expanded to literal sequences, which are
+# compiled into a single Aho-Corasick automaton, so that each sequence is
+# scanned once whatever the number of patterns. Counts are keyed by pattern.
+#********************************************************************
+
+IUPAC_CODES = {
+    "A" : "A", "C" : "C", "G" : "G", "T" : "T", 
+    "R" : "AG", "Y" : "CT", "S" : "CG", "W" : "AT", "K" : "GT", "M" : "AC",
+    "B" : "CGT", "D" : "AGT", "H" : "ACT", "V" : "ACG", "N" : "ACGT"
+}
+MAX_MOTIF_EXPANSION = 65536   # maximum number of literal sequences a degenerate pattern may expand to
+
+def is_motif_pattern(pattern):
+    """
+    returns True if a pattern consists only of IUPAC nucleotide codes (rather than being a regular expression)
+    """
+    return len(pattern) > 0 and len([ letter for letter in pattern.upper() if letter not in IUPAC_CODES ]) == 0
+
+def expand_motif_pattern(pattern):
+    """
+    returns a list of the literal sequences matched by an IUPAC pattern 
+    """
+    expansion_size = 1
+    for letter in pattern.upper():
+        expansion_size *= len(IUPAC_CODES[letter])
+    if expansion_size > MAX_MOTIF_EXPANSION:
+        raise kmer_prism_exception("error - pattern %s matches %d sequences (maximum is %d)"%(pattern, expansion_size, MAX_MOTIF_EXPANSION))
+    return [ "".join(letters) for letters in itertools.product(*[ IUPAC_CODES[letter] for letter in pattern.upper() ]) ]
+
+class motif_automaton(object):
+    """
+    an Aho-Corasick automaton for a list of literal / IUPAC patterns. The automaton is held as 
+    a complete transition table (a dictionary per state), so that scanning a sequence is one 
+    lookup per base 
+    """
+    def __init__(self, patterns, count_overlapping=False):
+        super(motif_automaton, self).__init__()
+        self.count_overlapping = count_overlapping
+        self.patterns = [ pattern.upper() for pattern in patterns ]
+        self.pattern_lengths = [ len(pattern) for pattern in self.patterns ]
+
+        # build the trie of the expanded sequences - outputs are the indexes of the patterns matched at each state
+        transitions = [{}]
+        outputs = [[]]
+        for (pattern_index, pattern) in enumerate(self.patterns):
+            for sequence in expand_motif_pattern(pattern):
+                state = 0
+                for letter in sequence:
+                    if letter not in transitions[state]:
+                        transitions.append({})
+                        outputs.append([])
+                        transitions[state][letter] = len(transitions) - 1
+                    state = transitions[state][letter]
+                if pattern_index not in outputs[state]:
+                    outputs[state].append(pattern_index)
+
+        # add failure transitions breadth first, completing the transition table 
+        alphabet = sorted(set( letter for state_transitions in transitions for letter in state_transitions ))
+        failures = [0] * len(transitions)
+        queue = collections.deque()
+        for letter in alphabet:
+            if letter in transitions[0]:
+                queue.append(transitions[0][letter])
+            else:
+                transitions[0][letter] = 0
+        while len(queue) > 0:
+            state = queue.popleft()
+            outputs[state] = outputs[state] + [ pattern_index for pattern_index in outputs[failures[state]] if pattern_index not in outputs[state] ]
+            for letter in alphabet:
+                if letter in transitions[state]:
+                    next_state = transitions[state][letter]
+                    failures[next_state] = transitions[failures[state]][letter]
+                    queue.append(next_state)
+                else:
+                    transitions[state][letter] = transitions[failures[state]][letter]
+
+        self.transitions = transitions
+        self.outputs = outputs
+
+    def get_motif_counts(self, strseq, weight, reverse_complement=False):
+        """
+        returns a list of (count, pattern) for the patterns found in a sequence. As with regular expression 
+        searches, overlapping instances of the same pattern are not counted, unless the automaton was 
+        built with count_overlapping
+        """
+        count_overlapping = self.count_overlapping
+        transitions = self.transitions
+        outputs = self.outputs
+        pattern_counts = {}
+        match_ends = {}      # position after the last counted instance of each pattern
+        state = 0
+        for (position, letter) in enumerate(strseq.upper()):
+            state = transitions[state].get(letter, 0)
+            for pattern_index in outputs[state]:
+                start = position + 1 - self.pattern_lengths[pattern_index]
+                if count_overlapping or start >= match_ends.get(pattern_index, 0):
+                    pattern_counts[pattern_index] = 1 + pattern_counts.get(pattern_index, 0)
+                    match_ends[pattern_index] = position + 1
+        if reverse_complement:
+            return [ (weight * count, get_reverse_complement(self.patterns[pattern_index])) for (pattern_index, count) in pattern_counts.items() ]
+        return [ (weight * count, self.patterns[pattern_index]) for (pattern_index, count) in pattern_counts.items() ]
+
+def get_kmer_patterns(pattern_list):
+    """
+    returns a list of patterns parsed from a comma separated list, or read from a file (one per line)
+    """
+    if os.path.isfile(pattern_list):
+        with open(pattern_list, "r") as pattern_stream:
+            return [ record.strip() for record in pattern_stream if len(record.strip()) > 0 and not record.startswith("#") ]
+    return [ pattern for pattern in re.split("\s*,\s*", pattern_list.strip()) if len(pattern) > 0 ]
+
+#********************************************************************
+# methods for the packed kmer counting engine. Sequences are read in
+# batches, encoded as 2-bit integer arrays, and kmer codes are rolled
+# and counted using numpy rather than slicing each kmer as a string
+#********************************************************************
+
+PACKED_BATCH_SIZE = 10000   # number of sequences counted per numpy pass
+PACKED_DENSE_MAX_KMER_SIZE = 12  # above this, counts are accumulated sparsely rather than in a 4**k array
+
+def get_batch_iter(record_iter, batch_size):
+    """
+    yields lists of up to batch_size records from an iterator of records
+    """
+    record_iter = iter(record_iter)
+    batch = list(itertools.islice(record_iter, batch_size))
+    while len(batch) > 0:
+        yield batch
+        batch = list(itertools.islice(record_iter, batch_size))
+
+
+def seq_batch_from_sequence_file(datafile, *args):
+    """
+    yields batches (lists) of seqs from a sequence file - either all or a random sample
+    """
+    batch_size = args[-1]
+    return get_batch_iter(seq_from_sequence_file(datafile, *args[:-1]), batch_size)
+
+
+def tag_count_batch_from_tag_count_file(datafile, *args):
+    """
+    yields batches (lists) of (tag, count) tuples from a tassel tag count file
+    """
+    batch_size = args[-1]
+    return get_batch_iter(tag_count_from_tag_count_file(datafile, *args[:-1]), batch_size)
+
+
+def get_non_overlapping_mask(positions, kmers, pattern_window_length):
+    """
+    given the (ascending) positions of kmers in a sequence, returns a list of booleans
+    indicating which of them would be counted by the sliding window method in
+    kmer_count_from_sequence - i.e. a kmer is not counted if an earlier instance of it that
+    was itself recorded overlaps it (so in TTTTTTT , the pattern TTTTTT counts once).
+    Only instances of the same kmer interact, so positions may be a subset of the windows
+    of a sequence (or batch of sequences), as long as all the instances of each kmer that
+    are within pattern_window_length of each other are included
+    """
+    history = {}  # key is kmer, value is list of (position, recorded) of recent instances
+    mask = []
+    for (position, kmer) in zip(positions, kmers):
+        recent = [ item for item in history.get(kmer, []) if position - item[0] <= pattern_window_length ]
+        counted = not any( recorded for (recent_position, recorded) in recent if position - recent_position < pattern_window_length )
+        recorded = counted or any( recorded for (recent_position, recorded) in recent if position - recent_position == pattern_window_length )
+        recent.append((position, recorded))
+        history[kmer] = recent
+        mask.append(counted)
+    return mask
+
+
+def to_byte_string(sequence):
+    """
+    returns the sequence as a byte string (sequences are str under python 2, but need encoding under python 3)
+    """
+    if isinstance(sequence, bytes):
+        return sequence
+    return sequence.encode("ascii")
+
+
+def get_packed_kmer_counts(sequences, weights, pattern_window_length, count_overlapping=False, canonical=False):
+    """
+    returns a dictionary of kmer counts for a batch of sequences (see get_packed_kmer_codes)
+    """
+    import numpy
+    from kmer_spectrum import decode_kmers
+
+    kmer_size = pattern_window_length
+    (counted_codes, counted_weights, other_kmer_weights) = get_packed_kmer_codes(sequences, weights, kmer_size, count_overlapping, canonical)
+    if kmer_size <= PACKED_DENSE_MAX_KMER_SIZE:
+        dense_counts = numpy.bincount(counted_codes, weights=counted_weights, minlength=4**kmer_size)
+        codes = numpy.nonzero(dense_counts)[0]
+        counts = dense_counts[codes]
+    else:
+        (codes, inverse) = numpy.unique(counted_codes, return_inverse=True)
+        counts = numpy.bincount(inverse, weights=counted_weights, minlength=len(codes))
+    if counted_weights is not None and counted_weights.dtype.kind in "iu":
+        counts = numpy.rint(counts).astype(numpy.int64)
+
+    kmer_counts = dict(zip(decode_kmers(codes, kmer_size), counts.tolist()))
+    for (kmer, weight) in other_kmer_weights:
+        kmer_counts[kmer] = weight + kmer_counts.setdefault(kmer, 0)
+    return kmer_counts
+
+
+def get_packed_kmer_codes(sequences, weights, pattern_window_length, count_overlapping=False, canonical=False):
+    """
+    returns (codes, code_weights, other_kmer_weights) for the kmers of a batch of sequences - codes is an array 
+    of the codes of the counted ACGT kmer windows, code_weights None or an array of their weights, and 
+    other_kmer_weights a list of (kmer, weight) of the counted windows containing other characters.
+
+    The sequences are joined (with a separator) into a single byte array and encoded as 2-bit
+    base codes (A=0, C=1, G=2, T=3). The code of each kmer window is rolled with shifts and
+    masks, and windows are counted with bincount into a dense 4**k array (or sparsely, for large k).
+    Windows containing anything other than upper case ACGT (e.g. N, or soft-masked
+    lower case) are counted from their string values, so that the spectrum is the
+    same as kmer_count_from_sequence would give.
+
+    weights is either None (each kmer instance counts 1), or a list of per-sequence weights.
+
+    Unless count_overlapping is set, the non-overlapping repeat semantics of the sliding
+    window method are kept (so in TTTTTTT , the pattern TTTTTT counts once)
+
+    If canonical is set, each kmer is counted as the lesser of its code and the code of its
+    reverse complement (rolled alongside the forward code), so that a kmer and its reverse
+    complement are collapsed into one bin
+    """
+    import numpy
+
+    kmer_size = pattern_window_length
+    byte_sequences = [ to_byte_string(sequence) for sequence in sequences ]
+    buffer = numpy.frombuffer(b"\n".join(byte_sequences), dtype=numpy.uint8)
+    window_count = len(buffer) - kmer_size + 1
+    if len(byte_sequences) == 0 or window_count <= 0:
+        return (numpy.zeros(0, dtype=numpy.int64), None, [])
+
+    # encode - anything other than ACGT gets 4, the separator gets 5
+    base_codes = numpy.full(256, 4, dtype=numpy.int64)
+    for (code, base) in enumerate(b"ACGT"):
+        base_codes[base if isinstance(base, int) else ord(base)] = code
+    base_codes[ord("\n")] = 5
+    encoded = base_codes[buffer]
+
+    # roll the kmer codes 
+    kmer_codes = numpy.zeros(window_count, dtype=numpy.int64)
+    for offset in range(kmer_size):
+        kmer_codes <<= 2
+        kmer_codes |= encoded[offset:offset + window_count] & 3
+
+    if canonical:
+        # roll the reverse complement codes (the complement of base code b is 3 - b)
+        reverse_complement_codes = numpy.zeros(window_count, dtype=numpy.int64)
+        complement = 3 - (encoded & 3)
+        for offset in range(kmer_size):
+            reverse_complement_codes |= complement[offset:offset + window_count] << (2 * offset)
+
+    # find windows which are all ACGT ("valid"), and those which span a sequence separator
+    cumulative_other = numpy.concatenate(([0], numpy.cumsum(encoded >= 4)))
+    cumulative_separator = numpy.concatenate(([0], numpy.cumsum(encoded == 5)))
+    valid = (cumulative_other[kmer_size:] - cumulative_other[:-kmer_size]) == 0
+    within_sequence = (cumulative_separator[kmer_size:] - cumulative_separator[:-kmer_size]) == 0
+    other = within_sequence & ~valid
+
+    # get the weight of each window from the weight of the sequence it is in
+    if weights is not None:
+        lengths = numpy.array([ len(sequence) for sequence in byte_sequences ], dtype=numpy.int64)
+        sequence_weights = numpy.asarray(weights)
+        window_weights = numpy.repeat(sequence_weights, lengths + 1)[:window_count]
+
+    counted = valid
+    if not count_overlapping:
+        # windows that are involved in a repeat are those with an identical window within
+        # pattern_window_length - only these need to be checked sequentially
+        involved = numpy.zeros(window_count, dtype=bool)
+        for distance in range(1, kmer_size + 1):
+            if distance >= window_count:
+                break
+            repeat = valid[distance:] & valid[:-distance] & (kmer_codes[distance:] == kmer_codes[:-distance])
+            involved[distance:] |= repeat
+            involved[:-distance] |= repeat
+        involved_positions = numpy.nonzero(involved)[0]
+        if len(involved_positions) > 0:
+            counted = valid.copy()
+            counted[involved_positions] = get_non_overlapping_mask(involved_positions.tolist(), kmer_codes[involved_positions].tolist(), kmer_size)
+
+    # the valid windows
+    counted_codes = kmer_codes[counted]
+    if canonical:
+        counted_codes = numpy.minimum(counted_codes, reverse_complement_codes[counted])
+    counted_weights = None
+    if weights is not None:
+        counted_weights = window_weights[counted]
+
+    # the windows containing other characters are counted from their string values
+    other_kmer_weights = []
+    other_positions = numpy.nonzero(other)[0].tolist()
+    if len(other_positions) > 0:
+        joined = buffer.tobytes()
+        other_kmers = [ joined[position:position + kmer_size] for position in other_positions ]
+        if sys.version_info >= (3,0):
+            other_kmers = [ kmer.decode("ascii") for kmer in other_kmers ]
+        if count_overlapping:
+            other_mask = len(other_positions) * [True]
+        else:
+            other_mask = get_non_overlapping_mask(other_positions, other_kmers, kmer_size)
+        for (position, kmer, is_counted) in zip(other_positions, other_kmers, other_mask):
+            if is_counted:
+                if canonical:
+                    kmer = get_canonical_kmer(kmer)
+                if weights is None:
+                    weight = 1
+                else:
+                    weight = window_weights[position].item()
+                other_kmer_weights.append((kmer, weight))
+
+    return (counted_codes, counted_weights, other_kmer_weights)
+
+
+def get_kmer_size_list(pattern_window_length):
+    """
+    returns a list of kmer sizes from a pattern window length, which is either a single kmer size or a list
+    """
+    if isinstance(pattern_window_length, (list, tuple)):
+        return list(pattern_window_length)
+    return [pattern_window_length]
+
+
+def kmer_count_from_sequence_batch(sequence_batch, *args):
+    """
+    packed engine equivalent of kmer_count_from_sequence - yields an iterator through counts of kmers in
+    a batch of sequences. Args are the same as for kmer_count_from_sequence, followed by count_overlapping
+    and canonical (patterns are not supported - a pattern_window_length must be given)
+    """
+    (reverse_complement, pattern_window_length, weight, count_overlapping, canonical) = args[0:5]
+    if callable(weight):
+        weights = [ weight(sequence) for sequence in sequence_batch ]
+    elif weight == 1:
+        weights = None
+    else:
+        weights = len(sequence_batch) * [weight]
+
+    sequences = [ get_sequence_bytes(sequence) for sequence in sequence_batch ]
+    kmer_counts = {}
+    for kmer_size in get_kmer_size_list(pattern_window_length):
+        kmer_counts.update(get_packed_kmer_counts(sequences, weights, kmer_size, count_overlapping, canonical))
+    # (as in kmer_count_from_sequence, reverse_complement only applies to patterns - fixed length kmers are counted as found)
+    return ( (kmer_counts[kmer], kmer) for kmer in kmer_counts )
+
+
+def kmer_count_from_tag_count_batch(tag_count_batch, *args):
+    """
+    packed engine equivalent of kmer_count_from_tag_count - yields an iterator through counts of kmers
+    in a batch of (tag, count) tuples, multiplied up by the tag counts
+    """
+    (reverse_complement, pattern_window_length, weight, count_overlapping, canonical) = args[0:5]
+    tags = [ tag for (tag, tag_count) in tag_count_batch ]
+    weights = [ tag_count for (tag, tag_count) in tag_count_batch ]
+    kmer_counts = {}
+    for kmer_size in get_kmer_size_list(pattern_window_length):
+        kmer_counts.update(get_packed_kmer_counts(tags, weights, kmer_size, count_overlapping, canonical))
+    # (as in kmer_count_from_tag_count, reverse_complement only applies to patterns - fixed length kmers are counted as found)
+    return ( (kmer_counts[kmer], kmer) for kmer in kmer_counts )
+
+#********************************************************************
+# sketch mode - approximate counting of large kmers in fixed memory per
+# sample. Batches of sequences (or tags) are encoded as by the packed 
+# engine, and the kmer codes added to a kmer_sketch (see kmer_spectrum.py)
+# for each kmer size. Partitions of a file may be sketched by a pool of 
+# processes, and the sketches merged
 #********************************************************************
-def build_kmer_spectrum(datafile, kmer_patterns, sampling_proportion, num_processes, builddir, reverse_complement, pattern_window_length, input_driver_config, input_filetype=None, weighting_method = None, assemble = False, number_to_assemble=100):
 
-    if os.path.exists(get_save_filename(datafile, builddir)):
+SKETCH_MEMORY_MB = 64        # default size of the count-min table of each sketch
+SKETCH_HEAVY_HITTERS = 1000  # default number of heavy hitters kept by each sketch
+
+def add_batch_to_sketches(sketches, record_batch, is_tag_count, provider_args):
+    """
+    adds the kmers of a batch of sequence records (or (tag, count) tuples) to a list of sketches (one per kmer size). 
+    provider_args are as for kmer_count_from_sequence_batch
+    """
+    (reverse_complement, pattern_window_length, weight, count_overlapping, canonical) = provider_args[0:5]
+    if is_tag_count:
+        sequences = [ tag for (tag, tag_count) in record_batch ]
+        weights = [ tag_count for (tag, tag_count) in record_batch ]
+    else:
+        sequences = [ get_sequence_bytes(sequence) for sequence in record_batch ]
+        if callable(weight):
+            weights = [ weight(sequence) for sequence in record_batch ]
+        elif weight == 1:
+            weights = None
+        else:
+            weights = len(record_batch) * [weight]
+
+    # (as in kmer_count_from_sequence, reverse_complement only applies to patterns - fixed length kmers are sketched as found)
+    for sketch in sketches:
+        (codes, code_weights, other_kmer_weights) = get_packed_kmer_codes(sequences, weights, sketch.kmer_size, count_overlapping, canonical)
+        sketch.add_codes(codes, code_weights)
+        sketch.add_total(sum( other_weight for (kmer, other_weight) in other_kmer_weights ))
+
+def get_new_sketches(kmer_sizes, sketch_memory, sketch_heavy_hitters, sampling_proportion):
+    from kmer_spectrum import kmer_sketch
+    return [ kmer_sketch.from_memory(kmer_size, sketch_memory, sketch_heavy_hitters, sampling_proportion) for kmer_size in kmer_sizes ]
+
+def get_partition_kmer_sketches(partition_args):
+    """
+    worker method - returns a list of sketches (one per kmer size) for a partition of a sequence file, or a block of records 
+    """
+    (datafile, filetype, partition, partition_number, sampler, with_description, batch_size, sketch_parameters, provider_args) = partition_args
+    sketches = get_new_sketches(*sketch_parameters)
+    for record_batch in get_batch_iter(get_partition_records(datafile, filetype, partition, sampler, with_description, partition_number), batch_size):
+        add_batch_to_sketches(sketches, record_batch, False, provider_args)
+    return sketches
+
+def get_kmer_sketches(sketch_prism, datafile, num_processes, sketch_memory, sketch_heavy_hitters):
+    """
+    returns a list of sketches (one per kmer size) of a sequence or tag count file, using the batch input method 
+    and provider args of a prism configured for the packed engine. Fasta and fastq files read by the raw record reader are 
+    partitioned between a pool of worker processes
+    """
+    provider_args = sketch_prism.spectrum_value_provider_func_xargs
+    (filetype, sampling_proportion) = sketch_prism.file_to_stream_func_xargs[0:2]
+    kmer_sizes = get_kmer_size_list(provider_args[1])
+    sketch_parameters = (kmer_sizes, sketch_memory, sketch_heavy_hitters, sampling_proportion)
+
+    if sketch_prism.file_to_stream_func == seq_batch_from_sequence_file and num_processes > 1 and \
+       sketch_prism.file_to_stream_func_xargs[2] == "raw" and filetype in RAW_RECORD_FILETYPES and is_partitionable_sampler(sketch_prism.file_to_stream_func_xargs[4]):
+        (with_description, sampler) = sketch_prism.file_to_stream_func_xargs[3:5]
+        batch_size = sketch_prism.file_to_stream_func_xargs[-1]
+        partitions = get_file_partitions(datafile, num_processes)
+        if partitions is None:
+            partitions = record_blocks_from_gzip(datafile, filetype)
+        partition_args_iter = ( (datafile, filetype, partition, partition_number, sampler, with_description, batch_size, sketch_parameters, provider_args) \
+                                for (partition_number, partition) in enumerate(partitions) )
+        sketches = get_new_sketches(*sketch_parameters)
+        pool = Pool(num_processes)
+        try:
+            for partition_args_wave in get_batch_iter(partition_args_iter, 4 * num_processes):
+                for partial_sketches in pool.map(get_partition_kmer_sketches, partition_args_wave):
+                    for (sketch, partial_sketch) in zip(sketches, partial_sketches):
+                        sketch.merge(partial_sketch)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        sketches = get_new_sketches(*sketch_parameters)
+        is_tag_count = sketch_prism.file_to_stream_func == tag_count_batch_from_tag_count_file
+        for record_batch in sketch_prism.file_to_stream_func(datafile, *sketch_prism.file_to_stream_func_xargs):
+            add_batch_to_sketches(sketches, record_batch, is_tag_count, provider_args)
+    return sketches
+
+#********************************************************************
+# general analysis / summary methods 
+#********************************************************************
+def build_kmer_spectrum(datafile, kmer_patterns, sampling_proportion, num_processes, builddir, reverse_complement, pattern_window_length, input_driver_config, input_filetype=None, weighting_method = None, assemble = False, number_to_assemble=100, \
+                        kmer_engine="string", count_overlapping=False, canonical=False, record_reader="raw", spectrum_format="pickle", \
+                        cache_fingerprint="stat", sketch_memory=SKETCH_MEMORY_MB, sketch_heavy_hitters=SKETCH_HEAVY_HITTERS, minimum_sample_size=0, sampling_seed=None, \
+                        timing=False, mate_file=None, paired=None, minimum_mate_overlap=None, assembly_report="unitigs"):
+
+    # if pattern_window_length is a list of kmer sizes, the spectrum for each size is built in a single pass
+    # through the input, and saved separately
+    multiple_kmer_sizes = isinstance(pattern_window_length, (list, tuple))
+    
+    # if a mate file is given, datafile and mate_file are the R1 and R2 files of a pair, which are read in lockstep, 
+    # and either a combined spectrum is saved (named after the pair), or a spectrum for each mate
+    spectrum_names = [datafile]
+    if mate_file is not None:
+        if paired == "mates":
+            spectrum_names = [datafile, mate_file]
+        else:
+            spectrum_names = [get_pair_name(datafile)]
+    
+    if multiple_kmer_sizes:
+        save_filenames = [ get_save_filename(spectrum_name, builddir, kmer_size, spectrum_format) for spectrum_name in spectrum_names for kmer_size in pattern_window_length ]
+    else:
+        save_filenames = [ get_save_filename(spectrum_name, builddir, spectrum_format=spectrum_format) for spectrum_name in spectrum_names ]
+
+    # spectra already in the build folder are re-used if they were built from the same input with the same
+    # parameters (or if the input is no longer available e.g. when just summarising). The sampling parameters
+    # are a separate part of the key, so that spectra built from a sample are re-used by a run which does not sample
+    cache_key = None
+    cached_keys = None
+    if cache_fingerprint != "none" and os.path.isfile(datafile) and (mate_file is None or os.path.isfile(mate_file)):
+        cache_key = get_cache_key(datafile, cache_fingerprint, { "kmer_patterns" : kmer_patterns, \
+                                  "reverse_complement" : reverse_complement, "kmer_size" : pattern_window_length, "input_driver_config" : input_driver_config, \
+                                  "input_filetype" : input_filetype, "weighting_method" : weighting_method, "count_overlapping" : count_overlapping, \
+                                  "canonical" : canonical, "spectrum_format" : spectrum_format })
+        if spectrum_format == "sketch":
+            cache_key = get_cache_key(datafile, cache_fingerprint, { "cache_key" : cache_key, "sketch_memory" : sketch_memory, "sketch_heavy_hitters" : sketch_heavy_hitters })
+        if mate_file is not None:
+            cache_key = get_cache_key(mate_file, cache_fingerprint, { "cache_key" : cache_key, "paired" : paired, "minimum_mate_overlap" : minimum_mate_overlap })
+        cache_key = "%s:%s"%(cache_key, get_sampling_key(sampling_proportion, minimum_sample_size, sampling_seed))
+        if all( os.path.exists(save_filename) for save_filename in save_filenames ):
+            cached_keys = get_cached_keys(builddir, save_filenames, cache_key, reuse_sampled = sampling_proportion is None)
+    
+    if all( os.path.exists(save_filename) for save_filename in save_filenames ) and (cache_key is None or cached_keys is not None):
         print("build_kmer_spectrum- skipping %s as already done"%datafile)
-        kmer_prism = prism.load(get_save_filename(datafile, builddir))
-        kmer_prism.summary()
+        if cache_key is not None:
+            record_cached_spectra(builddir, save_filenames, cached_keys, datafile)
+        for save_filename in save_filenames:
+            if spectrum_format == "binary":
+                from kmer_spectrum import kmer_spectrum
+                kmer_spectrum.load(save_filename).summary()
+            elif spectrum_format == "sketch":
+                from kmer_spectrum import kmer_sketch
+                kmer_sketch.load(save_filename).summary()
+            else:
+                kmer_prism = prism.load(save_filename)
+                kmer_prism.summary()
         
     else:
+        if all( os.path.exists(save_filename) for save_filename in save_filenames ):
+            print("build_kmer_spectrum- rebuilding %s as the saved spectra are stale (input or parameters have changed)"%datafile)
         print("build_kmer_spectrum- processing %s"%datafile)
         filetype = input_filetype
         if filetype is None:
@@ -263,41 +1497,274 @@ def build_kmer_spectrum(datafile, kmer_patterns, sampling_proportion, num_proces
         kmer_prism.interval_locator_funcs = (bin_discrete_value,)
         kmer_prism.assignments_files = ("kmer_binning.txt",)
         kmer_prism.file_to_stream_func = seq_from_sequence_file
-        kmer_prism.file_to_stream_func_xargs = [filetype,sampling_proportion]
+        sampler = get_record_sampler(sampling_proportion, minimum_sample_size, sampling_seed)
+        kmer_prism.file_to_stream_func_xargs = [filetype,sampling_proportion,record_reader,weighting_method == "tag_count",sampler]
         kmer_prism.spectrum_value_provider_func = kmer_count_from_sequence
 
         if weighting_method is None:
             kmer_prism.spectrum_value_provider_func_xargs = [reverse_complement, pattern_window_length, 1] + kmer_patterns        
         elif weighting_method == "tag_count":
             kmer_prism.spectrum_value_provider_func_xargs = [reverse_complement, pattern_window_length, parse_weight_from_sequence_description] + kmer_patterns
+
+        if pattern_window_length is None and len([ pattern for pattern in kmer_patterns if is_motif_pattern(pattern) ]) == len(kmer_patterns):
+            # literal and IUPAC patterns are counted using a single automaton, rather than a regular expression search per pattern 
+            kmer_prism.spectrum_value_provider_func_xargs = kmer_prism.spectrum_value_provider_func_xargs[0:3] + [motif_automaton(kmer_patterns, count_overlapping)]
         
         if filetype == ".cnt":
             #print "DEBUG setting methods for count file"
             kmer_prism.file_to_stream_func = tag_count_from_tag_count_file
-            kmer_prism.file_to_stream_func_xargs = [input_driver_config,sampling_proportion]
+            kmer_prism.file_to_stream_func_xargs = [input_driver_config,sampling_proportion,sampler]
             kmer_prism.spectrum_value_provider_func = kmer_count_from_tag_count 
+
+        if (kmer_engine == "packed" or spectrum_format == "sketch") and pattern_window_length is not None:
+            # count batches of sequences (or tags) using the 2-bit packed engine (sketches are always built from packed batches)
+            kmer_prism.file_to_stream_func_xargs = kmer_prism.file_to_stream_func_xargs + [PACKED_BATCH_SIZE]
+            kmer_prism.spectrum_value_provider_func_xargs = kmer_prism.spectrum_value_provider_func_xargs[0:3] + [count_overlapping, canonical]
+            if filetype == ".cnt":
+                kmer_prism.file_to_stream_func = tag_count_batch_from_tag_count_file
+                kmer_prism.spectrum_value_provider_func = kmer_count_from_tag_count_batch
+            else:
+                kmer_prism.file_to_stream_func = seq_batch_from_sequence_file
+                kmer_prism.spectrum_value_provider_func = kmer_count_from_sequence_batch
+        elif canonical:
+            # collapse kmers and their reverse complements as they are counted
+            kmer_prism.spectrum_value_provider_func_xargs = [kmer_prism.spectrum_value_provider_func] + kmer_prism.spectrum_value_provider_func_xargs
+            kmer_prism.spectrum_value_provider_func = kmer_count_canonical
+
+        if mate_file is not None:
+            # read the pair in lockstep, and count the kmers of both mates with the provider configured above
+            kmer_prism.file_to_stream_func = seq_pairs_from_sequence_files
+            kmer_prism.file_to_stream_func_xargs = [mate_file, filetype, record_reader, weighting_method == "tag_count", sampler, minimum_mate_overlap] + \
+                                                   kmer_prism.file_to_stream_func_xargs[5:]    # i.e. the batch size, if batched
+            kmer_prism.spectrum_value_provider_func_xargs = [paired, kmer_prism.spectrum_value_provider_func] + kmer_prism.spectrum_value_provider_func_xargs
+            kmer_prism.spectrum_value_provider_func = kmer_count_from_sequence_pair
+            if paired == "mates":
+                kmer_prism.interval_locator_parameters = (None, None)
+                kmer_prism.interval_locator_funcs = (bin_discrete_value, bin_discrete_value)
+
+        # optionally time the stages of the build (see prism_instrument.py)
+        global raw_block_instrument
+        instrument = None
+        if timing:
+            from prism_instrument import build_instrument
+            instrument = build_instrument(datafile, [ filename for filename in [datafile, mate_file] if filename is not None ])
+            instrument.instrument_prism(kmer_prism)
+            raw_block_instrument = instrument
+            instrument.start_stage("merge")
+
+        if spectrum_format == "sketch":
+            # approximate counting in fixed memory 
+            sketches = get_kmer_sketches(kmer_prism, datafile, num_processes, sketch_memory, sketch_heavy_hitters)
+        elif filetype == ".cnt" and num_processes > 1:
+            # decode the tag counts once, and count kmers in chunks of tags in a pool of worker processes
+            kmer_prism = get_parallel_tag_count_prism(kmer_prism, datafile, num_processes)
+            spectrum_data = kmer_prism.spectrum
+        elif filetype == ".cnt":
             spectrum_data = build(kmer_prism, use="singlethread")
+        elif num_processes > 1 and record_reader == "raw" and filetype in RAW_RECORD_FILETYPES and is_partitionable_sampler(sampler) and mate_file is None:
+            # each process reads a disjoint partition of the file 
+            kmer_prism = get_partitioned_sequence_prism(kmer_prism, datafile, num_processes)
+            spectrum_data = kmer_prism.spectrum
         else:
             spectrum_data = build(kmer_prism, proc_pool_size=num_processes)
-            
-        kmer_prism.save(get_save_filename(datafile, builddir))
 
-        print("spectrum %s has %d points distributed over %d intervals, stored in %d parts"%(get_save_filename(datafile, builddir), kmer_prism.total_spectrum_value, len(spectrum_data), len(kmer_prism.part_dict)))
+        if instrument is not None:
+            instrument.end_stage("merge")
+            instrument.restore_prism(kmer_prism)
+            raw_block_instrument = None
+            instrument.start_stage("save")
+
+        if spectrum_format == "sketch":
+            for (sketch, save_filename) in zip(sketches, save_filenames):
+                sketch.save(save_filename)
+                print("sketch %s has %d points, approximately %d distinct kmers, and %d heavy hitters"%(save_filename, sketch.total, sketch.get_cardinality(), sketch.get_kmer_count()))
+        elif spectrum_format == "binary" or multiple_kmer_sizes or paired == "mates":
+            # save a spectrum for each mate (if built per mate) and kmer size
+            mate_spectra = [kmer_prism.spectrum]
+            if paired == "mates":
+                mate_spectra = get_mate_spectra(kmer_prism.spectrum)
+            kmer_sizes = [None]
+            if multiple_kmer_sizes:
+                kmer_sizes = pattern_window_length
+            save_items = [ (spectrum_name, mate_spectrum, kmer_size) for (spectrum_name, mate_spectrum) in zip(spectrum_names, mate_spectra) for kmer_size in kmer_sizes ]
+            for ((spectrum_name, mate_spectrum, kmer_size), save_filename) in zip(save_items, save_filenames):
+                if spectrum_format == "binary":
+                    # save in the compact binary spectrum format
+                    from kmer_spectrum import kmer_spectrum
+                    if kmer_size is not None:
+                        kmer_counts = dict( (interval, count) for (interval, count) in mate_spectrum.items() if len(interval[0]) == kmer_size )
+                    else:
+                        kmer_counts = mate_spectrum
+                    spectrum = kmer_spectrum.from_kmer_counts(kmer_counts, sampling_proportion)
+                    spectrum.save(save_filename)
+                    print("spectrum %s has %d points distributed over %d intervals"%(save_filename, spectrum.total, spectrum.get_kmer_count()))
+                else:
+                    kmer_size_prism = get_spectrum_prism(mate_spectrum, spectrum_name, kmer_size)
+                    kmer_size_prism.save(save_filename)
+                    print("spectrum %s has %d points distributed over %d intervals"%(save_filename, kmer_size_prism.total_spectrum_value, len(kmer_size_prism.spectrum)))
+        else:
+            kmer_prism.save(save_filenames[0])
+
+            print("spectrum %s has %d points distributed over %d intervals, stored in %d parts"%(save_filenames[0], kmer_prism.total_spectrum_value, len(spectrum_data), len(kmer_prism.part_dict)))
+
+        if instrument is not None:
+            instrument.end_stage("save")
+            instrument.write(save_filenames)
 
         if assemble:
             print("assembling low entropy kmers (lowest %d)..."%number_to_assemble)
-            kmer_list = sorted(kmer_prism.spectrum.items(), lambda x,y:cmp(y[1], x[1]))[0:number_to_assemble]   # sort in descending order and pick the first number_to_assemble
+            kmer_items = kmer_prism.spectrum.items()
+            if multiple_kmer_sizes:
+                kmer_items = [ item for item in kmer_items if len(item[0][0]) == max(pattern_window_length) ]   # assemble the largest kmers
+            kmer_list = sorted(kmer_items, lambda x,y:cmp(y[1], x[1]))[0:number_to_assemble]   # sort in descending order and pick the first number_to_assemble
             # yields e.g. 
             #[(('CGCCGC',), 26870.0), (('GCGGCG',), 25952.0),....
             print("(%s)"%str(kmer_list))
             kmer_list = [ item[0][0] for item in kmer_list ]
-            assemble_kmer_spectrum(kmer_list, datafile, input_filetype, None, weighting_method=weighting_method)
+            assemble_kmer_spectrum(kmer_list, datafile, input_filetype, None, weighting_method=weighting_method, num_processes=num_processes, assembly_report=assembly_report)
+
+        if cache_key is not None:
+            record_cached_spectra(builddir, save_filenames, len(save_filenames) * [cache_key], datafile)
             
+    if paired == "mates" and mate_file is not None:
+        # the names of the spectra of each mate
+        if multiple_kmer_sizes:
+            return [ save_filenames[0:len(pattern_window_length)], save_filenames[len(pattern_window_length):] ]
+        return save_filenames
+    if multiple_kmer_sizes:
+        return save_filenames
+    return save_filenames[0]
+
+
+def kmer_counts_from_spectrum(datafile, *args):
+    """
+    yields (count, kmer) tuples from an already built spectrum (a dictionary with keys like ('CGCCGC',)),
+    optionally just those for kmers of a given size
+    """
+    (spectrum, kmer_size) = args[0:2]
+    return ( (count, interval[0]) for (interval, count) in spectrum.items() if kmer_size is None or len(interval[0]) == kmer_size )
+
+def kmer_count_from_kmer_count(kmer_count, *args):
+    return (kmer_count,)
+
+def get_spectrum_prism(spectrum, datafile, kmer_size=None):
+    """
+    returns a prism for an already built spectrum - e.g. with just the kmers of a given size, from a 
+    prism built for multiple kmer sizes, or a spectrum merged from partial spectra.  
+    (The spectrum is re-played through build, rather than re-reading the input) 
+    """
+    spectrum_prism = prism([datafile], 1)
+    spectrum_prism.interval_locator_parameters = (None,)
+    spectrum_prism.interval_locator_funcs = (bin_discrete_value,)
+    spectrum_prism.assignments_files = ("kmer_binning.txt",)
+    spectrum_prism.file_to_stream_func = kmer_counts_from_spectrum
+    spectrum_prism.file_to_stream_func_xargs = [spectrum, kmer_size]
+    spectrum_prism.spectrum_value_provider_func = kmer_count_from_kmer_count
+    build(spectrum_prism, use="singlethread")
+    spectrum_prism.file_to_stream_func_xargs = [None, kmer_size]   # don't save a copy of the source spectrum
+    return spectrum_prism
+
+
+TAG_COUNT_CHUNK_SIZE = 10000  # number of (tag, count) tuples counted by a worker at a time
+
+def get_chunk_kmer_counts(chunk_args):
+    """
+    worker method - returns a partial spectrum (dictionary with keys like ('CGCCGC',)) for a chunk
+    of records, using the given spectrum value provider
+    """
+    (record_chunk, spectrum_value_provider_func, spectrum_value_provider_func_xargs) = chunk_args
+    kmer_counts = {}
+    for record in record_chunk:
+        for (count, kmer) in spectrum_value_provider_func(record, *spectrum_value_provider_func_xargs):
+            kmer_counts[(kmer,)] = count + kmer_counts.setdefault((kmer,),0)
+    return kmer_counts
+
+def get_parallel_tag_count_prism(tag_count_prism, datafile, num_processes):
+    """
+    builds the spectrum of a tag count file using a pool of worker processes. The tag counts are 
+    decoded once (by the prism's file_to_stream_func), split into chunks which are 
+    counted by the workers, and the partial spectra are merged. Chunks are handed out in waves, so 
+    that only a few chunks per worker are held in memory at a time. Returns a prism for the merged spectrum
+    """
+    record_iter = tag_count_prism.file_to_stream_func(datafile, *tag_count_prism.file_to_stream_func_xargs)
+    if tag_count_prism.file_to_stream_func == tag_count_batch_from_tag_count_file:
+        chunk_size = 1     # records are already batches of tags
+    else:
+        chunk_size = TAG_COUNT_CHUNK_SIZE
+    chunk_args_iter = ( (record_chunk, tag_count_prism.spectrum_value_provider_func, tag_count_prism.spectrum_value_provider_func_xargs) \
+                        for record_chunk in get_batch_iter(record_iter, chunk_size) )
 
-    return get_save_filename(datafile, builddir)
+    spectrum = get_pooled_spectrum(get_chunk_kmer_counts, chunk_args_iter, num_processes)
+    return get_spectrum_prism(spectrum, datafile)
 
+def get_pooled_spectrum(worker_func, worker_args_iter, num_processes):
+    """
+    runs a worker method (which returns a partial spectrum) over an iterator of args in a pool 
+    of processes, and returns the merged spectrum. Args are handed out in waves, so that only
+    a few per worker are held in memory at a time 
+    """
+    spectrum = {}
+    pool = Pool(num_processes)
+    try:
+        for worker_args_wave in get_batch_iter(worker_args_iter, 4 * num_processes):
+            for partial_spectrum in pool.map(worker_func, worker_args_wave):
+                for (interval, count) in partial_spectrum.items():
+                    spectrum[interval] = count + spectrum.setdefault(interval,0)
+    finally:
+        pool.close()
+        pool.join()
+    return spectrum
+
+
+ASSEMBLY_CHUNK_SIZE = 10000    # number of sequences scanned per worker task when assembling
+
+def get_longest_supporting_run(strseq, kmer_index, pattern_window_length):
+    """
+    slides the window along the sequence and returns the longest run of consecutive windows which are 
+    members of the kmer index (a set), as a tuple of kmers (the first, if there are several of the same 
+    length), or None if there are no supporting kmers 
+    """
+    best_start = 0
+    best_length = 0
+    run_start = None
+    window_count = max(0, 1+len(strseq)-pattern_window_length)
+    for i in range(0, window_count):
+        if strseq[i:i+pattern_window_length] in kmer_index:
+            if run_start is None:
+                run_start = i
+        elif run_start is not None:
+            if i - run_start > best_length:
+                (best_start, best_length) = (run_start, i - run_start)
+            run_start = None
+
+    # check for a supporting run that included the last kmer
+    if run_start is not None and window_count - run_start > best_length:
+        (best_start, best_length) = (run_start, window_count - run_start)
+
+    if best_length == 0:
+        return None
+    return tuple( strseq[i:i+pattern_window_length] for i in range(best_start, best_start + best_length) )
+
+def get_chunk_supporting_runs(chunk_args):
+    """
+    worker method - returns a dictionary with the longest supporting run of each of a chunk of (sequence, count) as key, 
+    and the total count of sequences with that run as value 
+    """
+    (sequence_count_chunk, kmer_index, pattern_window_length) = chunk_args
+    supporting_runs = {}
+    for (strseq, sequence_count) in sequence_count_chunk:
+        best_supporting_run = get_longest_supporting_run(strseq, kmer_index, pattern_window_length)
+        if best_supporting_run is not None:
+            # store the supporting run in a dict with run as key, value the number of seqs with that run
+            supporting_runs[best_supporting_run] = sequence_count + supporting_runs.setdefault(best_supporting_run,0)
+    return supporting_runs
 
-def assemble_kmer_spectrum(kmer_list, sequence_file, sequence_file_type, sampling_proportion, input_driver_config = None,counts_file = None, weighting_method=None):
+def assemble_kmer_spectrum(kmer_list, sequence_file, sequence_file_type, sampling_proportion, input_driver_config = None,counts_file = None, weighting_method=None, num_processes=1, \
+                           assembly_report="unitigs"):
+    """
+    reports the unitigs assembled from the runs of the listed kmers found in the sequences (and, if assembly_report is "all", 
+    also the assembled runs themselves, as reported by earlier versions)
+    """
 
     # get an iter of (sequence, count)
     if sequence_file_type is None:
@@ -326,42 +1793,19 @@ def assemble_kmer_spectrum(kmer_list, sequence_file, sequence_file_type, samplin
     #
     #return
         
-    unassembled_dict = {} # key is a tuple of supporting kmers, value is count 
-
     pattern_window_length = max( len(kmer) for kmer in kmer_list)
     if pattern_window_length != min( len(kmer) for kmer in kmer_list):
         raise trim_exception("error -  all kmers in supporting list mustbe the same length")
     
-    for (sequence, sequence_count) in zsequences_counts_stream:      # z prefix denotes a zipped stream  - returns tuple of (seq, count)
-        # analyse sequence     
-        # slide the window along the sequence and accumulate exact matches to members of patterns.
-        #print sequence, sequence_count
-        strseq = str(sequence.seq)
-        supporting_run = []
-        supporting_runs = []
-        kmer_iter = (strseq[i:i+pattern_window_length] for i in range(0,1+len(strseq)-pattern_window_length))
-        #print "assembling %s using %s"%(str(kmer_list), strseq)
-        for kmer in kmer_iter:
-            #print "checking %s"%kmer
-            if kmer in kmer_list:
-                #print "added"
-                supporting_run.append(kmer) 
-            else:
-                if len(supporting_run) > 0:   # conclude this supporting run and append to the list of supporting runs
-                    supporting_runs.append(supporting_run)
-                    supporting_run = []
-
-        # check for a supporting run that included the last kmer
-        if len(supporting_run) > 0:
-           supporting_runs.append(supporting_run)
-
-        # if there are any supporting runs, store the longest
-        if len(supporting_runs) > 0:
-            supporting_runs = sorted(supporting_runs, lambda a,b:cmp(len(a), len(b)), None, True)
-            best_supporting_run = tuple(supporting_runs[0])
-
-            # store the supporting run in a dict with run as key, value the number of seqs with that run
-            unassembled_dict[best_supporting_run] = sequence_count + unassembled_dict.setdefault(best_supporting_run,0)
+    # find the longest supporting run in each sequence - in chunks of sequences scanned by a pool of worker
+    # processes if requested
+    kmer_index = set(kmer_list)
+    zsequences_counts_stream = ( (get_sequence_string(sequence), sequence_count) for (sequence, sequence_count) in zsequences_counts_stream )  # z prefix denotes a zipped stream  - returns tuple of (seq, count)
+    if num_processes > 1:
+        chunk_args_iter = ( (chunk, kmer_index, pattern_window_length) for chunk in get_batch_iter(zsequences_counts_stream, ASSEMBLY_CHUNK_SIZE) )
+        unassembled_dict = get_pooled_spectrum(get_chunk_supporting_runs, chunk_args_iter, num_processes)
+    else:
+        unassembled_dict = get_chunk_supporting_runs((zsequences_counts_stream, kmer_index, pattern_window_length))
 
     # summarise the frequency distribution of the lengths of supporting kmer runs (redundant length)
     unassembled_dist = {}
@@ -371,22 +1815,9 @@ def assemble_kmer_spectrum(kmer_list, sequence_file, sequence_file_type, samplin
     # summarise the frequency distribution of the non-redundant lengths of supporting kmer runs
     unassembled_dist_nr = {}
     for (kmer_tuple, count) in unassembled_dict.items():
-        unassembled_dist_nr[len(set(kmer_tuple))] = count + unassembled_dist.setdefault(len(set(kmer_tuple)),0)
+        unassembled_dist_nr[len(set(kmer_tuple))] = count + unassembled_dist_nr.setdefault(len(set(kmer_tuple)),0)
     
 
-    # assemble each of the runs 
-    assembled_dict = {}
-    for (kmer_tuple, count)in unassembled_dict.items():
-        if len(kmer_tuple) == 0:
-            assembly = ""
-        elif len(kmer_tuple) == 1:
-            assembly = kmer_tuple[0]
-        else:
-            assembly = reduce(lambda x,y:x+y[-1],kmer_tuple[1:],kmer_tuple[0])
-
-        # for each assembled run , store the count of seqs exhibiting the run, and also the non-redundant length of the run that was assembled
-        assembled_dict[assembly] = ( count , len(set(kmer_tuple)) )
-    
     print("\n\n\n")
     print("Frequency distribution of kmer counts found in seqs (of kmers to be assembled)")
     for key in sorted(unassembled_dist.keys()):
@@ -398,35 +1829,123 @@ def assemble_kmer_spectrum(kmer_list, sequence_file, sequence_file_type, samplin
         print("%s\t%s"%(key, unassembled_dist_nr[key]))
 
     print("\n\n\n")
-    print("Sequences assembled from target kmers and found in the data, sorted by length descending, reporting count of containing seqs, and distinct kmer count")
-    container = None
-    for key in sorted(assembled_dict.keys(),lambda x,y:cmp(len(x),len(y)),None,True):
-        if container is None:
-            container = key
-        elif container.find(key) < 0:
-            container = key
+    print("Unitigs of the de Bruijn graph of target kmers (with adjacencies as observed in the data), sorted by support descending, reporting length, kmer count and support (summed count of seqs supporting each kmer)")
+    unitigs = get_unitigs(*get_debruijn_graph(unassembled_dict))
+    for (unitig, kmer_count, support) in sorted(unitigs, key=lambda unitig:(-unitig[2], -len(unitig[0]), unitig[0])):
+        print("unitig\t%s\tlength=\t%d\tkmers=\t%d\tsupport=\t%s"%(unitig, len(unitig), kmer_count, support))
 
-        print("assembled_by_length\t%s\tcontained_in\t%s\tcounts=\t%s"%(key, container, assembled_dict[key]))
+    if assembly_report != "all":
+        return
 
-    def cmp_length_and_distinct_kmers(s1, s2):
-        """
-        sort first by distinct kmer counts, then by length, both descending
-        """
-        if assembled_dict[s1][1] == assembled_dict[s2][1]:
-            return cmp(len(s2),len(s1))
-        else:
-            return cmp(assembled_dict[s2][1] , assembled_dict[s1][1])
+    # assemble each of the runs 
+    assembled_dict = {}
+    for (kmer_tuple, count)in unassembled_dict.items():
+        # for each assembled run , store the count of seqs exhibiting the run, and also the non-redundant length of the run that was assembled
+        assembled_dict[get_path_assembly(kmer_tuple)] = ( count , len(set(kmer_tuple)) )
+
+    containers = get_containing_assemblies(assembled_dict.keys(), pattern_window_length)
+
+    print("\n\n\n")
+    print("Sequences assembled from target kmers and found in the data, sorted by length descending, reporting count of containing seqs, and distinct kmer count")
+    for key in sorted(assembled_dict.keys(), key=lambda assembly:(-len(assembly), assembly)):
+        print("assembled_by_length\t%s\tcontained_in\t%s\tcounts=\t%s"%(key, containers[key], assembled_dict[key]))
 
     print("\n\n\n")
     print("Sequences assembled from target kmers and found in the data, sorted by count of distinct kmers in seq, and length , descending")
-    container = None
-    for key in sorted(assembled_dict.keys(),cmp_length_and_distinct_kmers):
-        if container is None:
-            container = key
-        elif container.find(key) < 0:
-            container = key
+    for key in sorted(assembled_dict.keys(), key=lambda assembly:(-assembled_dict[assembly][1], -len(assembly), assembly)):
+        print("assembled_by_distinct\t%s\tcontained_in\t%s\tcounts=\t%s"%(key, containers[key], assembled_dict[key]))
+
+
+#********************************************************************
+# de Bruijn graph assembly of supporting kmer runs. Nodes are the kmers 
+# found in supporting runs, and edges the adjacencies observed in the runs.
+# Non-branching paths are compacted to unitigs
+#********************************************************************
+
+def get_path_assembly(kmer_path):
+    """
+    returns the sequence spelled by a path of overlapping kmers
+    """
+    if len(kmer_path) == 0:
+        return ""
+    return kmer_path[0] + "".join( kmer[-1] for kmer in kmer_path[1:] )
 
-        print("assembled_by_distinct\t%s\tcontained_in\t%s\tcounts=\t%s"%(key, container, assembled_dict[key]))
+def get_debruijn_graph(unassembled_dict):
+    """
+    returns (node_support, successors, predecessors) from a dictionary of supporting runs (tuples of kmers) and counts. The 
+    support of a kmer is the summed count of the runs that contain it, and successors and predecessors are
+    dictionaries of sets of kmers
+    """
+    node_support = {}
+    successors = {}
+    predecessors = {}
+    for (kmer_tuple, count) in unassembled_dict.items():
+        for kmer in set(kmer_tuple):
+            node_support[kmer] = count + node_support.setdefault(kmer,0)
+            successors.setdefault(kmer, set())
+            predecessors.setdefault(kmer, set())
+        for (kmer, next_kmer) in zip(kmer_tuple[:-1], kmer_tuple[1:]):
+            successors[kmer].add(next_kmer)
+            predecessors[next_kmer].add(kmer)
+    return (node_support, successors, predecessors)
+
+def get_unitigs(node_support, successors, predecessors):
+    """
+    compacts the de Bruijn graph into unitigs (maximal non-branching paths, including isolated cycles), and returns a 
+    list of (sequence, kmer count, summed support) 
+    """
+    def continues_unitig(kmer):
+        # a kmer continues the unitig of its predecessor, if each is the only neighbour of the other
+        if len(predecessors[kmer]) != 1:
+            return False
+        predecessor = next(iter(predecessors[kmer]))
+        return predecessor != kmer and len(successors[predecessor]) == 1
+
+    def get_unitig_path(start_kmer):
+        path = [start_kmer]
+        while len(successors[path[-1]]) == 1:
+            next_kmer = next(iter(successors[path[-1]]))
+            if next_kmer == start_kmer or not continues_unitig(next_kmer):
+                break
+            path.append(next_kmer)
+        return path
+
+    unitigs = []
+    visited = set()
+    start_kmers = [ kmer for kmer in sorted(node_support.keys()) if not continues_unitig(kmer) ]
+    for start_kmer in start_kmers + sorted(node_support.keys()):
+        # (kmers not yet visited after the start kmers are processed lie on isolated cycles)
+        if start_kmer in visited:
+            continue
+        path = get_unitig_path(start_kmer)
+        visited.update(path)
+        unitigs.append( (get_path_assembly(path), len(path), sum( node_support[kmer] for kmer in path )) )
+    return unitigs
+
+def get_containing_assemblies(assemblies, pattern_window_length):
+    """
+    returns a dictionary with each assembly as key, and the longest assembly containing it as value (the assembly 
+    itself if it is not contained in a longer one). Candidate containers are found from an index of the 
+    kmers of each assembly 
+    """
+    assemblies = sorted(assemblies, key=lambda assembly:(-len(assembly), assembly))
+    kmer_index = {}
+    for (assembly_number, assembly) in enumerate(assemblies):
+        for kmer in set( assembly[i:i+pattern_window_length] for i in range(0, 1+len(assembly)-pattern_window_length) ):
+            kmer_index.setdefault(kmer, []).append(assembly_number)
+
+    containers = {}
+    for assembly in assemblies:
+        containers[assembly] = assembly
+        # candidates are in length order, so the first which contains the assembly is the longest
+        for assembly_number in kmer_index.get(assembly[0:pattern_window_length], []):
+            candidate = assemblies[assembly_number]
+            if len(candidate) < len(assembly):
+                break
+            if candidate != assembly and candidate.find(assembly) >= 0:
+                containers[assembly] = candidate
+                break
+    return containers
 
 
 def use_kmer_prbdf(picklefile):
@@ -435,29 +1954,229 @@ def use_kmer_prbdf(picklefile):
     for (interval, freq) in spectrum_data.items():
         print(interval, freq)
 
-def get_save_filename(input_filename, builddir):
+#********************************************************************
+# spectrum cache. The spectra saved in a build folder are recorded in an
+# index file, with a key derived from a fingerprint of the input file
+# and all of the counting parameters. The key is in two parts - 
+# (fingerprint and counting parameters):(sampling parameters) - a saved 
+# spectrum is re-used if its key matches, or if just the first part 
+# matches and the spectrum is not to be sampled (i.e. as before the cache
+# was keyed, a re-run without -s re-uses spectra that were built from a 
+# sample). Spectra with no index entry (e.g. in a build folder that predates
+# the index) are re-used as they are, and are then indexed with a "legacy"
+# key, so that they can be evicted. Entries may be evicted by total size 
+# or age. The index is a tab-delimited text file, with one line per build
+# or re-use (the last line for a spectrum file is current) :
+#
+# spectrum filename, key, last used (seconds since epoch), size (bytes), input filename
+#********************************************************************
+
+CACHE_INDEX_FILENAME = "kmer_prism.cache_index.txt"
+LEGACY_CACHE_KEY = "legacy"
+UNSAMPLED_CACHE_KEY = "all"
+CACHE_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+def get_input_fingerprint(datafile, fingerprint_method):
+    """
+    returns a fingerprint of an input file - either its size and modification time ("stat"), or
+    its size and a hash of its contents ("hash")
+    """
+    stat = os.stat(datafile)
+    if fingerprint_method == "hash":
+        content_hash = hashlib.sha1()
+        with open(datafile, "rb") as data_stream:
+            for block in iter(lambda: data_stream.read(CACHE_HASH_BLOCK_SIZE), b""):
+                content_hash.update(block)
+        return "%d:%s"%(stat.st_size, content_hash.hexdigest())
+    return "%d:%d"%(stat.st_size, int(stat.st_mtime))
+
+
+def get_cache_key(datafile, fingerprint_method, parameters):
+    """
+    returns the cache key of the spectra of an input file, built with a dictionary of parameters
+    """
+    key_parts = [ os.path.realpath(datafile), get_input_fingerprint(datafile, fingerprint_method) ]
+    key_parts += [ "%s=%s"%(name, repr(parameters[name])) for name in sorted(parameters.keys()) ]
+    return hashlib.sha1("\t".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def get_sampling_key(sampling_proportion, minimum_sample_size, sampling_seed):
+    """
+    returns the sampling part of a cache key
+    """
+    if sampling_proportion is None:
+        return UNSAMPLED_CACHE_KEY
+    return hashlib.sha1(("%r\t%r\t%r"%(sampling_proportion, minimum_sample_size, sampling_seed)).encode("utf-8")).hexdigest()
+
+
+def read_cache_index(builddir):
+    """
+    returns a dictionary of the current cache index entries in a build folder, keyed by spectrum filename
+    """
+    index = {}
+    index_filename = os.path.join(builddir, CACHE_INDEX_FILENAME)
+    if not os.path.exists(index_filename):
+        return index
+    with open(index_filename, "r") as index_stream:
+        for record in index_stream:
+            fields = record.rstrip("\n").split("\t")
+            if len(fields) != 5:
+                continue      # e.g. a line truncated by a concurrent writer
+            index[fields[0]] = { "key" : fields[1], "last_used" : float(fields[2]), "size" : int(fields[3]), "input" : fields[4] }
+    return index
+
+
+def get_cached_keys(builddir, save_filenames, cache_key, reuse_sampled = False):
+    """
+    returns the index keys of the saved spectra, if they can all be re-used for the given cache key, otherwise None. 
+    If reuse_sampled, spectra built from a sample can be re-used (i.e. the sampling part of the key is not compared)
+    """
+    index = read_cache_index(builddir)
+    cached_keys = []
+    for save_filename in save_filenames:
+        if not os.path.exists(save_filename):
+            return None
+        entry = index.get(os.path.basename(save_filename))
+        if entry is None or entry["key"] == LEGACY_CACHE_KEY:
+            print("(re-using %s, which was cached without a cache index entry, so its parameters were not checked)"%save_filename)
+            cached_keys.append(LEGACY_CACHE_KEY)
+        elif entry["key"] == cache_key or (reuse_sampled and entry["key"].split(":")[0] == cache_key.split(":")[0]):
+            cached_keys.append(entry["key"])
+        else:
+            return None
+    return cached_keys
+
+
+def record_cached_spectra(builddir, save_filenames, cache_keys, datafile):
+    # lines are short and appended in one write, so that concurrent builds sharing a folder can update the index
+    lines = "".join( "%s\t%s\t%d\t%d\t%s\n"%(os.path.basename(save_filename), cache_key, int(time.time()), os.path.getsize(save_filename), datafile) \
+                     for (save_filename, cache_key) in zip(save_filenames, cache_keys) if os.path.exists(save_filename) )
+    with open(os.path.join(builddir, CACHE_INDEX_FILENAME), "a") as index_stream:
+        index_stream.write(lines)
+
+
+def evict_cached_spectra(builddir, max_size_gb, max_age_days, keep_filenames):
+    """
+    deletes cached spectra (least recently used first) until the total size of the cache is no more
+    than max_size_gb, and deletes spectra not used for more than max_age_days, then rewrites the index.
+    Spectra in keep_filenames are not deleted
+    """
+    index = read_cache_index(builddir)
+    keep_basenames = set( os.path.basename(filename) for filename in keep_filenames )
+    entries = sorted( (entry["last_used"], save_basename) for (save_basename, entry) in index.items() \
+                      if os.path.exists(os.path.join(builddir, save_basename)) )
+    total_size = sum( index[save_basename]["size"] for (last_used, save_basename) in entries )
+
+    evicted = set()
+    for (last_used, save_basename) in entries:
+        if save_basename in keep_basenames:
+            continue
+        too_old = max_age_days is not None and time.time() - last_used > max_age_days * 86400
+        too_big = max_size_gb is not None and total_size > max_size_gb * 1024**3
+        if too_old or too_big:
+            print("evicting %s from spectrum cache"%save_basename)
+            os.remove(os.path.join(builddir, save_basename))
+            total_size -= index[save_basename]["size"]
+            evicted.add(save_basename)
+
+    # rewrite the (compacted) index
+    (index_fd, index_tempname) = tempfile.mkstemp(dir=builddir, prefix=CACHE_INDEX_FILENAME)
+    with os.fdopen(index_fd, "w") as index_stream:
+        for (last_used, save_basename) in entries:
+            if save_basename not in evicted:
+                entry = index[save_basename]
+                index_stream.write("%s\t%s\t%d\t%d\t%s\n"%(save_basename, entry["key"], int(entry["last_used"]), entry["size"], entry["input"]))
+    os.rename(index_tempname, os.path.join(builddir, CACHE_INDEX_FILENAME))
+    print("spectrum cache has %d spectra (%d bytes) after evicting %d"%(len(entries) - len(evicted), total_size, len(evicted)))
+
+
+def get_save_filename(input_filename, builddir, kmer_size=None, spectrum_format="pickle"):
     sanitised_input_filename = re.sub("[\s\$]","_", input_filename)
-    return os.path.join(builddir,"%s.kmerdist.pickle"%(os.path.basename(sanitised_input_filename)))
+    suffix = ".kmerdist.pickle"
+    if spectrum_format == "binary":
+        suffix = ".kmerdist.spectrum"
+    elif spectrum_format == "sketch":
+        suffix = ".kmerdist.sketch"
+    if kmer_size is not None:
+        return os.path.join(builddir,"%s.k%d%s"%(os.path.basename(sanitised_input_filename), kmer_size, suffix))
+    return os.path.join(builddir,"%s%s"%(os.path.basename(sanitised_input_filename), suffix))
+
+def get_sample_name(save_filename):
+    """
+    returns the sample name used as a column heading in summaries - e.g. T867.fastq.gz.kmerdist
+    (the kmer size is dropped from the names of spectra built for multiple kmer sizes) 
+    """
+    return re.sub("\\.k\\d+\\.kmerdist$", ".kmerdist", os.path.splitext(os.path.basename(save_filename))[0])
+
+def get_kmer_size_output_filename(output_filename, kmer_size):
+    """
+    returns the name of the summary output file for a given kmer size, when summarising multiple kmer sizes
+    - e.g. distributions.txt -> distributions.k6.txt
+    """
+    (output_base, output_suffix) = os.path.splitext(output_filename)
+    return "%s.k%d%s"%(output_base, kmer_size, output_suffix)
+
+def get_kmer_sizes(kmer_size_string):
+    """
+    parses the kmer size option, which is either a single kmer size (e.g. 6), or a list 
+    and / or range of sizes (e.g. 1,2,6 or 1-6). Returns an int or a list of ints 
+    """
+    if re.search("^\d+$", kmer_size_string.strip()) is not None:
+        return int(kmer_size_string)
+    kmer_sizes = []
+    for item in re.split("\s*,\s*", kmer_size_string.strip()):
+        range_match = re.search("^(\d+)-(\d+)$", item)
+        if range_match is not None:
+            kmer_sizes += range(int(range_match.groups()[0]), 1+int(range_match.groups()[1]))
+        else:
+            kmer_sizes.append(int(item))
+    return sorted(set(kmer_sizes))
 
 
+if sys.version_info >= (3,0):
+    COMPLEMENT_TABLE = str.maketrans("ACGTRYKMBVDH", "TGCAYRMKVBHD")
+else:
+    COMPLEMENT_TABLE = string.maketrans("ACGTRYKMBVDH", "TGCAYRMKVBHD")
+
 def get_reverse_complement(kmer):
-    kmer=kmer.upper()
-    kmer=kmer.replace("A","t")
-    kmer=kmer.replace("T","a")
-    kmer=kmer.replace("C","g")
-    kmer=kmer.replace("G","c")
-    kmer=''.join(reversed(kmer))
-    return kmer.upper()
+    return kmer.upper().translate(COMPLEMENT_TABLE)[::-1]
+
+def get_canonical_kmer(kmer):
+    """
+    returns the lesser of a kmer and its reverse complement 
+    """
+    return min(kmer, get_reverse_complement(kmer))
     
     
 def build_kmer_spectra(options):
         
     spectrum_names = []
-    for file_name in options["file_names"]:
-        spectrum_names.append(build_kmer_spectrum(file_name, options["kmer_regexps"], options["sampling_proportion"], \
+    if options["paired"] is None:
+        input_pairs = [ (file_name, None) for file_name in options["file_names"] ]
+    else:
+        input_pairs = get_input_pairs(options["file_names"])
+    for (file_name, mate_file_name) in input_pairs:
+        spectrum_name = build_kmer_spectrum(file_name, options["kmer_regexps"], options["sampling_proportion"], \
                            options["num_processes"], options["builddir"], options["reverse_complement"], \
                            options["kmer_size"], options["input_driver_config"], options["input_filetype"], \
-                           options["weighting_method"], options["assemble_low_entropy_kmers"]))
+                           options["weighting_method"], options["assemble_low_entropy_kmers"], \
+                           kmer_engine=options["kmer_engine"], count_overlapping=options["count_overlapping"], canonical=options["canonical"], \
+                           record_reader=options["record_reader"], spectrum_format=options["spectrum_format"], \
+                           cache_fingerprint=options["cache_fingerprint"], sketch_memory=options["sketch_memory"], \
+                           sketch_heavy_hitters=options["sketch_heavy_hitters"], minimum_sample_size=options["minimum_sample_size"], \
+                           sampling_seed=options["sampling_seed"], timing=options["timing"], mate_file=mate_file_name, paired=options["paired"], \
+                           minimum_mate_overlap=options["minimum_mate_overlap"], assembly_report=options["assembly_report"])
+        if options["paired"] == "mates":
+            spectrum_names += spectrum_name    # a spectrum (or list of spectra by kmer size) for each mate
+        else:
+            spectrum_names.append(spectrum_name)
+
+    if options["cache_max_size"] is not None or options["cache_max_age"] is not None:
+        keep_filenames = []
+        for spectrum_name in spectrum_names:
+            keep_filenames += spectrum_name if isinstance(spectrum_name, list) else [spectrum_name]
+        evict_cached_spectra(options["builddir"], options["cache_max_size"], options["cache_max_age"], keep_filenames)
+        
     return spectrum_names
 
 
@@ -467,6 +2186,14 @@ def summarise_spectra(distributions, options):
     if options["summary_type"] in ["zipfian","entropy"]:
         measure = "unsigned_information"
 
+    # binary spectra and sketches (and incremental summaries, and binary distance matrices) are summarised using the matrix
+    # engine, which memory maps binary spectra rather than unpickling them, and measures and ranks them as prism does
+    if options.get("summary_engine") == "matrix" or options.get("summary_state") is not None or options.get("distance_matrix_file") is not None or \
+       len([ distribution for distribution in distributions if distribution.endswith(".kmerdist.spectrum") or distribution.endswith(".kmerdist.sketch") ]) > 0:
+        return summarise_spectra_matrix(distributions, measure, options)
+    return summarise_spectra_prism(distributions, measure, options)
+
+def summarise_spectra_prism(distributions, measure, options):
     kmer_intervals = prism.get_intervals(distributions, options["num_processes"])
 
     if options["alphabet"] is not None:
@@ -481,7 +2208,7 @@ def summarise_spectra(distributions, options):
 
     sample_measures = prism.get_projections(distributions, kmer_intervals, measure, False, options["num_processes"])
     zsample_measures = itertools.izip(*sample_measures)
-    sample_name_iter = [tuple([os.path.splitext(os.path.basename(distribution))[0] for distribution in distributions])]
+    sample_name_iter = [tuple([get_sample_name(distribution) for distribution in distributions])]
     zsample_measures = itertools.chain(sample_name_iter, zsample_measures)
     interval_name_iter = itertools.chain([("kmer_pattern")],kmer_intervals)
     
@@ -526,24 +2253,113 @@ def summarise_spectra(distributions, options):
         outfile.close()
 
 
+#********************************************************************
+# matrix summariser - all spectra are loaded into a single samples x kmers
+# array, and measures, ranks and zipfian distances are calculated for all
+# samples at once using numpy, rather than by zipping per-sample projections.
+# The measures, ranks and distances are those of the prism engine
+#********************************************************************
+
+SUMMARY_WRITE_BLOCK_SIZE = 10000   # number of kmer rows formatted per write
+
+def write_measure_table(outfile, kmers, sample_names, matrix):
+    """
+    writes a kmers x samples table of a samples x kmers matrix
+    """
+    print("%s\t%s"%("kmer_pattern", "\t".join(sample_names)), file=outfile)
+    row_format = "\t".join((1 + len(sample_names)) * ["%s"]) + "\n"
+    for block_start in range(0, len(kmers), SUMMARY_WRITE_BLOCK_SIZE):
+        block_kmers = kmers[block_start:block_start + SUMMARY_WRITE_BLOCK_SIZE]
+        block_rows = matrix[:, block_start:block_start + SUMMARY_WRITE_BLOCK_SIZE].T.tolist()
+        outfile.write("".join( row_format%tuple([kmer] + row) for (kmer, row) in zip(block_kmers, block_rows) ))
+
+
+def summarise_spectra_matrix(distributions, measure, options):
+    from kmer_spectrum import get_spectrum_matrix, get_measure_matrix, get_rank_matrix, get_zipfian_distance_matrix, save_distance_matrix, \
+         get_summary_state
+
+    # with a summary state, only spectra not already in the state are loaded (and zipfian distances are updated rather than recalculated)
+    state = None
+    if options.get("summary_state") is not None:
+        state = get_summary_state(options["summary_state"], distributions, options["alphabet"])
+        (kmers, counts, totals) = (state.kmers, state.counts, state.totals)
+    else:
+        (kmers, counts, totals) = get_spectrum_matrix(distributions, options["alphabet"])
+    print("summarising %s , %d kmers across %s (matrix engine)"%(measure, len(kmers), str(distributions)))
+
+    measures = get_measure_matrix(counts, totals, measure)
+    sample_names = [ get_sample_name(distribution) for distribution in distributions ]
+
+    with open(options["output_filename"], "w") as outfile:
+        if options["summary_type"] in ["entropy", "frequency"]:
+            write_measure_table(outfile, kmers, sample_names, measures)
+        elif options["summary_type"] in ["ranks", "zipfian"]:
+            ranks = get_rank_matrix(measures)
+
+            print("*** ranks *** :", file=outfile)
+            write_measure_table(outfile, kmers, sample_names, ranks)
+
+            print("*** entropies *** :", file=outfile)
+            write_measure_table(outfile, kmers, sample_names, measures)
+
+            print("*** distances *** :", file=outfile)
+            if state is not None and measure == "unsigned_information":
+                distance_matrix = state.get_zipfian_distance_matrix(measures, ranks, options["num_processes"])
+            else:
+                distance_matrix = get_zipfian_distance_matrix(measures, ranks, options["num_processes"])
+            # (printed by prism, in sample name order, as the prism engine prints them)
+            name_order = sorted(range(len(sample_names)), key=lambda index: sample_names[index])
+            prism.print_distance_matrix(distance_matrix[name_order][:, name_order].tolist(), [ sample_names[index] for index in name_order ], outfile)
+            if options.get("distance_matrix_file") is not None:
+                save_distance_matrix(distance_matrix, sample_names, options["distance_matrix_file"])
+        else:
+            print("warning, unknown summary type %(summary_type)s, no summary available"%options)
+
+    if state is not None:
+        state.save(options["summary_state"])
+
+
 def get_options():
     description = """
     This script summaries kmer frequencies or entropies for multiple input files. The output is a single tab-delimited text file
     with one row per kmer and one column per input file
 
     Input files may be fasta or fastq, compressed or uncompressed. The format of each file is inferred from its suffix.
+    Fasta and fastq files are read by a fast raw record reader (fastq records must be 4 lines) - use --record_reader biopython
+    to parse them with Bio.SeqIO instead.
 
     A sampling proportion may be specified, in which case a random sample of that proportion of each input file will be taken.
 
-    Multiple processes are started to analyse each file (even if only one file is being processed), with each process doing an interleaved
-    read of sequences from the same file. The default number of processes started is 4 (in that case process 1 handles the
-    1st, 5th, 9th, etc  sequences in the file; process 2 handles the 2nd, 6th, 10th, etc sequences in the file, etc; 
-    results are merged at the end). The -p option can be used to specify more or less processes.
-
-    The kmer summary for each input file is cached in the build folder as a serialised python object file. The name of the file is based on the
-    name of the input file, with a suffix ".kmerdist.pickle" added. If a serialised summary is already cached, the script
-    will not bother re-analysing the input file. This means the all-files summary table can be incrementally built, simply by re-running
-    a previous build command, with additional filenames appended.
+    Multiple processes are started to analyse each file (even if only one file is being processed), with each process reading a
+    separate part of the file. The default number of processes started is 4 (in that case, for an uncompressed file, process 1 handles
+    the records that start in the first quarter of the file, process 2 those in the second quarter, etc; results are merged at the end).
+    Files compressed with bgzip are split into ranges of compressed blocks, while other gzip files (which can only be decompressed
+    from the start) are decompressed once and handed out to the processes in blocks of records. (With --record_reader biopython, each
+    process instead does an interleaved read of sequences from the same file - process 1 handles the 1st, 5th, 9th, etc sequences,
+    process 2 the 2nd, 6th, 10th, etc). The -p option can be used to specify more or less processes.
+    For tag count (.cnt) files, the tags are decoded once, and chunks of tags are counted by the processes.
+
+    For fixed length kmers (-k), the -e packed option selects a faster counting engine, which reads sequences in batches, encodes them
+    as 2-bit integer arrays and counts kmers using numpy. It gives the same spectra as the default (string) engine.
+
+    The kmer spectrum of each input file is cached in the build folder, by default as a serialised python object file. The name of the file
+    is based on the name of the input file, with a suffix ".kmerdist.pickle" added. Cached spectra are recorded in a cache index in the build
+    folder (kmer_prism.cache_index.txt), keyed by a fingerprint of the input file (its size and modification time, or with --cache_fingerprint hash,
+    a hash of its contents) and the counting parameters. If a spectrum with a matching key is already cached, the script will not bother
+    re-analysing the input file. This means the all-files summary table can be incrementally built, simply by re-running a previous build
+    command, with additional filenames appended. A spectrum built from a random sample is also re-used by a run without -s, but if the input
+    file, the counting parameters or the sampling parameters have changed, the spectrum is rebuilt (and the log says so). Spectra which are not
+    in the cache index (e.g. in a build folder made before the index was kept) are re-used as they are, and the log notes that their parameters
+    were not checked. The least recently used spectra can be evicted from the build folder, to keep it under a given size (--cache_max_size)
+    or to drop spectra not used for a given number of days (--cache_max_age). The summary table itself is recalculated from the cached spectra
+    on each run, unless --summary_state is given, in which case the summary is also kept (as a count matrix plus any zipfian distances), so
+    that re-running only loads the additional spectra.
+
+    Several kmer sizes may be given (e.g. -k 1,2,6 or -k 1-6), in which case each input file is read once and a spectrum for each
+    kmer size is cached (with suffix ".k<size>.kmerdist.pickle"), and a summary is written for each kmer size (e.g. distributions.k6.txt)
+
+    Paired-end reads may be given (with --paired) as consecutive pairs of R1 and R2 files, in which case the files of each pair are read 
+    together in a single pass, and either a combined spectrum of the pair, or a spectrum for each mate, is cached (and summarised). 
 
     """
     long_description = """
@@ -557,14 +2373,46 @@ kmer_prism.py -t frequency -k 1 ./*.fa
 # , based on a random sample of 1/1000 seqs, split over 20 processes
 kmer_prism.py -t entropy -k 6 -p 20 -s .001 /data/project2/*.fastq.gz
 
+# as above, but sample at least 10000 seqs from each file (in one pass), using a fixed seed so the samples are reproducible
+kmer_prism.py -t entropy -k 6 -p 20 -s .001 -M 10000 --sampling_seed 1 /data/project2/*.fastq.gz
+
 # as above , but now also include 2 reference genomes. If this is run in the same folder as the
-# above, the script will re-use the previously cached results, so will only
-# have to analyse the kmer distribution for the two new files listed. The       if filetype is None:
-            filetype = get_file_type(datafile)two new files will not
-# be randomly sampled (no -s option specified), however for the existing files the cached results are
-# based on a random sample.  
+# above, the script will re-use the cached spectra of the fastq files (a run without -s re-uses
+# spectra built from a random sample), so will only have to analyse the kmer distribution for the
+# two new files listed. The two new files will not be randomly sampled (no -s option specified),
+# however for the existing files the cached spectra are based on a random sample. (Re-running with
+# a different -s, or different counting options such as -c, would rebuild the cached spectra)
 kmer_prism.py -t entropy -k 6 -p 20  /data/project2/*.fastq.gz /references/ref1.fa /references/ref2.fa
 
+# make tables of base composition, dinucleotide and 6-mer frequencies for all fastq files in /data/project2, reading 
+# each file only once (writes distributions.k1.txt, distributions.k2.txt, distributions.k6.txt)
+kmer_prism.py -t frequency -k 1,2,6 -e packed /data/project2/*.fastq.gz
+
+# as above, but cache the spectra in the compact binary format, which is summarised using the matrix engine (memory 
+# mapping the spectra rather than unpickling them). (kmer_spectrum.py can be used to convert existing .kmerdist.pickle files)
+kmer_prism.py -t frequency -k 1,2,6 -e packed --spectrum_format binary /data/project2/*.fastq.gz
+
+# zipfian summary of a large project, keeping the summary state so that when more files are added later (by re-running 
+# with the additional files appended), only the new spectra are loaded, and only their distances calculated
+kmer_prism.py -t zipfian -k 6 -e packed --summary_state /data/project2/kmer_analysis/summary_state.npz -b /data/project2/kmer_analysis /data/project2/*.fastq.gz
+
+# screen for contamination using 25-mers, approximately counted in a 256MB sketch per sample, comparing the frequencies 
+# of the 5000 most frequent 25-mers of each sample 
+kmer_prism.py -t frequency -k 25 --spectrum_format sketch --sketch_memory 256 --sketch_heavy_hitters 5000 /data/project2/*.fastq.gz
+
+# paired-end QC in one job per sample : the R1 and R2 files of each sample are read together in a single pass, and a 6-mer 
+# spectrum built for each mate, counting only the part of R2 that does not overlap R1 where the mates overlap 
+kmer_prism.py -t frequency -k 6 -e packed --paired mates --trim_mate_overlap /data/project2/s1_R1.fastq.gz /data/project2/s1_R2.fastq.gz
+
+# build spectra in a shared build folder, re-using any spectra previously built there from identical inputs (by
+# content) with the same parameters, and then evicting the least recently used spectra (other than those just 
+# built or re-used) to keep the folder under 50GB
+kmer_prism.py -t frequency -k 6 -b /dataset/shared/kmer_builds --cache_fingerprint hash --cache_max_size 50 /data/project2/*.fastq.gz
+
+# zipfian summary of a large number of samples, with the zipfian distances calculated a block of samples at a time 
+# over 16 processes, and also saved as a binary matrix for plotting
+kmer_prism.py -t zipfian -k 6 -p 16 --summary_engine matrix --distance_matrix_file zipfian_distances.bin /data/project2/*.fastq.gz
+
 # obtain a text file containing self-information and ranks for 6-mers in a tag count file
 ./kmer_prism.py -t zipfian -k 6 -p 1 -o tag_zipfian.txt -x /dataset/2023_illumina_sequencing_a/active/bin/hiseq_pipeline/cat_tag_count.sh /dataset/2023_illumina_sequencing_a/scratch/postprocessing/151016_D00390_0236_AC6JURANXX.gbs/SQ0124.processed_sample/uneak/tagCounts/G88687_C6JURANXX_1_124_X4.cnt
 
@@ -579,14 +2427,17 @@ kmer_prism.py -t entropy -k 6 -p 20  /data/project2/*.fastq.gz /references/ref1.
     parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
     parser.add_argument('file_names', type=str, nargs='+',metavar="filename", help='list of files to process')
     parser.add_argument('-t', '--summary_type' , dest='summary_type', default="frequency", choices=["frequency", "entropy", "ranks", "zipfian", "assembly", "test"],help="type of summary")
-    parser.add_argument('-k', '--kmer_size' , dest='kmer_size', default=None, type=int, help="kmer size (default None)")
-    parser.add_argument('-r', '--kmer_regexp_list' , dest='kmer_regexps', default=None, type=str, help="list of regular expressions (not currently supported)")
+    parser.add_argument('-k', '--kmer_size' , dest='kmer_size', default=None, type=str, help="kmer size, or a list or range of kmer sizes (e.g. 1,2,6 or 1-6) to build in a single pass (default None)")
+    parser.add_argument('-r', '--kmer_regexp_list' , dest='kmer_regexps', default=None, type=str, help="comma separated list of patterns to count instead of kmers (or the name of a file containing one pattern per line). If all patterns are literal or IUPAC-degenerate sequences (e.g. GCWGC), they are counted using a single automaton (and counts are reported per pattern), otherwise each is searched for as a regular expression")
     parser.add_argument('-b', '--build_dir' , dest='builddir', default=".", type=str, help="build folder (default '.')")
     parser.add_argument('-p', '--num_processes' , dest='num_processes', default=4, type=int, help="number of processes to start (default 4)")
     parser.add_argument('-s', '--sampling_proportion' , dest='sampling_proportion', default=None, type=float, help="proportion of sequence records to sample (default None means process all records)")
+    parser.add_argument('-M', '--minimum_sample_size' , dest='minimum_sample_size', default=0, type=int, help="minimum number of records to sample - if sampling the given proportion yields fewer records than this, a uniform random sample of this many records (or all records, if there are fewer) is used instead. The input is still read only once (default 0)")
+    parser.add_argument('--sampling_seed' , dest='sampling_seed', default=None, type=int, help="seed for the random sampling of records, so that samples are reproducible (default None - seeded from the system)")
     parser.add_argument('-o', '--output_filename' , dest='output_filename', default="distributions.txt", type=str, help="name of the output file to contain table of kmer distribution summaries for each input file (default 'distributions.txt')")
-    parser.add_argument('-c', '--reverse_complement' , dest='reverse_complement', action='store_true', help="for each kmer tabulate the frequency or entropy of its reverse complement (default False)")
+    parser.add_argument('-c', '--reverse_complement' , dest='reverse_complement', action='store_true', help="for each pattern (-r) tabulate the frequency or entropy of its reverse complement (fixed length kmers (-k) are tabulated as found) (default False)")
     parser.add_argument('-A', '--assemble_low_entropy_kmers' , dest='assemble_low_entropy_kmers', action='store_true', help="assemble low entropy kmers (default False)")
+    parser.add_argument('--assembly_report' , dest='assembly_report', default="unitigs", type=str, choices=["unitigs", "all"], help="what assembly runs (-t assembly or -A) report. unitigs : the unitigs of the de Bruijn graph of the kmers. all : also the assembled supporting runs (assembled_by_length and assembled_by_distinct), as reported by earlier versions (default unitigs)")
     parser.add_argument('-N', '--assemble_highest_n' , dest='assemble_highest_n', default=100, type=int, help="assemble top N kmers (default 50)")
     parser.add_argument('-x', '--input_driver_config' , dest='input_driver_config', default=None, help="this is use to configure input from custom file formats such as tassel count files")    
     parser.add_argument('-a', '--alphabet' , dest='alphabet', default=None, type=str, help="alphabet used to filter kmers when summarising distributions (not applied when building distribution)")
@@ -594,6 +2445,23 @@ kmer_prism.py -t entropy -k 6 -p 20  /data/project2/*.fastq.gz /references/ref1.
     parser.add_argument('--kmer_listfile' , dest='kmer_listfile', default=None, type=str,  help="list of kmers for an assembly run")
     parser.add_argument('--sequence_countfile' , dest='sequence_countfile', default=None, type=str,  help="sequence count file")
     parser.add_argument('--weighting_method' , dest='weighting_method', default=None, type=str,  choices=["tag_count"], help="weighting method")
+    parser.add_argument('-e', '--kmer_engine' , dest='kmer_engine', default="string", type=str,  choices=["string", "packed"], help="kmer counting engine - packed encodes batches of sequences as 2-bit arrays and counts using numpy (requires kmer_size) (default string)")
+    parser.add_argument('--record_reader' , dest='record_reader', default="raw", type=str,  choices=["raw", "biopython"], help="how fasta and fastq records are read - raw is a fast reader which only keeps the sequence (and description); biopython uses Bio.SeqIO (default raw)")
+    parser.add_argument('--spectrum_format' , dest='spectrum_format', default="pickle", type=str,  choices=["pickle", "binary", "sketch"], help="format in which spectra are cached in the build folder - binary spectra (.kmerdist.spectrum) are compact, and are memory mapped when summarised (by the matrix engine). sketch : kmers (of up to 31 bases) are counted approximately, in fixed memory, in a count-min sketch with a HyperLogLog estimate of the number of distinct kmers and a list of the heavy hitters (the most frequent kmers) - summaries compare the estimated counts of the heavy hitters of all samples (default pickle)")
+    parser.add_argument('--sketch_memory' , dest='sketch_memory', default=SKETCH_MEMORY_MB, type=float, help="memory (MB) of the count-min table of each sketch (i.e. per sample and kmer size, and per process while building) (default %d)"%SKETCH_MEMORY_MB)
+    parser.add_argument('--sketch_heavy_hitters' , dest='sketch_heavy_hitters', default=SKETCH_HEAVY_HITTERS, type=int, help="number of heavy hitters (most frequent kmers) kept by each sketch (default %d)"%SKETCH_HEAVY_HITTERS)
+    parser.add_argument('--summary_engine' , dest='summary_engine', default="prism", type=str,  choices=["prism", "matrix"], help="prism : project each spectrum using data_prism. matrix : load all spectra into a single (samples x kmers) numpy array, and calculate measures, ranks and zipfian distances for all samples at once (the distances a block of samples at a time, over num_processes processes). (The measures, ranks and distances are those of the prism engine - e.g. a kmer absent from a sample is given the self-information of half the smallest count in the sample. Binary spectra and sketches are always summarised using the matrix engine) (default prism)")
+    parser.add_argument('--timing' , dest='timing', action='store_true', help="time the stages of each build (decompress, parse, count, merge, save), and write the timing (with records/sec and peak memory) as a json file next to each spectrum (e.g. x.kmerdist.pickle.timing.json), and a summary line to the log (default False)")
+    parser.add_argument('--summary_state' , dest='summary_state', default=None, type=str,  help="optionally keep the count matrix (and zipfian distances, for zipfian summaries) of the summary in this (.npz) file, so that when the summary is re-run with additional spectra, only those are loaded (and zipfian distances are updated rather than recalculated) (implies the matrix engine). Use a separate state file for each summary type and alphabet. If several kmer sizes are summarised, a state file is kept for each (e.g. state.npz -> state.k6.npz) (default None)")
+    parser.add_argument('--distance_matrix_file' , dest='distance_matrix_file', default=None, type=str,  help="optionally also write the distance matrix of a ranks or zipfian summary to this (binary) file (implies the matrix engine)")
+    parser.add_argument('--cache_fingerprint' , dest='cache_fingerprint', default="stat", type=str,  choices=["stat", "hash", "none"], help="how input files are fingerprinted, to decide whether spectra in the build folder can be re-used. stat : size and modification time. hash : size and hash of contents. none : re-use any existing spectrum (default stat)")
+    parser.add_argument('--cache_max_size' , dest='cache_max_size', default=None, type=float,  help="optionally evict the least recently used spectra from the build folder so that it holds no more than this many GB of spectra (only spectra in the cache index are counted) (default None)")
+    parser.add_argument('--cache_max_age' , dest='cache_max_age', default=None, type=float,  help="optionally evict spectra which have not been used for this many days from the build folder (default None)")
+    parser.add_argument('--canonical' , dest='canonical', action='store_true', help="count each kmer and its reverse complement together, as the lesser of the two (default False)")
+    parser.add_argument('--paired' , dest='paired', default=None, type=str,  choices=["combined", "mates"], help="the input files are the R1 and R2 files of paired-end reads, given as consecutive pairs (e.g. s1_R1.fastq.gz s1_R2.fastq.gz s2_R1.fastq.gz s2_R2.fastq.gz). The files of a pair are read in lockstep in a single pass. combined : a single spectrum of both mates, named after R1 with suffix .paired (e.g. s1_R1.fastq.gz.paired.kmerdist.pickle). mates : a spectrum for each mate (default None - files are not paired)")
+    parser.add_argument('--trim_mate_overlap' , dest='trim_mate_overlap', action='store_true', help="(paired only) where the 3' ends of the mates overlap (by at least minimum_mate_overlap exactly matching bases), only count the part of R2 that does not overlap R1 (default False)")
+    parser.add_argument('--minimum_mate_overlap' , dest='minimum_mate_overlap', default=MINIMUM_MATE_OVERLAP, type=int, help="minimum overlap of mates for R2 to be trimmed (see trim_mate_overlap) (default %d)"%MINIMUM_MATE_OVERLAP)
+    parser.add_argument('--count_overlapping' , dest='count_overlapping', action='store_true', help="(packed engine or literal / IUPAC patterns only) count every instance of a kmer or pattern, including overlapping repeats (e.g. TTTTTT twice in TTTTTTT) (default False)")
     
     
     args = vars(parser.parse_args())
@@ -605,26 +2473,74 @@ kmer_prism.py -t entropy -k 6 -p 20  /data/project2/*.fastq.gz /references/ref1.
             parser.error("num_processes must be between 1 and %d"%PROC_POOL_SIZE)
 
         # should specify either a kmer_size, or a list of patterns (but not both)
+        if args["kmer_size"] is not None:
+            try:
+                args["kmer_size"] = get_kmer_sizes(args["kmer_size"])
+            except ValueError:
+                parser.error("could not parse kmer_size %(kmer_size)s"%args)
 
         if args["kmer_size"] is None and args["kmer_regexps"] is None:
             parser.error("should specify either kmer_size or a list of patterns")
         elif args["kmer_size"] is not None and args["kmer_regexps"] is not None:
             parser.error("should specify either kmer_size or a list of patterns but not both")
-            
+
+        if args["kmer_engine"] == "packed" and args["kmer_size"] is None:
+            parser.error("the packed kmer engine requires a kmer_size")
+
+        if args["spectrum_format"] == "sketch":
+            if args["kmer_size"] is None or max(get_kmer_size_list(args["kmer_size"])) > 31:
+                parser.error("sketches require a kmer_size of up to 31")
+            if args["assemble_low_entropy_kmers"]:
+                parser.error("can't assemble low entropy kmers from sketches")
+
+        if args["minimum_sample_size"] < 0:
+            parser.error("minimum_sample_size must not be negative")
+        if args["sampling_proportion"] is not None and not (0 < args["sampling_proportion"] <= 1):
+            parser.error("sampling_proportion must be between 0 and 1")
+
+        if args["distance_matrix_file"] is not None and args["summary_type"] not in ["ranks", "zipfian"]:
+            parser.error("distance_matrix_file requires a ranks or zipfian summary")
+
+        if args["canonical"] and args["reverse_complement"]:
+            parser.error("should specify either canonical or reverse_complement but not both")
+
+        if args["paired"] is not None:
+            if len(args["file_names"]) % 2 != 0:
+                parser.error("paired inputs should be given as consecutive pairs of R1 and R2 files")
+            if len([ file_name for file_name in args["file_names"] if (args["input_filetype"] or get_file_type(file_name)) == ".cnt" ]) > 0:
+                parser.error("tag count files can't be paired")
+            if args["spectrum_format"] == "sketch":
+                parser.error("paired inputs can't be sketched")
+            if args["assemble_low_entropy_kmers"]:
+                parser.error("can't assemble low entropy kmers from paired inputs")
+            if args["minimum_mate_overlap"] < 1:
+                parser.error("minimum_mate_overlap must be at least 1")
+        elif args["trim_mate_overlap"]:
+            parser.error("trim_mate_overlap requires paired inputs")
+        if not args["trim_mate_overlap"]:
+            args["minimum_mate_overlap"] = None
+
         # either input file or distribution file should exist 
         for file_name in args["file_names"]:
-            if not os.path.isfile(file_name) and not os.path.exists(get_save_filename(file_name, args["builddir"])):
-                parser.error("could not find either %s or %s"%(file_name,get_save_filename(file_name, args["builddir"])))
+            spectrum_name = file_name
+            if args["paired"] == "combined":
+                spectrum_name = get_pair_name(file_name)
+            if not os.path.isfile(file_name) and not os.path.exists(get_save_filename(spectrum_name, args["builddir"], spectrum_format=args["spectrum_format"])):
+                parser.error("could not find either %s or %s"%(file_name,get_save_filename(spectrum_name, args["builddir"], spectrum_format=args["spectrum_format"])))
             break
 
         # output file should not already exist
-        if os.path.exists(args["output_filename"]):
+        if isinstance(args["kmer_size"], list):
+            for kmer_size in args["kmer_size"]:
+                if os.path.exists(get_kmer_size_output_filename(args["output_filename"], kmer_size)):
+                    parser.error("error output file %s already exists"%get_kmer_size_output_filename(args["output_filename"], kmer_size))
+        elif os.path.exists(args["output_filename"]):
             parser.error("error output file %(output_filename)s already exists"%args)
 
 
         # parse kmer_regexps
         if args["kmer_regexps"] is not None:
-            args["kmer_regexps"] = re.split("\s*,\s*", args["kmer_regexps"])
+            args["kmer_regexps"] = get_kmer_patterns(args["kmer_regexps"])
         else:
             args["kmer_regexps"]= []
     
@@ -652,14 +2568,23 @@ def main():
 
     if options["summary_type"] != "assembly":
         distributions = build_kmer_spectra(options)
-        summarise_spectra(distributions, options)   
+        if isinstance(options["kmer_size"], list):
+            # one summary per kmer size
+            for (kmer_size_index, kmer_size) in enumerate(options["kmer_size"]):
+                kmer_size_options = dict(options)
+                kmer_size_options["output_filename"] = get_kmer_size_output_filename(options["output_filename"], kmer_size)
+                if options["summary_state"] is not None:
+                    kmer_size_options["summary_state"] = get_kmer_size_output_filename(options["summary_state"], kmer_size)
+                summarise_spectra([ distribution[kmer_size_index] for distribution in distributions ], kmer_size_options)
+        else:
+            summarise_spectra(distributions, options)   
     else:
         # get the kmer list
         with open(options["kmer_listfile"], "r") as kmer_stream:
             kmer_list = [ item.strip() for item in kmer_stream if len(item.strip()) > 0 ]
 
         assemble_kmer_spectrum(kmer_list, options["file_names"][0], options["input_filetype"], options["sampling_proportion"], \
-                               options["input_driver_config"],options["sequence_countfile"])
+                               options["input_driver_config"],options["sequence_countfile"], num_processes=options["num_processes"], assembly_report=options["assembly_report"])
 
     return 
 
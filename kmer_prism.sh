@@ -148,6 +148,8 @@ function configure_env() {
    cp ./kmer_prism.sh $OUT_DIR
    cp ./kmer_prism.mk $OUT_DIR
    cp ./kmer_prism.py $OUT_DIR
+   cp ./kmer_spectrum.py $OUT_DIR
+   cp ./prism_instrument.py $OUT_DIR
    cp ./data_prism.py $OUT_DIR
    cp ./kmer_plots.r $OUT_DIR
    if [ ! -f $OUT_DIR/tardis.toml ]; then
@@ -278,17 +280,18 @@ function run_prism() {
    make -f kmer_prism.mk -d -k  --no-builtin-rules -j $NUM_THREADS `cat $OUT_DIR/kmer_targets.txt` > $OUT_DIR/kmer_prism.log 2>&1
    # this uses the pickled distributions to make the final spectra
    # (note that the -k 6 arg here is not actually used , as the distributions have already been done by the make step)
+   # (each summary keeps its own summary state file, so that re-running with more files only loads the new distributions)
    rm -f $OUT_DIR/kmer_summary_plus.${parameters_moniker}.txt
-   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -t zipfian -o $OUT_DIR/kmer_summary_plus.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
+   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -t zipfian --summary_state $OUT_DIR/kmer_summary_state_plus.npz -o $OUT_DIR/kmer_summary_plus.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
 
    rm -f $OUT_DIR/kmer_frequency_plus.${parameters_moniker}.txt
-   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -t frequency -o $OUT_DIR/kmer_frequency_plus.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
+   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -t frequency --summary_state $OUT_DIR/kmer_frequency_state_plus.npz -o $OUT_DIR/kmer_frequency_plus.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
    
    rm -f $OUT_DIR/kmer_summary.${parameters_moniker}.txt
-   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -a CGAT -t zipfian -o $OUT_DIR/kmer_summary.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
+   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -a CGAT -t zipfian --summary_state $OUT_DIR/kmer_summary_state.npz -o $OUT_DIR/kmer_summary.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
 
    rm -f  $OUT_DIR/kmer_frequency.${parameters_moniker}.txt
-   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -a CGAT -t frequency -o $OUT_DIR/kmer_frequency.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
+   tardis.py --hpctype $HPC_TYPE -d $OUT_DIR --shell-include-file configure_biopython_env.src kmer_prism.py -k 6 -a CGAT -t frequency --summary_state $OUT_DIR/kmer_frequency_state.npz -o $OUT_DIR/kmer_frequency.${parameters_moniker}.txt -b $OUT_DIR $SUMMARY_TARGETS >> $OUT_DIR/kmer_prism.log 2>&1
 
    # first do plots including N's , then rename and do plots excluding N's 
    for version in "" "_plus" ; do
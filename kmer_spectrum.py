@@ -0,0 +1,922 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import struct
+import numbers
+import argparse
+import numpy
+if sys.version_info <= (2, 8):
+   from exceptions import Exception
+
+
+class kmer_spectrum_exception(Exception):
+    def __init__(self,args=None):
+        super(kmer_spectrum_exception, self).__init__(args)
+
+
+#********************************************************************
+# compact binary kmer spectrum format. A spectrum file consists of a
+# fixed size header, followed by (8-byte aligned) arrays, which are
+# read using numpy memmap, so that spectra can be summarised without
+# copying or unpickling them :
+#
+# header  - magic, version, kmer size (-1 if kmers are not all the same size),
+#           layout (dense or sparse), value type (int64 or float64),
+#           sampling proportion (nan if not sampled), total count,
+#           number of codes, number of other kmers, width of other kmers
+# codes   - (sparse layout only) sorted 2-bit codes of ACGT kmers (uint64)
+# values  - counts of ACGT kmers - for the dense layout there are 4**k of these,
+#           indexed by kmer code, for the sparse layout one per code
+# other kmers - sorted kmers which can't be coded (e.g. containing N, or of
+#           varying size), as fixed width (null-padded) byte strings
+# other values - counts of the other kmers
+#********************************************************************
+
+SPECTRUM_MAGIC = b"KMERSPEC"
+SPECTRUM_VERSION = 1
+SPECTRUM_HEADER_FORMAT = "<8sIiIIddQQI"
+SPECTRUM_HEADER_SIZE = 128
+SPECTRUM_SUFFIX = ".kmerdist.spectrum"
+
+DENSE_LAYOUT = 0
+SPARSE_LAYOUT = 1
+VALUE_TYPES = [numpy.int64, numpy.float64]
+
+
+def is_spectrum_file(filename):
+    return filename.endswith(SPECTRUM_SUFFIX)
+
+def get_aligned_size(size):
+    return 8 * ((size + 7) // 8)
+
+def to_kmer_string(kmer):
+    if sys.version_info >= (3,0) and isinstance(kmer, bytes):
+        return kmer.decode("ascii")
+    return kmer
+
+def to_kmer_bytes(kmer):
+    if isinstance(kmer, bytes):
+        return kmer
+    return kmer.encode("ascii")
+
+def encode_kmers(kmers, kmer_size):
+    """
+    returns (codes, is_coded) arrays for a list of kmers - is_coded is False for kmers
+    which are not kmer_size upper case ACGT
+    """
+    kmer_count = len(kmers)
+    codes = numpy.zeros(kmer_count, dtype=numpy.int64)
+    is_coded = numpy.zeros(kmer_count, dtype=bool)
+    if kmer_count == 0 or kmer_size < 1:
+        return (codes, is_coded)
+    base_codes = numpy.full(256, 4, dtype=numpy.int64)
+    for (code, base) in enumerate(b"ACGT"):
+        base_codes[base if isinstance(base, int) else ord(base)] = code
+    is_coded = numpy.array([ len(kmer) == kmer_size for kmer in kmers ], dtype=bool)
+    padded = b"".join( to_kmer_bytes(kmer) if len(kmer) == kmer_size else kmer_size * b"N" for kmer in kmers )
+    encoded = base_codes[numpy.frombuffer(padded, dtype=numpy.uint8)].reshape(kmer_count, kmer_size)
+    is_coded &= (encoded < 4).all(axis=1)
+    for offset in range(kmer_size):
+        codes <<= 2
+        codes |= encoded[:, offset] & 3
+    return (codes, is_coded)
+
+def decode_kmers(codes, kmer_size):
+    """
+    returns a list of the kmers corresponding to an array of 2-bit kmer codes
+    """
+    bases = numpy.frombuffer(b"ACGT", dtype=numpy.uint8)
+    shifts = numpy.arange(2 * (kmer_size - 1), -1, -2, dtype=numpy.int64)
+    letters = bases[(numpy.asarray(codes, dtype=numpy.int64)[:, None] >> shifts) & 3]
+    return [ to_kmer_string(kmer) for kmer in numpy.ascontiguousarray(letters).view("S%d"%kmer_size).ravel() ]
+
+def get_approximate_zeros(counts):
+    """
+    returns the count used in place of zero for each sample (row) of a samples x kmers count matrix - as in a prism
+    projection, half the smallest count of the kmers present in the sample (or half a count, if none are)
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    if counts.shape[1] == 0:
+        return numpy.full(counts.shape[0], 0.5)
+    smallest_counts = numpy.where(counts > 0, counts, numpy.inf).min(axis=1)
+    return numpy.where(numpy.isfinite(smallest_counts), smallest_counts, 1.0) / 2.0
+
+def get_unsigned_information(counts, totals):
+    """
+    returns the unsigned (self) information -log2(count/total) of each cell of a samples x kmers count matrix, given
+    the total count of each sample. Absent kmers (count 0) are given the information of the approximate zero of 
+    their sample, as they are by prism
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    totals = numpy.maximum(numpy.asarray(totals, dtype=numpy.float64), 1.0)
+    return -numpy.log2(numpy.where(counts > 0, counts, get_approximate_zeros(counts)[:, None]) / totals[:, None])
+
+
+class kmer_spectrum(object):
+    """
+    a kmer spectrum, held as arrays (which may be memory mapped from a spectrum file)
+    """
+    def __init__(self, kmer_size, layout, sampling_proportion, total, codes, values, other_kmers, other_values):
+        super(kmer_spectrum, self).__init__()
+        self.kmer_size = kmer_size
+        self.layout = layout
+        self.sampling_proportion = sampling_proportion
+        self.total = total
+        self.codes = codes
+        self.values = values
+        self.other_kmers = other_kmers
+        self.other_values = other_values
+
+    @staticmethod
+    def from_kmer_counts(kmer_counts, sampling_proportion = None):
+        """
+        returns a spectrum from a dictionary of kmer counts (keys may be kmers, or intervals like ('CGCCGC',) as in a
+        prism spectrum)
+        """
+        items = [ (kmer[0] if isinstance(kmer, tuple) else kmer, count) for (kmer, count) in kmer_counts.items() ]
+        kmer_sizes = set( len(kmer) for (kmer, count) in items )
+        kmer_size = kmer_sizes.pop() if len(kmer_sizes) == 1 else -1
+        value_type = numpy.int64
+        if len([ count for (kmer, count) in items if not isinstance(count, numbers.Integral) ]) > 0:
+            value_type = numpy.float64
+
+        kmers = [ kmer for (kmer, count) in items ]
+        counts = numpy.array([ count for (kmer, count) in items ], dtype=value_type)
+        (kmer_codes, is_coded) = encode_kmers(kmers, kmer_size)
+
+        # ACGT kmers are stored densely if at least half of the possible kmers are present
+        coded_count = int(is_coded.sum())
+        if kmer_size > 0 and 2 * coded_count >= 4**kmer_size:
+            layout = DENSE_LAYOUT
+            codes = numpy.zeros(0, dtype=numpy.uint64)
+            values = numpy.zeros(4**kmer_size, dtype=value_type)
+            values[kmer_codes[is_coded]] = counts[is_coded]
+        else:
+            layout = SPARSE_LAYOUT
+            order = numpy.argsort(kmer_codes[is_coded], kind="mergesort")
+            codes = kmer_codes[is_coded][order].astype(numpy.uint64)
+            values = counts[is_coded][order]
+
+        other = [ (to_kmer_bytes(kmer), count) for (kmer, count, coded) in zip(kmers, counts.tolist(), is_coded.tolist()) if not coded ]
+        other.sort()
+        other_width = max([1] + [ len(kmer) for (kmer, count) in other ])
+        other_kmers = numpy.array([ kmer for (kmer, count) in other ], dtype="S%d"%other_width)
+        other_values = numpy.array([ count for (kmer, count) in other ], dtype=value_type)
+
+        total = float(counts.sum()) if len(counts) > 0 else 0.0
+        return kmer_spectrum(kmer_size, layout, sampling_proportion, total, codes, values, other_kmers, other_values)
+
+    def save(self, filename):
+        value_type = VALUE_TYPES.index(self.values.dtype.type)
+        sampling_proportion = float("nan") if self.sampling_proportion is None else self.sampling_proportion
+        header = struct.pack(SPECTRUM_HEADER_FORMAT, SPECTRUM_MAGIC, SPECTRUM_VERSION, self.kmer_size, self.layout, value_type, \
+                             sampling_proportion, self.total, len(self.values), len(self.other_kmers), self.other_kmers.dtype.itemsize)
+        with open(filename, "wb") as spectrum_file:
+            spectrum_file.write(header + (SPECTRUM_HEADER_SIZE - len(header)) * b"\0")
+            for array in (self.codes, self.values, self.other_kmers, self.other_values):
+                data = numpy.ascontiguousarray(array).tobytes()
+                spectrum_file.write(data + (get_aligned_size(len(data)) - len(data)) * b"\0")
+
+    @staticmethod
+    def load(filename):
+        """
+        loads a spectrum file - the arrays are memory mapped rather than read
+        """
+        with open(filename, "rb") as spectrum_file:
+            header = spectrum_file.read(SPECTRUM_HEADER_SIZE)
+        (magic, version, kmer_size, layout, value_type, sampling_proportion, total, value_count, other_count, other_width) = \
+            struct.unpack(SPECTRUM_HEADER_FORMAT, header[0:struct.calcsize(SPECTRUM_HEADER_FORMAT)])
+        if magic != SPECTRUM_MAGIC or version != SPECTRUM_VERSION:
+            raise kmer_spectrum_exception("error - %s is not a (version %d) kmer spectrum file"%(filename, SPECTRUM_VERSION))
+        if sampling_proportion != sampling_proportion:   # nan
+            sampling_proportion = None
+        value_type = VALUE_TYPES[value_type]
+
+        offset = SPECTRUM_HEADER_SIZE
+        arrays = []
+        for (dtype, count) in ((numpy.uint64, value_count if layout == SPARSE_LAYOUT else 0), (value_type, value_count), \
+                               (numpy.dtype("S%d"%other_width), other_count), (value_type, other_count)):
+            if count == 0:
+                arrays.append(numpy.zeros(0, dtype=dtype))
+            else:
+                arrays.append(numpy.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(count,)))
+            offset += get_aligned_size(count * numpy.dtype(dtype).itemsize)
+        return kmer_spectrum(kmer_size, layout, sampling_proportion, total, *arrays)
+
+    def get_kmer_count(self):
+        if self.layout == DENSE_LAYOUT:
+            return int(numpy.count_nonzero(self.values)) + len(self.other_kmers)
+        return len(self.values) + len(self.other_kmers)
+
+    def get_kmers(self):
+        """
+        returns a list of the kmers in the spectrum (with non-zero counts)
+        """
+        if self.layout == DENSE_LAYOUT:
+            codes = numpy.nonzero(self.values)[0]
+        else:
+            codes = self.codes
+        kmers = []
+        if len(codes) > 0:
+            kmers = decode_kmers(codes, self.kmer_size)
+        return kmers + [ to_kmer_string(kmer) for kmer in self.other_kmers ]
+
+    def get_counts(self, kmers):
+        """
+        returns an array of the counts of a list of kmers (0 for kmers not in the spectrum)
+        """
+        counts = numpy.zeros(len(kmers), dtype=self.values.dtype)
+        (codes, is_coded) = encode_kmers(kmers, self.kmer_size)
+        coded_index = numpy.nonzero(is_coded)[0]
+        if len(coded_index) > 0:
+            if self.layout == DENSE_LAYOUT:
+                counts[coded_index] = self.values[codes[coded_index]]
+            elif len(self.codes) > 0:
+                query_codes = codes[coded_index].astype(numpy.uint64)
+                positions = numpy.searchsorted(self.codes, query_codes)
+                positions = numpy.minimum(positions, len(self.codes) - 1)
+                found = self.codes[positions] == query_codes
+                counts[coded_index[found]] = self.values[positions[found]]
+        other_index = numpy.nonzero(~is_coded)[0]
+        if len(other_index) > 0 and len(self.other_kmers) > 0:
+            query_kmers = [ to_kmer_bytes(kmers[index]) for index in other_index ]
+            # (the query array is as wide as the longest query, so that longer kmers are not truncated to match stored ones)
+            query_kmers = numpy.array(query_kmers, dtype="S%d"%max(self.other_kmers.dtype.itemsize, max( len(kmer) for kmer in query_kmers )))
+            positions = numpy.minimum(numpy.searchsorted(self.other_kmers, query_kmers), len(self.other_kmers) - 1)
+            found = self.other_kmers[positions] == query_kmers
+            counts[other_index[found]] = self.other_values[positions[found]]
+        return counts
+
+    def get_kmer_counts(self):
+        """
+        returns a dictionary of the kmer counts in the spectrum (a copy)
+        """
+        kmers = self.get_kmers()
+        return dict(zip(kmers, self.get_counts(kmers).tolist()))
+
+    def summary(self):
+        print("kmer spectrum - kmer size %s, %.15g points distributed over %d kmers (%s layout), sampling proportion %s"%(self.kmer_size if self.kmer_size > 0 else "(various)", \
+              self.total, self.get_kmer_count(), ["dense","sparse"][self.layout], self.sampling_proportion))
+
+
+#********************************************************************
+# kmer sketches - approximate spectra in fixed memory, for large kmer sizes
+# (up to 31, so that a kmer code fits in 64 bits). A sketch consists of :
+#
+# - a count-min sketch (depth rows of 2**width_bits counters, each row indexed
+#   by a different hash of the kmer code), which gives an upper bound estimate
+#   of the count of any kmer
+# - a HyperLogLog (2**hll_bits registers) estimating the number of distinct kmers
+# - a heavy hitter list - the (up to) heavy_hitter_count kmers with the highest
+#   estimated counts seen so far
+#
+# Only kmers of ACGT are sketched - the counts of other kmers (e.g. containing N)
+# are included in the total. Sketches of parts of a file can be merged. The file
+# format is a fixed size header followed by (8-byte aligned) arrays, as for
+# spectrum files :
+#
+# header  - magic, version, kmer size, depth, width bits, hll bits, heavy hitter
+#           count (limit), value type (int64 or float64), sampling proportion (nan if 
+#           not sampled), total count, number of heavy hitters
+# table   - depth x 2**width_bits counts (float64)
+# registers - 2**hll_bits HyperLogLog registers (uint8)
+# heavy codes - codes of the heavy hitters (uint64)
+# heavy counts - estimated counts of the heavy hitters (float64)
+#********************************************************************
+
+SKETCH_MAGIC = b"KMERSKCH"
+SKETCH_VERSION = 1
+SKETCH_HEADER_FORMAT = "<8sIiIIIIIddQ"
+SKETCH_SUFFIX = ".kmerdist.sketch"
+SKETCH_MAX_KMER_SIZE = 31
+SKETCH_DEPTH = 4
+SKETCH_HLL_BITS = 14
+
+def is_sketch_file(filename):
+    return filename.endswith(SKETCH_SUFFIX)
+
+def get_kmer_hashes(codes, seed):
+    """
+    returns 64 bit hashes of an array of kmer codes (the splitmix64 finaliser, applied to the code plus a seeded offset)
+    """
+    with numpy.errstate(over="ignore"):
+        hashes = numpy.asarray(codes).astype(numpy.uint64) + numpy.uint64((0x9E3779B97F4A7C15 * (seed + 1)) % 2**64)
+        hashes = (hashes ^ (hashes >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        hashes = (hashes ^ (hashes >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        return hashes ^ (hashes >> numpy.uint64(31))
+
+def get_bit_lengths(values):
+    """
+    returns the bit lengths of an array of uint64 values (computed from 32 bit halves, which floats represent exactly)
+    """
+    high = (values >> numpy.uint64(32)).astype(numpy.float64)
+    low = (values & numpy.uint64(0xFFFFFFFF)).astype(numpy.float64)
+    return numpy.where(high > 0, 32 + numpy.frexp(high)[1], numpy.frexp(low)[1])
+
+class kmer_sketch(object):
+    """
+    an approximate kmer spectrum in fixed memory (see above)
+    """
+    def __init__(self, kmer_size, depth, width_bits, hll_bits, heavy_hitter_count, value_type = numpy.int64, sampling_proportion = None, \
+                 total = 0.0, table = None, registers = None, heavy_codes = None, heavy_counts = None):
+        super(kmer_sketch, self).__init__()
+        if kmer_size < 1 or kmer_size > SKETCH_MAX_KMER_SIZE:
+            raise kmer_spectrum_exception("error - kmer size for sketches must be between 1 and %d"%SKETCH_MAX_KMER_SIZE)
+        self.kmer_size = kmer_size
+        self.depth = depth
+        self.width_bits = width_bits
+        self.hll_bits = hll_bits
+        self.heavy_hitter_count = heavy_hitter_count
+        self.value_type = value_type
+        self.sampling_proportion = sampling_proportion
+        self.total = total
+        self.table = table if table is not None else numpy.zeros((depth, 2**width_bits), dtype=numpy.float64)
+        self.registers = registers if registers is not None else numpy.zeros(2**hll_bits, dtype=numpy.uint8)
+        self.heavy_codes = heavy_codes if heavy_codes is not None else numpy.zeros(0, dtype=numpy.uint64)
+        self.heavy_counts = heavy_counts if heavy_counts is not None else numpy.zeros(0, dtype=numpy.float64)
+
+    @staticmethod
+    def from_memory(kmer_size, memory_mb, heavy_hitter_count, sampling_proportion = None):
+        """
+        returns an empty sketch whose count-min table is as wide as will fit in memory_mb 
+        """
+        width_bits = 10
+        while SKETCH_DEPTH * 8 * 2**(width_bits + 1) <= memory_mb * 1024**2:
+            width_bits += 1
+        return kmer_sketch(kmer_size, SKETCH_DEPTH, width_bits, SKETCH_HLL_BITS, heavy_hitter_count, sampling_proportion = sampling_proportion)
+
+    def get_indexes(self, codes, row):
+        return (get_kmer_hashes(codes, row) >> numpy.uint64(64 - self.width_bits)).astype(numpy.int64)
+
+    def get_code_estimates(self, codes):
+        """
+        returns the count-min estimates of the counts of an array of kmer codes 
+        """
+        estimates = numpy.full(len(codes), numpy.inf)
+        for row in range(self.depth):
+            estimates = numpy.minimum(estimates, self.table[row][self.get_indexes(codes, row)])
+        return estimates
+
+    def update_heavy_hitters(self, codes):
+        """
+        re-estimates the current heavy hitters together with the (unique) codes given, and keeps the highest
+        """
+        candidates = numpy.union1d(self.heavy_codes, numpy.asarray(codes).astype(numpy.uint64))
+        estimates = self.get_code_estimates(candidates)
+        if len(candidates) > self.heavy_hitter_count:
+            keep = numpy.argpartition(-estimates, self.heavy_hitter_count - 1)[0:self.heavy_hitter_count]
+            (candidates, estimates) = (candidates[keep], estimates[keep])
+        order = numpy.lexsort((candidates, -estimates))
+        (self.heavy_codes, self.heavy_counts) = (candidates[order], estimates[order])
+
+    def add_codes(self, codes, weights = None):
+        """
+        adds an array of kmer codes (with optional weights) to the sketch
+        """
+        if len(codes) == 0:
+            return
+        (unique_codes, inverse) = numpy.unique(codes, return_inverse=True)
+        code_counts = numpy.bincount(inverse, weights=weights, minlength=len(unique_codes)).astype(numpy.float64)
+        if weights is not None and numpy.asarray(weights).dtype.kind not in "iub":
+            self.value_type = numpy.float64
+        self.total += float(code_counts.sum())
+
+        # count-min table - indexes may collide within a row, so the counts for each distinct index are summed first
+        for row in range(self.depth):
+            (row_indexes, row_inverse) = numpy.unique(self.get_indexes(unique_codes, row), return_inverse=True)
+            self.table[row][row_indexes] += numpy.bincount(row_inverse, weights=code_counts, minlength=len(row_indexes))
+
+        # HyperLogLog - the register is given by the top hll_bits of the hash, and its value is the position of the first set bit in the rest
+        hashes = get_kmer_hashes(unique_codes, self.depth)
+        register_indexes = (hashes >> numpy.uint64(64 - self.hll_bits)).astype(numpy.int64)
+        remainders = (hashes << numpy.uint64(self.hll_bits)) >> numpy.uint64(self.hll_bits)
+        ranks = (64 - self.hll_bits + 1 - get_bit_lengths(remainders)).astype(numpy.uint8)
+        order = numpy.lexsort((ranks, register_indexes))
+        last = numpy.append(register_indexes[order][1:] != register_indexes[order][:-1], True)   # the highest rank for each register
+        (register_indexes, ranks) = (register_indexes[order][last], ranks[order][last])
+        self.registers[register_indexes] = numpy.maximum(self.registers[register_indexes], ranks)
+
+        self.update_heavy_hitters(unique_codes)
+
+    def add_total(self, count):
+        """
+        adds the count of kmers which are not sketched (e.g. containing N) to the total 
+        """
+        self.total += count
+
+    def merge(self, sketch):
+        """
+        merges another sketch (with the same dimensions) into this one 
+        """
+        if (sketch.kmer_size, sketch.depth, sketch.width_bits, sketch.hll_bits) != (self.kmer_size, self.depth, self.width_bits, self.hll_bits):
+            raise kmer_spectrum_exception("error - can't merge sketches of different kmer size or dimensions")
+        self.table += sketch.table
+        self.registers = numpy.maximum(self.registers, sketch.registers)
+        self.total += sketch.total
+        if sketch.value_type == numpy.float64:
+            self.value_type = numpy.float64
+        self.update_heavy_hitters(sketch.heavy_codes)
+
+    def get_cardinality(self):
+        """
+        returns the HyperLogLog estimate of the number of distinct (ACGT) kmers 
+        """
+        register_count = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / register_count)
+        estimate = alpha * register_count**2 / numpy.sum(2.0 ** -self.registers.astype(numpy.float64))
+        zero_count = int(numpy.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * register_count and zero_count > 0:
+            estimate = register_count * numpy.log(register_count / zero_count)   # linear counting for small cardinalities
+        return estimate
+
+    def get_kmer_count(self):
+        return len(self.heavy_codes)
+
+    def get_kmers(self):
+        """
+        returns a list of the heavy hitter kmers (in descending order of estimated count)
+        """
+        if len(self.heavy_codes) == 0:
+            return []
+        return decode_kmers(self.heavy_codes.astype(numpy.int64), self.kmer_size)
+
+    def get_counts(self, kmers):
+        """
+        returns an array of the estimated counts of a list of kmers (0 for kmers which are not ACGT of the sketch kmer size)
+        """
+        counts = numpy.zeros(len(kmers), dtype=numpy.float64)
+        (codes, is_coded) = encode_kmers(kmers, self.kmer_size)
+        if is_coded.any():
+            counts[is_coded] = self.get_code_estimates(codes[is_coded])
+        if self.value_type == numpy.int64:
+            return numpy.rint(counts).astype(numpy.int64)
+        return counts
+
+    def get_kmer_counts(self):
+        """
+        returns a dictionary of the estimated counts of the heavy hitters
+        """
+        kmers = self.get_kmers()
+        return dict(zip(kmers, self.get_counts(kmers).tolist()))
+
+    def save(self, filename):
+        sampling_proportion = float("nan") if self.sampling_proportion is None else self.sampling_proportion
+        header = struct.pack(SKETCH_HEADER_FORMAT, SKETCH_MAGIC, SKETCH_VERSION, self.kmer_size, self.depth, self.width_bits, self.hll_bits, \
+                             self.heavy_hitter_count, VALUE_TYPES.index(self.value_type), sampling_proportion, self.total, len(self.heavy_codes))
+        with open(filename, "wb") as sketch_file:
+            sketch_file.write(header + (SPECTRUM_HEADER_SIZE - len(header)) * b"\0")
+            for (array, dtype) in ((self.table, numpy.float64), (self.registers, numpy.uint8), (self.heavy_codes, numpy.uint64), (self.heavy_counts, numpy.float64)):
+                data = numpy.ascontiguousarray(array, dtype=dtype).tobytes()
+                sketch_file.write(data + (get_aligned_size(len(data)) - len(data)) * b"\0")
+
+    @staticmethod
+    def load(filename):
+        """
+        loads a sketch file - the count-min table is memory mapped rather than read
+        """
+        with open(filename, "rb") as sketch_file:
+            header = sketch_file.read(SPECTRUM_HEADER_SIZE)
+        (magic, version, kmer_size, depth, width_bits, hll_bits, heavy_hitter_count, value_type, sampling_proportion, total, heavy_count) = \
+            struct.unpack(SKETCH_HEADER_FORMAT, header[0:struct.calcsize(SKETCH_HEADER_FORMAT)])
+        if magic != SKETCH_MAGIC or version != SKETCH_VERSION:
+            raise kmer_spectrum_exception("error - %s is not a (version %d) kmer sketch file"%(filename, SKETCH_VERSION))
+        if sampling_proportion != sampling_proportion:   # nan
+            sampling_proportion = None
+
+        offset = SPECTRUM_HEADER_SIZE
+        arrays = []
+        for (dtype, shape) in ((numpy.float64, (depth, 2**width_bits)), (numpy.uint8, (2**hll_bits,)), (numpy.uint64, (heavy_count,)), (numpy.float64, (heavy_count,))):
+            size = int(numpy.prod(shape))
+            if size == 0:
+                arrays.append(numpy.zeros(shape, dtype=dtype))
+            elif dtype == numpy.float64 and len(shape) == 2:
+                arrays.append(numpy.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape))
+            else:
+                arrays.append(numpy.array(numpy.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)))
+            offset += get_aligned_size(size * numpy.dtype(dtype).itemsize)
+        return kmer_sketch(kmer_size, depth, width_bits, hll_bits, heavy_hitter_count, VALUE_TYPES[value_type], sampling_proportion, total, *arrays)
+
+    def summary(self):
+        print("kmer sketch - kmer size %d, %.15g points, approximately %d distinct kmers, %d heavy hitters, %d x %d count-min table, sampling proportion %s"%(self.kmer_size, \
+              self.total, self.get_cardinality(), len(self.heavy_codes), self.depth, 2**self.width_bits, self.sampling_proportion))
+
+
+def load_pickled_spectrum(picklefile, sampling_proportion = None):
+    """
+    loads a .kmerdist.pickle file as a spectrum
+    """
+    from data_prism import prism
+    import kmer_prism
+
+    # pickled prisms refer to the kmer_prism.py provider functions as members of __main__ (as that is
+    # how kmer_prism.py is run), so make these available to the unpickler
+    main_module = sys.modules["__main__"]
+    for (name, value) in vars(kmer_prism).items():
+        if callable(value) and not hasattr(main_module, name):
+            setattr(main_module, name, value)
+
+    return kmer_spectrum.from_kmer_counts(prism.load(picklefile).spectrum, sampling_proportion)
+
+
+def load_any_spectrum(filename):
+    if is_spectrum_file(filename):
+        return kmer_spectrum.load(filename)
+    elif is_sketch_file(filename):
+        return kmer_sketch.load(filename)
+    return load_pickled_spectrum(filename)
+
+
+def get_alphabet_mask(kmers, alphabet):
+    """
+    returns a boolean array indicating which of a list of kmers consist only of letters from
+    the alphabet (case insensitive)
+    """
+    if len(kmers) == 0:
+        return numpy.zeros(0, dtype=bool)
+    allowed = numpy.zeros(256, dtype=bool)
+    for letter in to_kmer_bytes(alphabet.upper() + alphabet.lower()):
+        allowed[letter if isinstance(letter, int) else ord(letter)] = True
+    allowed[0] = True    # padding of shorter kmers
+    kmer_array = numpy.array([ to_kmer_bytes(kmer) for kmer in kmers ])
+    letters = kmer_array.view(numpy.uint8).reshape(len(kmers), kmer_array.dtype.itemsize)
+    return allowed[letters].all(axis=1) & (numpy.array([ len(kmer) for kmer in kmers ]) > 0)
+
+
+def get_spectrum_matrix(filenames, alphabet = None):
+    """
+    loads a list of spectra (binary spectrum files, sketches or pickles) into a samples x kmers matrix
+    of counts, and returns (kmers, counts, totals) - kmers is the sorted union of the kmers in the
+    spectra (optionally restricted to those from an alphabet), totals the total count of each spectrum.
+    For sketches, the kmers are the heavy hitters, and counts are estimated 
+    """
+    spectra = [ load_any_spectrum(filename) for filename in filenames ]
+    kmers = set()
+    for (filename, spectrum) in zip(filenames, spectra):
+        kmers.update(spectrum.get_kmers())
+        if isinstance(spectrum, kmer_sketch):
+            print("(%s : approximately %d distinct kmers, %d heavy hitters)"%(filename, spectrum.get_cardinality(), spectrum.get_kmer_count()))
+    kmers = sorted(kmers)
+    if alphabet is not None:
+        mask = get_alphabet_mask(kmers, alphabet)
+        print("(restricting kmers to those from alphabet %s , deleted %d / %d kmers)"%(alphabet, len(kmers) - int(mask.sum()), len(kmers)))
+        kmers = [ kmer for (kmer, keep) in zip(kmers, mask.tolist()) if keep ]
+
+    value_type = numpy.int64
+    if len([ spectrum for spectrum in spectra if spectrum.get_counts([]).dtype == numpy.float64 ]) > 0:
+        value_type = numpy.float64
+    counts = numpy.zeros((len(spectra), len(kmers)), dtype=value_type)
+    for (sample_index, spectrum) in enumerate(spectra):
+        counts[sample_index] = spectrum.get_counts(kmers)
+    totals = numpy.array([ spectrum.total for spectrum in spectra ], dtype=numpy.float64)
+    return (kmers, counts, totals)
+
+
+def get_measure_matrix(counts, totals, measure):
+    """
+    returns the measure ("raw" or "unsigned_information") of each cell of a samples x kmers count matrix
+    """
+    if measure == "raw":
+        return counts
+    return get_unsigned_information(counts, totals)
+
+
+def get_rank_matrix(measures):
+    """
+    returns the ranks of the kmers within each sample of a samples x kmers measure matrix, as prism.get_rank_iter ranks 
+    them : the kmers of a sample are ranked 1, 2, 3 ... in increasing order of measure, with tied kmers ranked in kmer 
+    (column) order
+    """
+    order = numpy.argsort(measures, axis=1, kind="mergesort")
+    ranks = numpy.zeros(measures.shape, dtype=numpy.int64)
+    ranks[numpy.arange(measures.shape[0])[:, None], order] = numpy.arange(1, measures.shape[1] + 1)
+    return ranks
+
+#********************************************************************
+# zipfian distances. The zipfian plot of a sample is the measure (e.g.
+# self-information) of each kmer against the log2 of its rank in the 
+# sample (as drawn by kmer_plots.r), and the zipfian distance between two 
+# samples is the area between their plots - the sum over ranks r of the 
+# absolute difference between the measures of the samples at rank r, 
+# times log2(r + 1) - log2(r). This reproduces the distance matrix of 
+# prism.get_zipfian_distance_matrix, but is calculated with numpy, a 
+# block of samples at a time (optionally by a pool of processes). The 
+# distances may also be written as a binary matrix file :
+#
+# header  - magic, version, number of samples
+# names   - for each sample, the length (uint32) and utf-8 bytes of its name
+# matrix  - number of samples x number of samples float64 distances, row major
+# (all integers and floats are little endian)
+#********************************************************************
+
+DISTANCE_MAGIC = b"ZIPFDIST"
+DISTANCE_VERSION = 1
+DISTANCE_HEADER_FORMAT = "<8sII"
+DISTANCE_BLOCK_ELEMENTS = 2**24     # maximum size of the intermediate (block x samples x kmers) difference array
+
+def get_zipf_curves(measures, ranks):
+    """
+    returns the samples x ranks matrix of zipf curves (the measure of the kmer at each rank of each sample), from
+    samples x kmers measures and ranks
+    """
+    order = numpy.argsort(ranks, axis=1, kind="mergesort")
+    return numpy.asarray(measures, dtype=numpy.float64)[numpy.arange(measures.shape[0])[:, None], order]
+
+def get_rank_widths(rank_count, first_rank = 1):
+    """
+    returns the width of each rank from first_rank to rank_count on a log2 scale, i.e. log2(r + 1) - log2(r)
+    """
+    ranks = numpy.arange(first_rank, rank_count + 1, dtype=numpy.float64)
+    return numpy.log2(ranks + 1.0) - numpy.log2(ranks)
+
+
+distance_curves = None   # zipf curves (and rank widths) shared by the distance workers
+
+def set_distance_curves(curves):
+    global distance_curves
+    distance_curves = curves
+
+
+def get_zipfian_distance_block(block_range):
+    """
+    returns the zipfian distances between a block (range) of the shared zipf curves and all the curves
+    """
+    (curves, rank_widths) = distance_curves
+    (block_start, block_end) = block_range
+    block_curves = curves[block_start:block_end]
+    distances = numpy.zeros((len(block_curves), len(curves)), dtype=numpy.float64)
+    chunk_size = max(1, DISTANCE_BLOCK_ELEMENTS // max(1, len(block_curves) * curves.shape[1]))
+    for chunk_start in range(0, len(curves), chunk_size):
+        chunk = curves[chunk_start:chunk_start + chunk_size]
+        distances[:, chunk_start:chunk_start + chunk_size] = numpy.abs(block_curves[:, None, :] - chunk[None, :, :]).dot(rank_widths)
+    return distances
+
+
+def get_zipfian_distance_matrix(measures, ranks, num_processes = 1, first_row = 0):
+    """
+    returns the samples x samples zipfian distance matrix, from samples x kmers measures and ranks. Rows are
+    calculated in blocks - if num_processes > 1 the blocks are distributed over a pool of processes. If first_row
+    is given, only the rows from there on (i.e. the distances of the later samples to all samples) are calculated
+    """
+    curves = get_zipf_curves(measures, ranks)
+    sample_count = len(curves)
+    if sample_count <= first_row:
+        return numpy.zeros((0, sample_count), dtype=numpy.float64)
+    block_size = max(1, min(sample_count, DISTANCE_BLOCK_ELEMENTS // max(1, sample_count * curves.shape[1])))
+    block_ranges = [ (block_start, min(sample_count, block_start + block_size)) for block_start in range(first_row, sample_count, block_size) ]
+    shared_curves = (curves, get_rank_widths(curves.shape[1]))
+    if num_processes > 1 and len(block_ranges) > 1:
+        from multiprocessing import Pool
+        pool = Pool(num_processes, initializer=set_distance_curves, initargs=(shared_curves,))
+        try:
+            blocks = pool.map(get_zipfian_distance_block, block_ranges)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        set_distance_curves(shared_curves)
+        blocks = [ get_zipfian_distance_block(block_range) for block_range in block_ranges ]
+        set_distance_curves(None)
+    return numpy.vstack(blocks)
+
+
+def save_distance_matrix(distance_matrix, sample_names, filename):
+    with open(filename, "wb") as distance_file:
+        distance_file.write(struct.pack(DISTANCE_HEADER_FORMAT, DISTANCE_MAGIC, DISTANCE_VERSION, len(sample_names)))
+        for sample_name in sample_names:
+            name_bytes = sample_name.encode("utf-8") if not isinstance(sample_name, bytes) else sample_name
+            distance_file.write(struct.pack("<I", len(name_bytes)) + name_bytes)
+        distance_file.write(numpy.ascontiguousarray(distance_matrix, dtype="<f8").tobytes())
+
+
+def load_distance_matrix(filename):
+    """
+    returns (distance_matrix, sample_names) from a binary distance matrix file
+    """
+    with open(filename, "rb") as distance_file:
+        (magic, version, sample_count) = struct.unpack(DISTANCE_HEADER_FORMAT, distance_file.read(struct.calcsize(DISTANCE_HEADER_FORMAT)))
+        if magic != DISTANCE_MAGIC or version != DISTANCE_VERSION:
+            raise kmer_spectrum_exception("error - %s is not a (version %d) distance matrix file"%(filename, DISTANCE_VERSION))
+        sample_names = []
+        for sample_index in range(sample_count):
+            (name_length,) = struct.unpack("<I", distance_file.read(4))
+            sample_names.append(distance_file.read(name_length).decode("utf-8"))
+        distance_matrix = numpy.frombuffer(distance_file.read(8 * sample_count * sample_count), dtype="<f8").reshape(sample_count, sample_count)
+    return (distance_matrix, sample_names)
+
+
+#********************************************************************
+# summary state - the samples x kmers count matrix of a summary (and the
+# zipfian distances, if calculated) is kept in a numpy .npz file, so 
+# that when a summary is re-run with more spectra, only the new spectra 
+# are loaded and appended as rows (with any new kmers appended as columns,
+# which are zero for the existing samples). Measures and ranks are 
+# recalculated from the counts, which is cheap. The existing distances 
+# are updated rather than recalculated : a new kmer is absent from all 
+# of the existing samples, so it extends the zipf curve of each existing 
+# sample, at its highest ranks, by the information of an absent kmer
+# (that of its approximate zero, which the new kmers don't change), and
+# the distance between two existing samples by the difference of these
+# times the (log2) width of the added ranks. (Only distances between
+# self-information curves are kept - an absent kmer has the lowest raw
+# count, so adding kmers re-ranks a raw count curve from the start)
+# The state is rebuilt from scratch if a spectrum has changed or is no
+# longer summarised, if the alphabet changes, or for sketches (the 
+# estimated count of a new kmer in an existing sketch need not be zero)
+#********************************************************************
+
+def get_spectrum_identity(filename):
+    """
+    returns a string that changes if a spectrum file is rewritten
+    """
+    file_stat = os.stat(filename)
+    return "%d:%r"%(file_stat.st_size, file_stat.st_mtime)
+
+
+class summary_state(object):
+    def __init__(self, alphabet, filenames, identities, kmers, counts, totals, distance_filenames = None, distance_kmer_count = 0, distances = None):
+        super(summary_state, self).__init__()
+        self.alphabet = alphabet
+        self.filenames = filenames
+        self.identities = identities
+        self.kmers = kmers
+        self.counts = counts
+        self.totals = totals
+        self.distance_filenames = distance_filenames
+        self.distance_kmer_count = distance_kmer_count
+        self.distances = distances
+
+    @staticmethod
+    def from_spectra(filenames, alphabet = None):
+        (kmers, counts, totals) = get_spectrum_matrix(filenames, alphabet)
+        return summary_state(alphabet, list(filenames), [ get_spectrum_identity(filename) for filename in filenames ], kmers, counts, totals)
+
+    def get_stale_reason(self, filenames, alphabet):
+        """
+        returns why this state can't be updated to summarise the given spectra, or None if it can 
+        """
+        identities = dict(zip(self.filenames, self.identities))
+        if alphabet != self.alphabet:
+            return "the alphabet has changed"
+        elif len([ filename for filename in filenames if is_sketch_file(filename) ]) > 0:
+            return "sketches are always summarised from scratch"
+        elif len(set(self.filenames) - set(filenames)) > 0:
+            return "%d spectra are no longer summarised"%len(set(self.filenames) - set(filenames))
+        changed = [ filename for filename in filenames if filename in identities and get_spectrum_identity(filename) != identities[filename] ]
+        if len(changed) > 0:
+            return "%d spectra have changed"%len(changed)
+        return None
+
+    def update(self, filenames, alphabet = None):
+        """
+        returns a state summarising the given spectra (with rows in that order), appending any new spectra to this one, 
+        or rebuilding from scratch if that isn't possible 
+        """
+        stale_reason = self.get_stale_reason(filenames, alphabet)
+        if stale_reason is not None:
+            print("(rebuilding summary state as %s)"%stale_reason)
+            return summary_state.from_spectra(filenames, alphabet)
+
+        known_filenames = set(self.filenames)
+        new_filenames = [ filename for filename in filenames if filename not in known_filenames ]
+        print("(summary state has %d spectra, loading %d new spectra)"%(len(self.filenames), len(new_filenames)))
+        (kmers, counts, totals) = (self.kmers, self.counts, self.totals)
+        if len(new_filenames) > 0:
+            (new_kmers, new_counts, new_totals) = get_spectrum_matrix(new_filenames, alphabet)
+            kmers = sorted(set(self.kmers).union(new_kmers))
+            kmer_index = dict((kmer, index) for (index, kmer) in enumerate(kmers))
+            counts = numpy.zeros((len(self.filenames) + len(new_filenames), len(kmers)), dtype=numpy.result_type(self.counts, new_counts))
+            counts[:len(self.filenames), [ kmer_index[kmer] for kmer in self.kmers ]] = self.counts
+            counts[len(self.filenames):, [ kmer_index[kmer] for kmer in new_kmers ]] = new_counts
+            totals = numpy.concatenate((self.totals, new_totals))
+
+        # put the rows in the requested order
+        row_index = dict((filename, index) for (index, filename) in enumerate(self.filenames + new_filenames))
+        order = [ row_index[filename] for filename in filenames ]
+        return summary_state(alphabet, list(filenames), [ get_spectrum_identity(filename) for filename in filenames ], kmers, counts[order], totals[order], \
+                             self.distance_filenames, self.distance_kmer_count, self.distances)
+
+    def get_zipfian_distance_matrix(self, measures, ranks, num_processes = 1):
+        """
+        returns the zipfian distance matrix of the samples (from their unsigned information measures and ranks), 
+        updating the distances kept in the state if there are any, and keeps the result in the state
+        """
+        if self.distances is None or len(set(self.distance_filenames) - set(self.filenames)) > 0:
+            distances = get_zipfian_distance_matrix(measures, ranks, num_processes)
+        else:
+            row_index = dict((filename, index) for (index, filename) in enumerate(self.filenames))
+            old_rows = [ row_index[filename] for filename in self.distance_filenames ]
+            new_rows = sorted(set(range(len(self.filenames))) - set(old_rows))
+            order = old_rows + new_rows
+            old_count = len(old_rows)
+
+            # existing distances, extended by the kmers added since they were calculated, and the new rows 
+            absent_information = -numpy.log2(get_approximate_zeros(self.counts[old_rows]) / numpy.maximum(self.totals[old_rows], 1.0))
+            added_width = get_rank_widths(len(self.kmers), self.distance_kmer_count + 1).sum()
+            ordered_distances = numpy.zeros((len(order), len(order)), dtype=numpy.float64)
+            ordered_distances[:old_count, :old_count] = self.distances + added_width * numpy.abs(absent_information[:, None] - absent_information[None, :])
+            new_distances = get_zipfian_distance_matrix(measures[order], ranks[order], num_processes, first_row = old_count)
+            ordered_distances[old_count:, :] = new_distances
+            ordered_distances[:old_count, old_count:] = new_distances[:, :old_count].T
+            distances = numpy.zeros(ordered_distances.shape, dtype=numpy.float64)
+            distances[numpy.ix_(order, order)] = ordered_distances
+            print("(updated %d x %d summary state distances, calculated %d new rows)"%(old_count, old_count, len(new_rows)))
+
+        (self.distance_filenames, self.distance_kmer_count, self.distances) = (list(self.filenames), len(self.kmers), distances)
+        return distances
+
+    def save(self, filename):
+        arrays = { "filenames" : numpy.array(self.filenames), "identities" : numpy.array(self.identities), \
+                   "kmers" : numpy.array([ to_kmer_bytes(kmer) for kmer in self.kmers ], dtype=bytes), \
+                   "counts" : self.counts, "totals" : self.totals, \
+                   "alphabet" : numpy.array([] if self.alphabet is None else [self.alphabet]) }
+        if self.distances is not None:
+            arrays.update({ "distance_filenames" : numpy.array(self.distance_filenames), "distance_kmer_count" : numpy.array(self.distance_kmer_count), \
+                            "distances" : self.distances })
+        # write then rename, so that an interrupted save does not leave a corrupt state 
+        with open(filename + ".tmp", "wb") as state_file:
+            numpy.savez(state_file, **arrays)
+        os.rename(filename + ".tmp", filename)
+
+    @staticmethod
+    def get_strings(string_array):
+        """
+        returns a list of strings from an array saved by either python 2 (bytes) or 3 (unicode)
+        """
+        if sys.version_info >= (3,0):
+            return [ item.decode("utf-8") if isinstance(item, bytes) else item for item in string_array.tolist() ]
+        return [ item.encode("utf-8") if isinstance(item, unicode) else item for item in string_array.tolist() ]
+
+    @staticmethod
+    def load(filename):
+        with numpy.load(filename, allow_pickle = False) as arrays:
+            alphabet = None
+            if len(arrays["alphabet"]) > 0:
+                alphabet = summary_state.get_strings(arrays["alphabet"])[0]
+            state = summary_state(alphabet, summary_state.get_strings(arrays["filenames"]), summary_state.get_strings(arrays["identities"]), \
+                                  [ to_kmer_string(kmer) for kmer in arrays["kmers"].tolist() ], arrays["counts"], arrays["totals"])
+            if "distances" in arrays.files:
+                (state.distance_filenames, state.distance_kmer_count, state.distances) = (summary_state.get_strings(arrays["distance_filenames"]), \
+                                                                                          int(arrays["distance_kmer_count"]), arrays["distances"])
+        return state
+
+
+def get_summary_state(state_filename, filenames, alphabet = None):
+    """
+    returns the summary state of a list of spectra, updating (or creating) the state in state_filename 
+    """
+    if os.path.exists(state_filename):
+        state = summary_state.load(state_filename).update(filenames, alphabet)
+    else:
+        state = summary_state.from_spectra(filenames, alphabet)
+    return state
+
+
+def convert_pickle(picklefile, sampling_proportion = None):
+    """
+    converts a .kmerdist.pickle file to a spectrum file (alongside it), and returns the spectrum filename
+    """
+    spectrum_filename = re.sub("\\.kmerdist\\.pickle$", "", picklefile) + SPECTRUM_SUFFIX
+    load_pickled_spectrum(picklefile, sampling_proportion).save(spectrum_filename)
+    return spectrum_filename
+
+
+def get_options():
+    description = """
+    This script converts kmer spectra saved by kmer_prism.py as serialised python objects (.kmerdist.pickle) to the
+    compact binary spectrum format (.kmerdist.spectrum), or lists the contents of spectrum files
+    """
+    long_description = """
+examples :
+
+# convert all the pickled spectra in a build folder
+kmer_spectrum.py /dataset/project2/kmer_analysis/*.kmerdist.pickle
+
+# list the kmer counts in a spectrum file
+kmer_spectrum.py --list /dataset/project2/kmer_analysis/T867.fastq.gz.kmerdist.spectrum
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_names', type=str, nargs='+',metavar="filename", help='list of files to process')
+    parser.add_argument('-s', '--sampling_proportion' , dest='sampling_proportion', default=None, type=float, help="sampling proportion to record in converted spectra (default None)")
+    parser.add_argument('--list' , dest='list', action='store_true', help="list the contents of spectrum files rather than converting pickles")
+    args = vars(parser.parse_args())
+    return args
+
+
+def main():
+    options = get_options()
+    for file_name in options["file_names"]:
+        if options["list"]:
+            spectrum = kmer_spectrum.load(file_name)
+            spectrum.summary()
+            for (kmer, count) in sorted(spectrum.get_kmer_counts().items()):
+                print("%s\t%s"%(kmer, count))
+        else:
+            spectrum_filename = convert_pickle(file_name, options["sampling_proportion"])
+            print("converted %s to %s"%(file_name, spectrum_filename))
+            kmer_spectrum.load(spectrum_filename).summary()
+
+
+if __name__ == "__main__":
+   main()
@@ -1,14 +1,16 @@
 #!/usr/bin/env python2.7
 
 import itertools,os,re,argparse,string,sys
+from multiprocessing import Pool
 #sys.path.append('/usr/local/agr-scripts')
 #from prbdf import Distribution , build, from_tab_delimited_file, bin_discrete_value
-from data_prism import prism, build, from_tab_delimited_file, bin_discrete_value
+from data_prism import prism, build, bin_discrete_value
+from blast_results import query_blocks_from_file, get_database_name, build_split_prism
 
 
 def my_locus_provider(filename, *xargs):
     """
-    transform the tab-delimited stream, to only yield the records that relates either to a hit
+    transform the blast results (parsed a query at a time - see blast_results.py), to only yield the records that relate either to a hit
     or "no hit" . Note that sometimes this format reports multiple hits to the same target
     - we only want the top hit - this is provided by the next method
 # BLASTN 2.6.0+
@@ -28,40 +30,18 @@ seq_21074       CM004590.1      98.438  64      1       0       1       64
 
     """
     weighting_method = xargs[0]
-    raw_tuple_stream = from_tab_delimited_file(filename,*xargs[1:])   # query, hitacc, hstart,hend
-    database=[None]
-    tuple_stream = ((item[0], database[0], item[1], item[2],item[3]) for item in raw_tuple_stream)
-
-    atuple = tuple_stream.next()
-    query = ""
-    while True:
-        #print "DEBUG", atuple
-        database_match=re.search("^#\s+Database:\s+(\S+)$",atuple[0].strip())
-        if database_match is not None:
-            database[0] = os.path.splitext( os.path.basename(database_match.groups()[0]) )[0]
-        weight = 1
-        query_match = re.search("^#\s+Query:\s+(.*)$",atuple[0].strip())
-        if query_match is not None:
-            query = query_match.groups()[0]
-        if re.search(" 0 hits",atuple[0],re.IGNORECASE) is not None:
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                weight = float(weighting_match.groups()[0])
-            yield ((query,database[0],'No hits'),weight)
-        elif atuple[3:] != (None, None):
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                weight = float(weighting_match.groups()[0])
-            yield ((query,database[0],atuple[2]), weight)
-        else:
-            pass 
-        
-        atuple = tuple_stream.next()
+    for block in query_blocks_from_file(filename, xargs[1:], weighting_method):   # query, hitacc, hstart,hend
+        database = get_database_name(block.database)
+        if block.no_hits:
+            yield ((block.query,database,'No hits'),block.weight)
+        for hit in block.hits:
+            if hit[2:] != (None, None):
+                yield ((block.query,database,hit[1]), block.weight)
 
 
 def my_description_provider(filename, *xargs):
     """
-    transform the tab-delimited stream, to only yield the records that relates either to a hit
+    transform the blast results (parsed a query at a time - see blast_results.py), to only yield the records that relate either to a hit
     or "no hit" . Note that sometimes this format reports multiple hits to the same target
     - we only want the top hit - this is provided by the next method
 # BLASTN 2.6.0+
@@ -81,39 +61,16 @@ seq_21074       CM004590.1      98.438  64      1       0       1       64
 
     """
     weighting_method = xargs[0]
-    raw_tuple_stream = from_tab_delimited_file(filename,*xargs[1:])   # query, description
-    database=[None]
-    tuple_stream = ((item[0], database[0], item[1]) for item in raw_tuple_stream)
-
-    atuple = tuple_stream.next()
-    query = ""
-    while True:
-        #print "DEBUG1", atuple
-        database_match=re.search("^#\s+Database:\s+(\S+)$",atuple[0].strip())
-        if database_match is not None:
-            database[0] = os.path.splitext( os.path.basename(database_match.groups()[0]) )[0]
-        weight = 1
-        query_match = re.search("^#\s+Query:\s+(.*)$",atuple[0].strip())
-        if query_match is not None:
-            query = query_match.groups()[0]
-        if re.search(" 0 hits",atuple[0],re.IGNORECASE) is not None:
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                weight = float(weighting_match.groups()[0])
-            yield ((query,database[0],'No hits'),weight)
-        elif atuple[0] == re.split("\s+",query)[0]:
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                weight = float(weighting_match.groups()[0])
-            #print "DEBUG2", ((query,database[0],atuple[2]), weight)
-            # e.g.
-            #(('seq_91347 count=1.001001', 'nt', 'PREDICTED: Salmo salar uncharacterized LOC106591627 (LOC106591627), ncRNA'), 1.001001)
-            yield ((query,database[0],atuple[2]), weight)
-            
-        else:
-            pass 
-        
-        atuple = tuple_stream.next()
+    for block in query_blocks_from_file(filename, xargs[1:], weighting_method):   # query, description
+        database = get_database_name(block.database)
+        if block.no_hits:
+            yield ((block.query,database,'No hits'),block.weight)
+        query_id = re.split("\s+",block.query)[0]
+        for hit in block.hits:
+            if hit[0] == query_id:
+                # e.g.
+                #(('seq_91347 count=1.001001', 'nt', 'PREDICTED: Salmo salar uncharacterized LOC106591627 (LOC106591627), ncRNA'), 1.001001)
+                yield ((block.query,database,hit[1]), block.weight)
         
 
 def my_top_locus_provider(filename, *xargs):
@@ -157,7 +114,7 @@ def my_description_spectrum_value_provider(interval_weight, *xargs):
     return ((interval_weight[1],interval_weight[0][1],interval_weight[0][2]),)
 
 
-def build_locus_distribution(datafiles, weighting_method = None, locus_type="locus"):
+def build_locus_distribution(datafiles, weighting_method = None, locus_type="locus", timing = False, split_processes = 1):
     distob = prism(datafiles, 1)
 
     #distob.DEBUG = True
@@ -173,10 +130,29 @@ def build_locus_distribution(datafiles, weighting_method = None, locus_type="loc
         distob.spectrum_value_provider_func = my_description_spectrum_value_provider
     
     
-    distdata = build(distob,"singlethread")
+    # optionally time the stages of the build (see prism_instrument.py)
+    instrument = None
+    if timing:
+        from prism_instrument import build_instrument
+        instrument = build_instrument(os.path.commonprefix(datafiles), datafiles)
+        instrument.instrument_prism(distob)
+        instrument.start_stage("merge")
+    
+    if split_processes > 1:
+        # the files are split into chunks which are parsed by a pool of processes
+        distdata = build_split_prism(distob, split_processes)
+    else:
+        distdata = build(distob,"singlethread")
 
+    if instrument is not None:
+        instrument.end_stage("merge")
+        instrument.restore_prism(distob)
+        instrument.start_stage("save")
     print "saving distribution to %s.locus.pickle"%os.path.commonprefix(datafiles)
     distob.save("%s.locus.pickle"%os.path.commonprefix(datafiles))
+    if instrument is not None:
+        instrument.end_stage("save")
+        instrument.write("%s.locus.pickle"%os.path.commonprefix(datafiles))
     print """
     seq count %d
     locus count %d
@@ -186,6 +162,39 @@ def build_locus_distribution(datafiles, weighting_method = None, locus_type="loc
     
     return distdata
 
+def summarise_file(file_args):
+    """
+    worker method - builds the locus distribution of a single results file
+    """
+    (filename, weighting_method, locus_type, timing, split_processes) = file_args
+    build_locus_distribution([filename], weighting_method = weighting_method, locus_type = locus_type, timing = timing, split_processes = split_processes)
+    return filename
+
+def summarise_files(filenames, weighting_method = None, locus_type = "locus", timing = False, num_processes = 1, split_results = False):
+    """
+    builds a locus distribution for each results file (as if the script was run once for each file) - either serially, or
+    in a pool of processes. If split_results, the files are summarised one at a time, each split into chunks which are 
+    parsed by the pool of processes
+    """
+    if split_results:
+        for filename in filenames:
+            summarise_file((filename, weighting_method, locus_type, timing, num_processes))
+        return
+
+    file_args_list = [ (filename, weighting_method, locus_type, timing, 1) for filename in filenames ]
+    if num_processes == 1 or len(filenames) < 2:
+        for file_args in file_args_list:
+            summarise_file(file_args)
+        return
+
+    pool = Pool(min(num_processes, len(filenames)))
+    try:
+        for filename in pool.imap(summarise_file, file_args_list):
+            print "summarised %s"%filename
+    finally:
+        pool.close()
+        pool.join()
+
 def locus_cmp(x,y):
     ord=cmp(x[0],y[0])
     if ord == 0:
@@ -259,6 +268,9 @@ for file in /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_o
    do ./locus_prism.py --weighting_method tag_count --locus_type description $file >> /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/annotation/nt_gene.summary.txt;
 done
 
+# or, as a single job summarising 16 files at a time 
+./locus_prism.py --weighting_method tag_count --locus_type description --each_file --num_processes 16 /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/blast/*.gz
+
 ./locus_prism.py --summary_type summary_table --measure frequency --rownames /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/blast/*.pickle > /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/annotation/nt_gene_freq.txt
 ./locus_prism.py --summary_type summary_table --measure information --rownames /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/blast/*.pickle > > /dataset/gseq_processing/scratch/gbs/180824_D00390_0394_BCCPYFANXX_old_KGD/SQ0673.all.PstI-MspI.PstI-MspI/annotation/nt_gene_info.txt
 
@@ -279,10 +291,19 @@ optionally, the query line can specify a weighting to be used as a count instead
     parser.add_argument('--rownames' , dest='rownames', default=False,action='store_true', help="combine genome and locus fields to make a rowname")
     parser.add_argument('--weighting_method' , dest='weighting_method', default=None,choices=["tag_count"],help="weighting method")
     parser.add_argument('--locus_type' , dest='locus_type', default="locus" ,choices=["locus", "description"],help="locus type")
+    parser.add_argument('--timing' , dest='timing', default=False,action='store_true', help="time the stages of the build (parse, count, merge, save), writing the timing as a json file next to the pickle, and a summary line to the log")
+    parser.add_argument('--each_file' , dest='each_file', default=False,action='store_true', help="build a distribution for each input file (e.g. x.results.gz.locus.pickle for each x.results.gz), rather than a single distribution of all of them")
+    parser.add_argument('--num_processes' , dest='num_processes', default=1, type=int, help="(with each_file or split_results) number of processes used to summarise the input files - with each_file, each file is summarised by one process, unless split_results (default 1)")
+    parser.add_argument('--split_results' , dest='split_results', default=False,action='store_true', help="split the input files (at query boundaries) into chunks which are parsed by num_processes processes - for large results files. The distributions are identical to those built by one process")
 
 
 
     args = vars(parser.parse_args())
+
+    if args["num_processes"] < 1:
+        parser.error("num_processes must be at least 1")
+    if args["num_processes"] > 1 and not (args["each_file"] or args["split_results"]):
+        parser.error("num_processes requires each_file or split_results (otherwise a single distribution of all the input files is built by one process)")
     return args
 
         
@@ -299,7 +320,15 @@ def main():
     #debug(args)
 
     if args["summary_type"] == "sample_summaries" :
-        locus_dist = build_locus_distribution(args['filenames'], weighting_method = args["weighting_method"], locus_type=args["locus_type"])
+        if args["each_file"]:
+            summarise_files(args['filenames'], weighting_method = args["weighting_method"], locus_type=args["locus_type"], timing = args["timing"], num_processes = args["num_processes"], \
+                            split_results = args["split_results"])
+        else:
+            split_processes = 1
+            if args["split_results"]:
+                split_processes = args["num_processes"]
+            locus_dist = build_locus_distribution(args['filenames'], weighting_method = args["weighting_method"], locus_type=args["locus_type"], timing = args["timing"], \
+                                                  split_processes = split_processes)
         #write_summaries(filename,locus_dist)
     elif args["summary_type"] == "summary_table" :
         #print "summarising %s"%str(args["filename"])
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import resource
+
+#********************************************************************
+# optional instrumentation of prism builds. A build_instrument times
+# the stages of building a prism from an input file :
+#
+# decompress - reading (and decompressing) blocks of the input, where the
+#              reader reports these (e.g. the kmer_prism raw record reader)
+# parse      - the rest of the time spent in file_to_stream_func, i.e.
+#              turning the input into records
+# count      - spectrum_value_provider_func, i.e. turning records into
+#              spectrum values
+# merge      - the rest of the build (e.g. accumulating the spectrum,
+#              and waiting for and merging the results of worker processes)
+#              - i.e. the time between start_stage("merge") and end_stage("merge")
+#              not spent in the other stages
+# save       - saving (pickling) the prism
+#
+# Stages are timed by wrapping the stream and provider functions of the
+# prism with callable (so picklable) objects. Stages nest (e.g. the build
+# calls the stream function, which reads blocks) and time is only added
+# to the innermost stage, so stage times add up. Only work done in the main
+# process is timed and counted - where a build hands records out to
+# worker processes, their time shows up as merge. The results are written
+# as a json sidecar next to the saved prism, and as a single summary line
+# on standard output (i.e. in the log)
+#********************************************************************
+
+TIMING_SUFFIX = ".timing.json"
+
+def get_peak_rss_mb():
+    """
+    returns the peak resident memory (MB) of this process, or of its largest (finished) child process if larger
+    """
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        return peak_rss / (1024.0 * 1024.0)
+    return peak_rss / 1024.0
+
+def get_record_count(item):
+    """
+    returns the number of records in an item from a stream - batches (lists) of records count as their length
+    """
+    if isinstance(item, list):
+        return len(item)
+    return 1
+
+class timed_func(object):
+    """
+    base class of the timed wrappers below. A wrapper compares equal to the function it wraps, so that 
+    code which checks which function a prism has been configured with still works when it is instrumented
+    """
+    def __init__(self, func, instrument, stage):
+        super(timed_func, self).__init__()
+        self.func = func
+        self.instrument = instrument
+        self.stage = stage
+
+    def __eq__(self, other):
+        if isinstance(other, timed_func):
+            return self.func == other.func
+        return self.func == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.func)
+
+class timed_stream_func(timed_func):
+    """
+    wraps a file_to_stream_func, timing the time spent getting each record from it
+    """
+    def __init__(self, stream_func, instrument, stage="parse"):
+        super(timed_stream_func, self).__init__(stream_func, instrument, stage)
+
+    def __call__(self, datafile, *args):
+        return self.instrument.time_iter(self.func(datafile, *args), self.stage, get_record_count)
+
+class timed_value_provider(timed_func):
+    """
+    wraps a spectrum_value_provider_func, timing each call (lazy results are consumed within the timing)
+    """
+    def __init__(self, value_provider, instrument, stage="count"):
+        super(timed_value_provider, self).__init__(value_provider, instrument, stage)
+
+    def __call__(self, *args):
+        self.instrument.start_stage(self.stage)
+        try:
+            values = self.func(*args)
+            if values is not None and not isinstance(values, (list, tuple, dict)):
+                values = list(values)
+        finally:
+            self.instrument.end_stage(self.stage)
+        return values
+
+class build_instrument(object):
+    def __init__(self, name, input_filenames=[]):
+        super(build_instrument, self).__init__()
+        self.name = name
+        self.input_filenames = list(input_filenames)
+        self.stage_seconds = {}
+        self.stage_order = []
+        self.stage_stack = []
+        self.records = 0
+        self.bytes_decompressed = 0
+        self.wrapped = None
+        self.start_time = time.time()
+
+    def add_time(self, stage, seconds):
+        if stage not in self.stage_seconds:
+            self.stage_seconds[stage] = 0.0
+            self.stage_order.append(stage)
+        self.stage_seconds[stage] += seconds
+
+    def start_stage(self, stage):
+        """
+        starts timing a stage (pausing the stage it is nested in, if any)
+        """
+        now = time.time()
+        if len(self.stage_stack) > 0:
+            (outer_stage, outer_start_time) = self.stage_stack[-1]
+            self.add_time(outer_stage, now - outer_start_time)
+        self.stage_stack.append([stage, now])
+
+    def end_stage(self, stage):
+        """
+        stops timing a stage (resuming the stage it is nested in, if any)
+        """
+        now = time.time()
+        (inner_stage, start_time) = self.stage_stack.pop()
+        if inner_stage != stage:
+            raise Exception("error - ending stage %s but %s is in progress"%(stage, inner_stage))
+        self.add_time(stage, now - start_time)
+        if len(self.stage_stack) > 0:
+            self.stage_stack[-1][1] = now
+
+    def time_iter(self, item_iter, stage, record_count_func=None, byte_count_func=None):
+        """
+        yields the items of an iterator, adding the time spent getting them to a stage, and optionally counting
+        records (e.g. for the parse stage) or bytes (e.g. for the decompress stage)
+        """
+        item_iter = iter(item_iter)
+        while True:
+            self.start_stage(stage)
+            try:
+                item = next(item_iter)
+            except StopIteration:
+                return
+            finally:
+                self.end_stage(stage)
+            if record_count_func is not None:
+                self.records += record_count_func(item)
+            if byte_count_func is not None:
+                self.bytes_decompressed += byte_count_func(item)
+            yield item
+
+    def instrument_prism(self, instrumented_prism):
+        """
+        wraps the stream and provider functions of a prism so that they are timed (see restore_prism)
+        """
+        self.wrapped = (instrumented_prism.file_to_stream_func, instrumented_prism.spectrum_value_provider_func)
+        instrumented_prism.file_to_stream_func = timed_stream_func(instrumented_prism.file_to_stream_func, self)
+        instrumented_prism.spectrum_value_provider_func = timed_value_provider(instrumented_prism.spectrum_value_provider_func, self)
+        return instrumented_prism
+
+    def restore_prism(self, instrumented_prism):
+        """
+        unwraps the functions of a prism (so that it is saved as if it had not been instrumented)
+        """
+        if self.wrapped is not None and isinstance(instrumented_prism.file_to_stream_func, timed_stream_func):
+            (instrumented_prism.file_to_stream_func, instrumented_prism.spectrum_value_provider_func) = self.wrapped
+        return instrumented_prism
+
+    def get_timing(self):
+        """
+        returns the timing as a dict
+        """
+        stage_seconds = dict(self.stage_seconds)
+        wall_seconds = time.time() - self.start_time
+        bytes_read = sum( os.path.getsize(filename) for filename in self.input_filenames if os.path.isfile(filename) )
+        records_per_second = None
+        if self.records > 0:
+            records_per_second = self.records / max(wall_seconds, 1e-9)
+        return { "name" : self.name, "input_filenames" : self.input_filenames, "records" : self.records, "bytes_read" : bytes_read, \
+                 "bytes_decompressed" : self.bytes_decompressed, "stage_seconds" : stage_seconds, "wall_seconds" : wall_seconds, \
+                 "records_per_second" : records_per_second, "peak_rss_mb" : get_peak_rss_mb() }
+
+    def get_summary_line(self, timing=None):
+        if timing is None:
+            timing = self.get_timing()
+        stage_order = [ stage for stage in ["decompress", "parse", "count", "merge", "save"] if stage in timing["stage_seconds"] ] + \
+                      [ stage for stage in self.stage_order if stage not in ["decompress", "parse", "count", "merge", "save"] ]
+        stages = " ".join("%s=%.2fs"%(stage, timing["stage_seconds"][stage]) for stage in stage_order)
+        records_per_second = "-" if timing["records_per_second"] is None else "%.0f"%timing["records_per_second"]
+        return "timing %s : records=%d bytes_read=%d %s wall=%.2fs records/sec=%s peak_rss=%.1fMB"%(timing["name"], timing["records"], timing["bytes_read"], \
+                                                                                                stages, timing["wall_seconds"], records_per_second, timing["peak_rss_mb"])
+
+    def write(self, saved_filenames):
+        """
+        writes the timing as a json sidecar of a saved prism (e.g. x.kmerdist.pickle -> x.kmerdist.pickle.timing.json), or of each
+        of a list of prisms saved by the same build, and prints the summary line
+        """
+        if not isinstance(saved_filenames, list):
+            saved_filenames = [saved_filenames]
+        timing = self.get_timing()
+        for saved_filename in saved_filenames:
+            with open(saved_filename + TIMING_SUFFIX, "w") as timing_file:
+                json.dump(timing, timing_file, indent=1, sort_keys=True)
+        print(self.get_summary_line(timing))
+        return timing
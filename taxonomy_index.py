@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import io
+import gzip
+import json
+import heapq
+import shutil
+import tempfile
+import itertools
+import argparse
+
+#********************************************************************
+# compact taxonomy index - resolves accessions and taxids to lineages
+# in-process (rather than via get_taxonomy.r and the taxonomizr
+# SQLite database). The index is built once from a local copy of the
+# NCBI taxdump (nodes.dmp, names.dmp and optionally merged.dmp) and
+# accession2taxid files, e.g.
+#
+# ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz
+# ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/nucl_gb.accession2taxid.gz
+#
+# and is a folder of flat binary files, which are memory mapped (so
+# are shared via the page cache by all the processes on a node using
+# the index, and only the pages needed are read) :
+#
+# accession.keys    - the (base) accessions, sorted, as fixed width null padded strings
+# accession.taxids  - int32 taxid of each accession
+# taxid.parents     - int32 parent of each taxid (indexed by taxid)
+# taxid.ranks       - uint8 rank code of each taxid (indexed by taxid)
+# taxid.name_offsets - int64 offset of the scientific name of each taxid in taxid.names
+#                     (the name of taxid t is names[offsets[t]:offsets[t+1]])
+# taxid.names       - utf-8 scientific names
+# taxonomy_index.json - sizes, key width, and rank names
+#
+# Lookups are batched - a batch of accessions is sorted and deduplicated,
+# and joined with the sorted keys (each found by binary search, in
+# ascending order, so the key file is read in a single forward pass),
+# and the lineages of a batch of taxids are found by walking up the
+# parent array a level at a time for the whole batch.
+#
+# Merged taxids (merged.dmp) are kept as unranked children of the taxid
+# they were merged into, so they resolve to its lineage.
+#********************************************************************
+
+INDEX_VERSION = 1
+INDEX_METADATA_FILE = "taxonomy_index.json"
+ACCESSION_KEYS_FILE = "accession.keys"
+ACCESSION_TAXIDS_FILE = "accession.taxids"
+TAXID_PARENTS_FILE = "taxid.parents"
+TAXID_RANKS_FILE = "taxid.ranks"
+TAXID_NAME_OFFSETS_FILE = "taxid.name_offsets"
+TAXID_NAMES_FILE = "taxid.names"
+
+LINEAGE_RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]   # as reported by taxonomizr
+RANK_ALIASES = {"domain" : "superkingdom", "acellular root" : "superkingdom"}   # (NCBI renamed superkingdom in 2025)
+NO_RANK = "no rank"
+MAXIMUM_LINEAGE_DEPTH = 256
+ACCESSION_RUN_SIZE = 20000000    # number of accessions sorted in memory at a time, when building
+LOOKUP_BATCH_SIZE = 100000       # number of records looked up at a time
+
+class taxonomy_index_exception(Exception):
+    def __init__(self,args=None):
+        super(taxonomy_index_exception, self).__init__(args)
+
+def get_text_lines(filename):
+    """
+    returns a stream of the lines of a text file, optionally compressed with gzip
+    """
+    if filename.endswith(".gz"):
+        stream = io.BufferedReader(gzip.open(filename, "rb"))
+    else:
+        stream = io.open(filename, "rb")
+    if sys.version_info >= (3,0):
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return stream
+
+def get_bytes(text, encoding="utf-8"):
+    """
+    returns text as bytes (python 2 strings already are)
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode(encoding)
+
+def dmp_records(filename):
+    """
+    yields the fields of each record of a taxdump .dmp file - e.g.
+    9606	|	9605	|	species	|	HS	|	5	|	...	|
+    """
+    with get_text_lines(filename) as dmp_stream:
+        for record in dmp_stream:
+            record = record.rstrip("\r\n")
+            if record.endswith("\t|"):
+                record = record[:-2]
+            yield record.split("\t|\t")
+
+def get_accession_base(accession):
+    """
+    returns the base accession (i.e. without the version) of an accession or blast subject id - e.g.
+    CP036491.1 -> CP036491, gi|688443106|emb|LL194098.1| -> LL194098, ref|NC_000001.11| -> NC_000001
+    """
+    if "|" in accession:
+        fields = [ field for field in accession.split("|") if len(field) > 0 ]
+        if fields[0] == "gi" and len(fields) > 3:
+            accession = fields[3]
+        elif fields[0] != "gi" and len(fields) > 1:
+            accession = fields[1]
+        else:
+            accession = fields[-1]
+    return accession.split(".")[0]
+
+def get_taxid(taxid):
+    """
+    returns the (first) taxid of a field as an int, or 0 if there is none - e.g. 9606 -> 9606 , 9606;9605 -> 9606, N/A -> 0
+    """
+    if taxid is None:
+        return 0
+    taxid = taxid.split(";")[0].strip()
+    if not taxid.isdigit():
+        return 0
+    return int(taxid)
+
+#********************************************************************
+# building the index
+#********************************************************************
+
+def build_taxid_arrays(taxdump_dir, index_dir):
+    """
+    writes the parent, rank and name arrays (indexed by taxid) from nodes.dmp, names.dmp and merged.dmp (if there is one)
+    and returns the maximum taxid and the rank names
+    """
+    import numpy
+
+    nodes = [ (int(fields[0]), int(fields[1]), RANK_ALIASES.get(fields[2], fields[2])) for fields in dmp_records(os.path.join(taxdump_dir, "nodes.dmp")) ]
+    merged = []
+    if os.path.isfile(os.path.join(taxdump_dir, "merged.dmp")):
+        merged = [ (int(fields[0]), int(fields[1])) for fields in dmp_records(os.path.join(taxdump_dir, "merged.dmp")) ]
+
+    rank_names = [NO_RANK] + sorted(set( rank for (taxid, parent, rank) in nodes if rank != NO_RANK ))
+    rank_codes = dict( (rank, code) for (code, rank) in enumerate(rank_names) )
+    max_taxid = max( [ taxid for (taxid, parent, rank) in nodes ] + [ old_taxid for (old_taxid, taxid) in merged ] )
+
+    parents = numpy.zeros(max_taxid + 1, dtype=numpy.int32)
+    ranks = numpy.zeros(max_taxid + 1, dtype=numpy.uint8)
+    for (taxid, parent, rank) in nodes:
+        parents[taxid] = parent
+        ranks[taxid] = rank_codes[rank]
+    for (old_taxid, taxid) in merged:
+        parents[old_taxid] = taxid
+    del nodes
+
+    names = {}
+    for fields in dmp_records(os.path.join(taxdump_dir, "names.dmp")):
+        if fields[3] == "scientific name":
+            names[int(fields[0])] = get_bytes(fields[1])
+
+    name_offsets = numpy.zeros(max_taxid + 2, dtype=numpy.int64)
+    with open(os.path.join(index_dir, TAXID_NAMES_FILE), "wb") as names_file:
+        offset = 0
+        for taxid in range(max_taxid + 1):
+            name = names.get(taxid, b"")
+            names_file.write(name)
+            offset += len(name)
+            name_offsets[taxid + 1] = offset
+
+    parents.tofile(os.path.join(index_dir, TAXID_PARENTS_FILE))
+    ranks.tofile(os.path.join(index_dir, TAXID_RANKS_FILE))
+    name_offsets.tofile(os.path.join(index_dir, TAXID_NAME_OFFSETS_FILE))
+    return (max_taxid, rank_names)
+
+def accession_records(accession_filenames):
+    """
+    yields (base accession, taxid) from accession2taxid files - e.g.
+    accession       accession.version       taxid   gi
+    A00002  A00002.1        9913    2
+    """
+    for filename in accession_filenames:
+        with get_text_lines(filename) as accession_stream:
+            for record in accession_stream:
+                fields = record.split("\t")
+                if fields[0] == "accession" or len(fields) < 3:
+                    continue
+                yield (get_bytes(fields[0], "ascii"), int(fields[2]))
+
+def write_sorted_run(records, run_dir, run_number):
+    """
+    sorts a run of (accession, taxid) records, keeping the first record of each accession, and saves it (as numpy arrays) 
+    for merging. Returns the filename and the key width of the run
+    """
+    import numpy
+    keys = numpy.array([ key for (key, taxid) in records ])
+    taxids = numpy.array([ taxid for (key, taxid) in records ], dtype=numpy.int32)
+    order = numpy.argsort(keys, kind="mergesort")     # stable, so the first record of an accession sorts first
+    (keys, taxids) = (keys[order], taxids[order])
+    first = numpy.concatenate(([True], keys[1:] != keys[:-1]))
+    run_filename = os.path.join(run_dir, "run%d.npz"%run_number)
+    numpy.savez(run_filename, keys=keys[first], taxids=taxids[first])
+    return (run_filename, keys.dtype.itemsize)
+
+def run_records(run_filename, run_number):
+    """
+    yields (accession, run number, taxid) from a sorted run - i.e. where runs list the same accession, the earlier run merges first
+    """
+    import numpy
+    run = numpy.load(run_filename)
+    for (key, taxid) in zip(run["keys"].tolist(), run["taxids"].tolist()):
+        yield (key, run_number, taxid)
+
+def build_accession_arrays(accession_filenames, index_dir, run_size=ACCESSION_RUN_SIZE, temp_dir=None):
+    """
+    writes the sorted accession keys and their taxids, and returns the number of keys and the key width. The accessions
+    are sorted in runs (of run_size), which are then merged. Where an accession is listed more than once, the first taxid is kept
+    """
+    import numpy
+
+    run_dir = tempfile.mkdtemp(prefix="taxonomy_index", dir=temp_dir)
+    try:
+        runs = []
+        record_iter = accession_records(accession_filenames)
+        records = list(itertools.islice(record_iter, run_size))
+        while len(records) > 0:
+            runs.append(write_sorted_run(records, run_dir, len(runs)))
+            records = list(itertools.islice(record_iter, run_size))
+        key_width = max([1] + [ run_key_width for (run_filename, run_key_width) in runs ])
+
+        # merge the runs, writing blocks of the unique keys
+        key_count = 0
+        merged_iter = heapq.merge(*[ run_records(run_filename, run_number) for (run_number, (run_filename, run_key_width)) in enumerate(runs) ])
+        unique_iter = ( (key, taxid) for (key, run_number, taxid) in ( next(group) for (key, group) in itertools.groupby(merged_iter, lambda record:record[0]) ) )
+        with open(os.path.join(index_dir, ACCESSION_KEYS_FILE), "wb") as keys_file, open(os.path.join(index_dir, ACCESSION_TAXIDS_FILE), "wb") as taxids_file:
+            block = list(itertools.islice(unique_iter, LOOKUP_BATCH_SIZE))
+            while len(block) > 0:
+                keys_file.write(numpy.array([ key for (key, taxid) in block ], dtype="S%d"%key_width).tobytes())
+                taxids_file.write(numpy.array([ taxid for (key, taxid) in block ], dtype=numpy.int32).tobytes())
+                key_count += len(block)
+                block = list(itertools.islice(unique_iter, LOOKUP_BATCH_SIZE))
+    finally:
+        shutil.rmtree(run_dir)
+
+    return (key_count, key_width)
+
+def build_taxonomy_index(index_dir, taxdump_dir, accession_filenames, run_size=ACCESSION_RUN_SIZE, temp_dir=None):
+    """
+    builds a taxonomy index (see above) in index_dir
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    (max_taxid, rank_names) = build_taxid_arrays(taxdump_dir, index_dir)
+    (accession_count, key_width) = build_accession_arrays(accession_filenames, index_dir, run_size, temp_dir)
+    metadata = { "version" : INDEX_VERSION, "max_taxid" : max_taxid, "rank_names" : rank_names, "accession_count" : accession_count, \
+                 "key_width" : key_width, "taxdump_dir" : os.path.abspath(taxdump_dir), \
+                 "accession_filenames" : [ os.path.abspath(filename) for filename in accession_filenames ] }
+    # the metadata is written last, so that an index which was not completely built cannot be opened
+    with open(os.path.join(index_dir, INDEX_METADATA_FILE), "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=1, sort_keys=True)
+    return metadata
+
+#********************************************************************
+# using the index
+#********************************************************************
+
+class taxonomy_index(object):
+    def __init__(self, index_dir):
+        super(taxonomy_index, self).__init__()
+        import numpy
+        self.index_dir = index_dir
+        metadata_filename = os.path.join(index_dir, INDEX_METADATA_FILE)
+        if not os.path.isfile(metadata_filename):
+            raise taxonomy_index_exception("error - %s not found - %s does not look like a (completely built) taxonomy index"%(metadata_filename, index_dir))
+        with open(metadata_filename, "r") as metadata_file:
+            self.metadata = json.load(metadata_file)
+        if self.metadata["version"] != INDEX_VERSION:
+            raise taxonomy_index_exception("error - %s is a version %s taxonomy index - expected version %s (please rebuild it)"%(index_dir, self.metadata["version"], INDEX_VERSION))
+        self.key_width = self.metadata["key_width"]
+        self.max_taxid = self.metadata["max_taxid"]
+        self.rank_names = self.metadata["rank_names"]
+        self.keys = self.get_array(ACCESSION_KEYS_FILE, "S%d"%self.key_width, self.metadata["accession_count"])
+        self.taxids = self.get_array(ACCESSION_TAXIDS_FILE, numpy.int32, self.metadata["accession_count"])
+        self.parents = self.get_array(TAXID_PARENTS_FILE, numpy.int32, self.max_taxid + 1)
+        self.ranks = self.get_array(TAXID_RANKS_FILE, numpy.uint8, self.max_taxid + 1)
+        self.name_offsets = self.get_array(TAXID_NAME_OFFSETS_FILE, numpy.int64, self.max_taxid + 2)
+        self.names = self.get_array(TAXID_NAMES_FILE, numpy.uint8, int(self.name_offsets[-1]))
+
+    def get_array(self, filename, dtype, length):
+        """
+        memory maps one of the files of the index
+        """
+        import numpy
+        if length == 0:
+            return numpy.zeros(0, dtype=dtype)     # (an empty file can't be mapped)
+        return numpy.memmap(os.path.join(self.index_dir, filename), dtype=dtype, mode="r", shape=(length,))
+
+    def get_rank_code(self, rank):
+        rank = RANK_ALIASES.get(rank, rank)
+        if rank not in self.rank_names:
+            raise taxonomy_index_exception("error - unknown rank %s (the ranks in the index are %s)"%(rank, ", ".join(self.rank_names[1:])))
+        return self.rank_names.index(rank)
+
+    def get_accession_taxids(self, accessions):
+        """
+        returns a numpy array of the taxids of a batch of (base) accessions, with 0 for accessions which are not in the index
+        """
+        import numpy
+        if len(accessions) == 0 or len(self.keys) == 0:
+            return numpy.zeros(len(accessions), dtype=numpy.int64)
+        accessions = [ accession.encode("ascii") if not isinstance(accession, bytes) else accession for accession in accessions ]
+        (queries, inverse) = numpy.unique(numpy.array(accessions, dtype="S%d"%max(self.key_width, max( len(accession) for accession in accessions ))), return_inverse=True)
+        positions = numpy.minimum(numpy.searchsorted(self.keys, queries), len(self.keys) - 1)
+        found = self.keys[positions] == queries
+        query_taxids = numpy.where(found, self.taxids[positions], 0).astype(numpy.int64)
+        return query_taxids[inverse]
+
+    def get_lineage_taxids(self, taxids, ranks=LINEAGE_RANKS):
+        """
+        returns a (len(taxids) x len(ranks)) numpy array of the taxid at each rank of the lineage of a batch of taxids, with 0 where a lineage
+        has no taxid at a rank (or the taxid is not in the index)
+        """
+        import numpy
+        rank_codes = [ self.get_rank_code(rank) for rank in ranks ]
+        current = numpy.asarray(taxids, dtype=numpy.int64)
+        current = numpy.where((current > 0) & (current <= self.max_taxid), current, 0)
+        lineage_taxids = numpy.zeros((len(current), len(ranks)), dtype=numpy.int64)
+        for depth in range(MAXIMUM_LINEAGE_DEPTH):
+            climbing = current > 0
+            if not climbing.any():
+                break
+            current_ranks = self.ranks[current]
+            for (rank_number, rank_code) in enumerate(rank_codes):
+                at_rank = climbing & (current_ranks == rank_code) & (lineage_taxids[:, rank_number] == 0)
+                lineage_taxids[at_rank, rank_number] = current[at_rank]
+            parents = self.parents[current].astype(numpy.int64)
+            current = numpy.where(parents == current, 0, parents)     # the root is its own parent
+        return lineage_taxids
+
+    def get_name(self, taxid):
+        """
+        returns the scientific name of a taxid, or None
+        """
+        if taxid <= 0 or taxid > self.max_taxid:
+            return None
+        name = self.names[self.name_offsets[taxid]:self.name_offsets[taxid + 1]].tobytes()
+        if len(name) == 0:
+            return None
+        if sys.version_info >= (3,0):
+            return name.decode("utf-8")
+        return name
+
+    def get_lineages(self, taxids, ranks=LINEAGE_RANKS):
+        """
+        returns the lineage of each of a batch of taxids - a tuple of the names at each rank, with None where there is no name at a rank
+        """
+        lineage_taxids = self.get_lineage_taxids(taxids, ranks)
+        names = dict( (taxid, self.get_name(taxid)) for taxid in set(lineage_taxids.flatten().tolist()) )
+        return [ tuple( names[taxid] for taxid in lineage ) for lineage in lineage_taxids.tolist() ]
+
+    def get_accession_lineages(self, accessions, ranks=LINEAGE_RANKS):
+        """
+        returns the lineage of each of a batch of accessions (or blast subject ids)
+        """
+        return self.get_lineages(self.get_accession_taxids([ get_accession_base(accession) for accession in accessions ]), ranks)
+
+class lineage_resolver(object):
+    """
+    resolves the hits of blast results to lineages, in batches (as used by taxonomy_prism.py). Each hit is a tuple
+    (query, taxid, subject id, ...) - i.e. the query followed by the hit columns - and is resolved to (query, name at each
+    rank, ...) using the taxid if there is one, otherwise the accession of the subject. The index is opened when first used, 
+    so that a resolver can be passed to other processes (each of which maps the index)
+    """
+    def __init__(self, index_dir, ranks, taxid_column=4, accession_column=1, unknown="Unknown", batch_size=LOOKUP_BATCH_SIZE):
+        super(lineage_resolver, self).__init__()
+        self.index_dir = index_dir
+        self.ranks = list(ranks)
+        self.taxid_column = taxid_column
+        self.accession_column = accession_column
+        self.unknown = unknown
+        self.batch_size = batch_size
+        self.index = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["index"] = None
+        return state
+
+    def get_hit_columns(self):
+        """
+        returns the columns (of the results file) needed to resolve a hit
+        """
+        return [self.taxid_column, self.accession_column]
+
+    def get_index(self):
+        if self.index is None:
+            self.index = taxonomy_index(self.index_dir)
+            for rank in self.ranks:
+                self.index.get_rank_code(rank)
+        return self.index
+
+    def resolve_hits(self, item_iter, no_hits="No hits"):
+        """
+        takes a stream of (hit, weight) items and yields (resolved hit, weight) items. Items with no hits (i.e. with
+        no_hits as the taxid) are passed through, with no_hits at each rank
+        """
+        index = self.get_index()
+        item_iter = iter(item_iter)
+        batch = list(itertools.islice(item_iter, self.batch_size))
+        while len(batch) > 0:
+            taxids = [ get_taxid(hit[1]) if hit[1] != no_hits else 0 for (hit, weight) in batch ]
+            unknown_taxids = [ item_number for (item_number, taxid) in enumerate(taxids) if taxid == 0 and batch[item_number][0][1] != no_hits ]
+            accession_taxids = index.get_accession_taxids([ get_accession_base(batch[item_number][0][2]) for item_number in unknown_taxids ])
+            for (item_number, taxid) in zip(unknown_taxids, accession_taxids.tolist()):
+                taxids[item_number] = taxid
+            lineages = index.get_lineages(taxids, self.ranks)
+            for ((hit, weight), lineage) in zip(batch, lineages):
+                if hit[1] == no_hits:
+                    yield ((hit[0],) + len(self.ranks) * (no_hits,) + tuple(hit[3:]), weight)
+                else:
+                    yield ((hit[0],) + tuple( self.unknown if name is None else name for name in lineage ) + tuple(hit[3:]), weight)
+            batch = list(itertools.islice(item_iter, self.batch_size))
+
+#********************************************************************
+# command line - build an index, or look up the accessions (or taxids)
+# in a column of text files (like get_taxonomy.r)
+#********************************************************************
+
+def lookup_files(index_dir, filenames, column, lookup_type, result_format, ranks):
+    """
+    prints each record of the files (whitespace delimited) followed by the taxid, or the names at each rank, of the accession
+    or taxid in a column (NA where not found). (Unlike get_taxonomy.r, which writes its results with R's write.table, 
+    nothing is quoted)
+    """
+    index = taxonomy_index(index_dir)
+    for filename in filenames:
+        with get_text_lines(filename) as record_stream:
+            records = ( record.split() for record in record_stream if len(record.strip()) > 0 )
+            batch = list(itertools.islice(records, LOOKUP_BATCH_SIZE))
+            while len(batch) > 0:
+                if lookup_type == "accession":
+                    taxids = index.get_accession_taxids([ get_accession_base(record[column]) for record in batch ]).tolist()
+                else:
+                    taxids = [ get_taxid(record[column]) for record in batch ]
+                if result_format == "taxid":
+                    results = [ (str(taxid) if taxid > 0 else "NA",) for taxid in taxids ]
+                else:
+                    results = [ tuple( "NA" if name is None else name for name in lineage ) for lineage in index.get_lineages(taxids, ranks) ]
+                for (record, result) in zip(batch, results):
+                    print("\t".join(record + list(result)))
+                batch = list(itertools.islice(records, LOOKUP_BATCH_SIZE))
+
+def get_options():
+    description = """
+    builds a compact taxonomy index from a local copy of the NCBI taxdump and accession2taxid files, or looks up the
+    lineages of accessions (or taxids) in a column of text files using an index
+    """
+    long_description = """
+
+examples :
+
+# build an index (once)
+taxonomy_index.py --action build --index_dir /dataset/gseq_processing/scratch/taxonomy_index --taxdump_dir /dataset/gseq_processing/scratch/taxdump /dataset/gseq_processing/scratch/taxdump/nucl_gb.accession2taxid.gz /dataset/gseq_processing/scratch/taxdump/nucl_wgs.accession2taxid.gz
+
+# look up the lineages of the accessions in the second column of a file - e.g.
+# 879     CP017297.1
+# 879     CP017707.1
+taxonomy_index.py --index_dir /dataset/gseq_processing/scratch/taxonomy_index --column 1 test/accessions.txt
+
+# look up just the taxids
+taxonomy_index.py --index_dir /dataset/gseq_processing/scratch/taxonomy_index --column 1 --result_format taxid test/accessions.txt
+"""
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="*",help='accession2taxid files (build), or files to look up (lookup) (optionally compressed with gzip)')
+    parser.add_argument('--action' , dest='action', default="lookup", type=str, choices=["build", "lookup"], help="action (default lookup)")
+    parser.add_argument('--index_dir' , dest='index_dir', required=True, type=str, help="folder containing the index")
+    parser.add_argument('--taxdump_dir' , dest='taxdump_dir', default=None, type=str, help="(build) folder containing nodes.dmp, names.dmp and (optionally) merged.dmp")
+    parser.add_argument('--temp_dir' , dest='temp_dir', default=None, type=str, help="(build) folder for the sorted runs of accessions (default the system temporary folder)")
+    parser.add_argument('--run_size' , dest='run_size', default=ACCESSION_RUN_SIZE, type=int, help="(build) number of accessions sorted in memory at a time (default %d)"%ACCESSION_RUN_SIZE)
+    parser.add_argument('--column' , dest='column', default=0, type=int, help="(lookup) column number (starting from 0) of the accession or taxid (default 0)")
+    parser.add_argument('--lookup_type' , dest='lookup_type', default="accession", type=str, choices=["accession", "taxid"], help="(lookup) what the column contains (default accession)")
+    parser.add_argument('--result_format' , dest='result_format', default="taxa", type=str, choices=["taxa", "taxid"], help="(lookup) taxa : the name at each rank. taxid : just the taxid (default taxa)")
+    parser.add_argument('--ranks' , dest='ranks', default=",".join(LINEAGE_RANKS), type=str, help="(lookup) ranks (default %s)"%",".join(LINEAGE_RANKS))
+
+    args = vars(parser.parse_args())
+    args["ranks"] = [ rank.strip() for rank in args["ranks"].split(",") if len(rank.strip()) > 0 ]
+
+    if args["action"] == "build":
+        if args["taxdump_dir"] is None:
+            parser.error("build requires a taxdump_dir")
+        if len(args["filenames"]) == 0:
+            parser.error("build requires at least one accession2taxid file")
+        if args["run_size"] < 1:
+            parser.error("run_size must be at least 1")
+    elif args["column"] < 0:
+        parser.error("column must be at least 0")
+    return args
+
+def main():
+    args = get_options()
+    if args["action"] == "build":
+        metadata = build_taxonomy_index(args["index_dir"], args["taxdump_dir"], args["filenames"], args["run_size"], args["temp_dir"])
+        print("built taxonomy index %s : maximum taxid %d, %d accessions"%(args["index_dir"], metadata["max_taxid"], metadata["accession_count"]))
+    else:
+        lookup_files(args["index_dir"], args["filenames"], args["column"], args["lookup_type"], args["result_format"], args["ranks"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
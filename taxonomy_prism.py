@@ -1,65 +1,71 @@
 #!/usr/bin/env python2.7
 
 import itertools,os,re,argparse,string,sys
+from multiprocessing import Pool
 #sys.path.append('/usr/local/agr-scripts')
 #from prbdf import Distribution , build, from_tab_delimited_file, bin_discrete_value
-from data_prism import prism, build, from_tab_delimited_file, bin_discrete_value
+from data_prism import prism, build, bin_discrete_value
+from blast_results import query_blocks_from_file, build_split_prism, best_hit_selector, SELECTION_CRITERIA
 
 
 def my_hit_provider(filename, *xargs):
     """
-    transform the tab-delimited stream, to only yield the records that relates either to a hit
-    or "no hit" . Note that sometimes this format reports multiple hits to the same target
-    - we only want the top hit - this is provided by the next method
+    transform the blast results (parsed a query at a time - see blast_results.py), to only yield the records that relate either 
+    to a hit or "no hit" . Note that sometimes this format reports multiple hits to the same target
+    - we only want the top hit - this is provided by the next method.
+    If there is a lineage resolver (the second arg - see taxonomy_index.py), the hit columns are the taxid and subject id, 
+    and the hits are resolved (in batches) to the names at each rank of their lineage
     """
+    (weighting_method, lineage_resolver) = xargs[0:2]
+    if lineage_resolver is not None:
+        return lineage_resolver.resolve_hits(my_hit_provider(filename, weighting_method, None, *xargs[2:]))
+    return my_unresolved_hit_provider(filename, weighting_method, *xargs[2:])
+
+def my_unresolved_hit_provider(filename, *xargs):
     weighting_method = xargs[0]
-    tuple_stream = from_tab_delimited_file(filename,*xargs[1:])
-
-    atuple = tuple_stream.next()
-    query = ""
-    while True:
-        #print "debug " + str(atuple)
-        weight = 1.0
-        query_match = re.search("^#\s+Query:\s+(.*)$",atuple[0].strip())
-        if query_match is not None:
-            query = query_match.groups()[0]
-        if re.search(" 0 hits",atuple[0],re.IGNORECASE) is not None:
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                if weighting_match is not None:
-                    weight = float(weighting_match.groups()[0])
-            yield ((query,'No hits','No hits'),weight)
-        elif atuple[1:] == tuple( (len(atuple)-1) * [None] ):
-            pass
-        elif atuple[1] is None or atuple[2] is None:
-            raise Exception("error - unexpected results %s from blast output - incomplete taxonomy tuple"%str(atuple))        
-        else:
-            if weighting_method == "tag_count":
-                weighting_match = re.search("count=(\d*\.*\d*)\s*$", query)
-                if weighting_match is not None:
-                    weight = float(weighting_match.groups()[0])
-            yield (atuple, weight)
-        
-        atuple = tuple_stream.next()
+    missing_columns = tuple( (len(xargs)-2) * [None] )
+
+    for block in query_blocks_from_file(filename, xargs[1:], weighting_method, 1.0):
+        if block.no_hits:
+            yield ((block.query,'No hits','No hits'),block.weight)
+        for hit in block.hits:
+            if hit[1:] == missing_columns:
+                pass
+            elif hit[1] is None or hit[2] is None:
+                raise Exception("error - unexpected results %s from blast output - incomplete taxonomy tuple"%str(hit))        
+            else:
+                yield (hit, block.weight)
 
 def my_top_hit_provider(filename, *xargs):
     """
-    takes a stream which may contain multiple hits, and yields just the top hit in each group
+    takes a stream which may contain multiple hits, and yields just the top hit in each group. If there is a lineage resolver, 
+    only the top hits are resolved (the other hits of each query are discarded unresolved)
     """
-    groups = itertools.groupby(my_hit_provider(filename, *xargs), lambda x:x[0][0])    
+    (weighting_method, lineage_resolver) = xargs[0:2]
+    groups = itertools.groupby(my_hit_provider(filename, weighting_method, None, *xargs[2:]), lambda x:x[0][0])    
     top_hits = (group.next() for (key, group) in groups)
+    if lineage_resolver is not None:
+        return lineage_resolver.resolve_hits(top_hits)
     return top_hits
 
 def my_best_hit_provider(filename, *xargs):
     """
-    takes a stream which may contain multiple hits, and yields just the "best" hit in each group, as determined by smallest evalue - assumes
-    the evalue is the second field 
+    takes a stream which may contain multiple hits, and yields just the "best" hit in each group, as determined by
+    a best_hit_selector (the second arg - see blast_results.py), which reads the columns it scores hits on in addition 
+    to the output columns. (The hits are scored as they are read, rather than collected and sorted). If there is a lineage
+    resolver, only the selected hits are resolved - unless the selector takes the LCA of tied hits, which needs the lineage 
+    of every hit
     """
-    groups = itertools.groupby(my_hit_provider(filename, *xargs), lambda x:x[0][0])    
-    #top_hits = (group.next() for (key, group) in groups)
-    top_hits = (sorted(group, cmp=lambda x,y:cmp(float(x[0][1]), float(y[0][1])))[0] for (key, group) in groups)
-
-    return top_hits
+    (weighting_method, lineage_resolver, selector) = xargs[0:3]
+    columns = list(xargs[3:])
+    output_length = len(columns)
+    if lineage_resolver is not None and selector.lca:
+        output_length = 1 + len(lineage_resolver.ranks)
+        return selector.select(my_hit_provider(filename, weighting_method, lineage_resolver, *(columns + selector.get_score_columns())), output_length)
+    best_hits = selector.select(my_hit_provider(filename, weighting_method, None, *(columns + selector.get_score_columns())), output_length)
+    if lineage_resolver is not None:
+        return lineage_resolver.resolve_hits(best_hits)
+    return best_hits
 
 
 
@@ -74,17 +80,78 @@ def my_spectrum_value_provider(interval_weight, *xargs):
     #print interval_weight
     return ((interval_weight[1],interval_weight[0][1],interval_weight[0][2]),)       
 
-def build_tax_distribution(datafile, weighting_method = None, column_numbers = [0,7,6]):
+def build_tax_distribution(datafile, weighting_method = None, column_numbers = [0,7,6], timing = False, split_processes = 1, top_hit_selector = None, lineage_resolver = None):
     distob = prism([datafile], 1)
     distob.file_to_stream_func = my_top_hit_provider
     #distob.DEBUG = True
-    distob.file_to_stream_func_xargs = [weighting_method] + column_numbers # i.e. pick out first field, then kingdom, comnames
+    if lineage_resolver is not None:
+        # kingdom and family are resolved from the taxid (or subject id) of each hit, rather than taken from the blast output 
+        column_numbers = column_numbers[0:1] + lineage_resolver.get_hit_columns()
+    distob.file_to_stream_func_xargs = [weighting_method, lineage_resolver] + column_numbers # i.e. pick out first field, then kingdom, comnames
+    if top_hit_selector is not None:
+        # the best rather than the first hit of each query is counted 
+        distob.file_to_stream_func = my_best_hit_provider
+        distob.file_to_stream_func_xargs = [weighting_method, lineage_resolver, top_hit_selector] + column_numbers
     distob.interval_locator_funcs = [bin_discrete_value, bin_discrete_value]
     distob.spectrum_value_provider_func = my_spectrum_value_provider
-    distdata = build(distob,"singlethread")
+
+    # optionally time the stages of the build (see prism_instrument.py)
+    instrument = None
+    if timing:
+        from prism_instrument import build_instrument
+        instrument = build_instrument(datafile, [datafile])
+        instrument.instrument_prism(distob)
+        instrument.start_stage("merge")
+    if split_processes > 1:
+        # the file is split into chunks which are parsed by a pool of processes
+        distdata = build_split_prism(distob, split_processes)
+    else:
+        distdata = build(distob,"singlethread")
+    if instrument is not None:
+        instrument.end_stage("merge")
+        instrument.restore_prism(distob)
+        instrument.start_stage("save")
     distob.save("%s.tax.pickle"%datafile)
+    if instrument is not None:
+        instrument.end_stage("save")
+        instrument.write("%s.tax.pickle"%datafile)
     return distdata
 
+def summarise_sample(sample_args):
+    """
+    worker method - builds the taxonomy distribution of a results file, and writes its kingdom and family summaries
+    """
+    (filename, weighting_method, timing, split_processes, top_hit_selector, lineage_resolver) = sample_args
+    tax_dist = build_tax_distribution(filename, weighting_method = weighting_method, timing = timing, split_processes = split_processes, top_hit_selector = top_hit_selector, \
+                                      lineage_resolver = lineage_resolver)
+    write_summaries(filename,tax_dist)
+    return tax_dist
+
+def summarise_samples(filenames, weighting_method = None, timing = False, num_processes = 1, split_results = False, top_hit_selector = None, lineage_resolver = None):
+    """
+    summarises each results file (see summarise_sample) - either serially, or in a pool of processes (the 
+    distributions are still listed in the order of the files). If split_results, the files are summarised 
+    one at a time, each split into chunks which are parsed by the pool of processes
+    """
+    if split_results:
+        for filename in filenames:
+            print summarise_sample((filename, weighting_method, timing, num_processes, top_hit_selector, lineage_resolver))
+        return
+
+    sample_args_list = [ (filename, weighting_method, timing, 1, top_hit_selector, lineage_resolver) for filename in filenames ]
+    if num_processes == 1 or len(filenames) < 2:
+        for sample_args in sample_args_list:
+            print summarise_sample(sample_args)
+        return
+
+    pool = Pool(min(num_processes, len(filenames)))
+    try:
+        for tax_dist in pool.imap(summarise_sample, sample_args_list):
+            print tax_dist
+    finally:
+        pool.close()
+        pool.join()
+
 def tax_cmp(x,y):
     ord=cmp(x[0],y[0])
     if ord == 0:
@@ -160,13 +227,16 @@ def write_summaries(basename,tax_dist):
 
 def debug(options):
     #test_iter = my_hit_provider(options["filenames"][0], *[None,0,7,6])
-    columns=["tag_count"] + options["column_numbers"] 
+    column_numbers = options["column_numbers"]
+    if options["lineage_resolver"] is not None:
+        column_numbers = column_numbers[0:1] + options["lineage_resolver"].get_hit_columns()
+    columns=["tag_count", options["lineage_resolver"]] + column_numbers 
     
     #test_iter = my_top_hit_provider(options["filenames"][0], *["tag_count",0,7,6])
     if options["top_hit_selection_method"] == "first": 
         test_iter = my_top_hit_provider(options["filenames"][0], *columns)
-    elif options["top_hit_selection_method"] == "best":
-        test_iter = my_best_hit_provider(options["filenames"][0], *columns)
+    elif options["top_hit_selector"] is not None:
+        test_iter = my_best_hit_provider(options["filenames"][0], *(columns[0:2] + [options["top_hit_selector"]] + columns[2:]))
     else:
         test_iter= my_hit_provider(options["filenames"][0], *columns)
 
@@ -190,6 +260,14 @@ def get_options():
 example :
 
 ./taxonomy_prism.py  /dataset/2023_illumina_sequencing_a/scratch/postprocessing/Salmon_mixed_runs.processed_in_progress/taxonomy_in_progress/Project_Salmon_HalfVol_ApeKI_Sample_SQ0031.list.nt_blastresults.txt.gz
+# summarise all the results files of a flowcell in one job, 16 files at a time
+./taxonomy_prism.py  --num_processes 16 --weighting_method tag_count /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/*.results.gz
+# summarise one large results file, split into chunks parsed by 16 processes
+./taxonomy_prism.py  --num_processes 16 --split_results /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/SQ0807.all.results.gz
+# summarise counting the hit with the smallest evalue (then largest % identity) for each query, or where several hits tie, their lowest common ancestor 
+./taxonomy_prism.py  --top_hit_selection_method combined --lca /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/*.results.gz
+# summarise by phylum and genus, resolved from the taxid (or accession) of each hit using a taxonomy index (see taxonomy_index.py)
+./taxonomy_prism.py  --taxonomy_index /dataset/gseq_processing/scratch/taxonomy_index --lineage_ranks phylum,genus /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/*.results.gz
 ./taxonomy_prism.py  --column_numbers 0,7,6 --summary_type dump_top_hits /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/qc314325-1_CCV91ANXX_4_807_X4.cnt.tag_count_unique.s.05m2T10_taggt2.fasta.blastn.nt.evalue1.0e10dust20641outfmt7qseqidsseqidpidentevaluestaxidssscinamesscomnamessskingdomsstitle.results
 ./taxonomy_prism.py   --summary_type dump_top_hits --top_hit_selection_method best /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/qc314325-1_CCV91ANXX_4_807_X4.cnt.tag_count_unique.s.05m2T10_taggt2.fasta.blastn.nt.evalue1.0e10dust20641outfmt7qseqidsseqidpidentevaluestaxidssscinamesscomnamessskingdomsstitle.results
 ./taxonomy_prism.py  --column_numbers 0,3,7,6  --summary_type dump_top_hits --top_hit_selection_method best /dataset/gseq_processing/scratch/gbs/181005_D00390_0407_BCCV91ANXX/SQ0807.all.PstI.PstI/annotation/qc314325-1_CCV91ANXX_4_807_X4.cnt.tag_count_unique.s.05m2T10_taggt2.fasta.blastn.nt.evalue1.0e10dust20641outfmt7qseqidsseqidpidentevaluestaxidssscinamesscomnamessskingdomsstitle.results
@@ -229,13 +307,54 @@ optionally, the query line can specify a weighting to be used as a count instead
     parser.add_argument('--rownames' , dest='rownames', default=False,action='store_true', help="combine kingdom and family fields to make a rowname")
     parser.add_argument('--weighting_method' , dest='weighting_method', default=None,choices=["tag_count"],help="weighting method")
     parser.add_argument('--column_numbers' , dest='column_numbers', default="0,7,6" ,help="column numbers to output")
-    parser.add_argument('--top_hit_selection_method' , dest='top_hit_selection_method', default="first",choices=["first", "best", "all"],help="top_hit_selection_method")
+    parser.add_argument('--top_hit_selection_method' , dest='top_hit_selection_method', default="first",choices=["first", "best", "all"] + SELECTION_CRITERIA,help="how the hit counted for each query is selected. first : the first hit (i.e. in blast's order). evalue (or best) : smallest evalue. bitscore : largest bit score. pident : largest %% identity. combined : smallest evalue, then largest bit score (if a bit score column is given), then largest %% identity. all : all hits (dump_top_hits only) (default first)")
+    parser.add_argument('--evalue_column' , dest='evalue_column', default=3, type=int, help="column number of the evalue (default 3)")
+    parser.add_argument('--bitscore_column' , dest='bitscore_column', default=None, type=int, help="column number of the bit score (default None - the default blast format has no bit score)")
+    parser.add_argument('--pident_column' , dest='pident_column', default=2, type=int, help="column number of the %% identity (default 2)")
+    parser.add_argument('--lca' , dest='lca', default=False,action='store_true', help="where several hits tie for best, count the lowest common ancestor of their lineages - i.e. the kingdom and family on which they all agree, with the others reported as Unresolved (requires a best hit selection method)")
+    parser.add_argument('--taxonomy_index' , dest='taxonomy_index', default=None, type=str, help="optionally, a taxonomy index (built by taxonomy_index.py), used to resolve the taxid of each hit (or the accession of its subject id, if it has no taxid) to its lineage - the kingdom and family are then the names at the lineage_ranks, rather than the blast super kingdom and common name columns")
+    parser.add_argument('--lineage_ranks' , dest='lineage_ranks', default="superkingdom,family", type=str, help="(taxonomy_index) the two ranks summarised as kingdom and family (default superkingdom,family)")
+    parser.add_argument('--taxid_column' , dest='taxid_column', default=4, type=int, help="(taxonomy_index) column number of the subject tax ids (default 4)")
+    parser.add_argument('--accession_column' , dest='accession_column', default=1, type=int, help="(taxonomy_index) column number of the subject id (default 1)")
+    parser.add_argument('--timing' , dest='timing', default=False,action='store_true', help="time the stages of each build (parse, count, merge, save), writing the timing as a json file next to the pickle, and a summary line to the log")
+    parser.add_argument('--num_processes' , dest='num_processes', default=1, type=int, help="number of processes used to summarise the input files (sample_summaries) - each file is summarised by one process, unless split_results (default 1)")
+    parser.add_argument('--split_results' , dest='split_results', default=False,action='store_true', help="(sample_summaries) summarise the input files one at a time, splitting each (at query boundaries) into chunks which are parsed by num_processes processes - for large results files. The summaries are identical to those built by one process")
 
 
     args = vars(parser.parse_args())
 
     args["column_numbers"] =  [int(item) for item in re.split(",", args["column_numbers"])]
 
+    if args["num_processes"] < 1:
+        parser.error("num_processes must be at least 1")
+
+    # set up best hit selection 
+    args["top_hit_selector"] = None
+    if args["top_hit_selection_method"] == "best":
+        args["top_hit_selection_method"] = "evalue"
+    if args["top_hit_selection_method"] in SELECTION_CRITERIA:
+        try:
+            args["top_hit_selector"] = best_hit_selector(args["top_hit_selection_method"], args["evalue_column"], args["bitscore_column"], args["pident_column"], args["lca"])
+        except Exception, e:
+            parser.error(str(e))
+    elif args["lca"]:
+        parser.error("lca requires a best hit selection method (%s)"%", ".join(SELECTION_CRITERIA))
+    if args["top_hit_selection_method"] == "all" and args["summary_type"] == "sample_summaries":
+        parser.error("all hits can only be dumped (dump_top_hits)")
+
+    # set up lineage resolution 
+    args["lineage_resolver"] = None
+    if args["taxonomy_index"] is not None:
+        lineage_ranks = [ rank.strip() for rank in re.split(",", args["lineage_ranks"]) if len(rank.strip()) > 0 ]
+        if len(lineage_ranks) != 2:
+            parser.error("lineage_ranks must be two ranks (summarised as kingdom and family)")
+        from taxonomy_index import lineage_resolver
+        try:
+            args["lineage_resolver"] = lineage_resolver(args["taxonomy_index"], lineage_ranks, args["taxid_column"], args["accession_column"])
+            args["lineage_resolver"].get_index()
+        except Exception, e:
+            parser.error(str(e))
+
     
     return args
 
@@ -253,10 +372,8 @@ def main():
     #debug(args)
 
     if args["summary_type"] == "sample_summaries" :
-        for filename in  args["filenames"]:
-            tax_dist = build_tax_distribution(filename, weighting_method = args["weighting_method"])
-            print tax_dist
-            write_summaries(filename,tax_dist)
+        summarise_samples(args["filenames"], weighting_method = args["weighting_method"], timing = args["timing"], num_processes = args["num_processes"], \
+                          split_results = args["split_results"], top_hit_selector = args["top_hit_selector"], lineage_resolver = args["lineage_resolver"])
     elif args["summary_type"] == "dump_top_hits" :
         debug(args)
     elif args["summary_type"] == "summary_table" :
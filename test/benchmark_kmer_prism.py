@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import re
+import gzip
+import json
+import time
+import socket
+import resource
+import tempfile
+import itertools
+import subprocess
+import shutil
+import argparse
+from random import Random
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = os.path.join(REPO_DIR, "test")
+
+class benchmark_exception(Exception):
+    def __init__(self,args=None):
+        super(benchmark_exception, self).__init__(args)
+
+#********************************************************************
+# synthetic inputs. Reads are random sequence, with a fraction of reads
+# starting with an adapter (so that some kmers are much more frequent
+# than others) and the odd N. Inputs are generated once per size, with
+# a fixed seed, and re-used by all the cases
+#********************************************************************
+
+SYNTHETIC_READ_LENGTH = 100
+SYNTHETIC_ADAPTER = "AGATCGGAAGAGCGGTTCAGCAGGAATGCCGAG"
+SYNTHETIC_ADAPTER_RATE = 0.1
+SYNTHETIC_N_RATE = 0.001
+SYNTHETIC_SEED = 1
+
+def get_synthetic_reads(read_count, seed=SYNTHETIC_SEED):
+    """
+    yields read_count random reads
+    """
+    rng = Random(seed)
+    for read_number in range(read_count):
+        read = "".join(rng.choice("ACGT") for i in range(SYNTHETIC_READ_LENGTH))
+        if rng.random() < SYNTHETIC_ADAPTER_RATE:
+            read = SYNTHETIC_ADAPTER + read[len(SYNTHETIC_ADAPTER):]
+        if rng.random() < SYNTHETIC_N_RATE * SYNTHETIC_READ_LENGTH:
+            position = rng.randrange(SYNTHETIC_READ_LENGTH)
+            read = read[:position] + "N" + read[position+1:]
+        yield read
+
+def write_synthetic_fastq(filename, read_count):
+    with gzip.open(filename, "wb") as fastq:
+        for (read_number, read) in enumerate(get_synthetic_reads(read_count)):
+            fastq.write(("@read_%d\n%s\n+\n%s\n"%(read_number, read, "I" * len(read))).encode("ascii"))
+
+def write_synthetic_fasta(filename, read_count, weighted=False):
+    """
+    writes a fasta file of reads - if weighted, each read is marked up with a count, as in fasta files made from tag counts
+    """
+    rng = Random(SYNTHETIC_SEED + 1)
+    with open(filename, "w") as fasta:
+        for (read_number, read) in enumerate(get_synthetic_reads(read_count)):
+            if weighted:
+                fasta.write(">read_%d count=%d\n%s\n"%(read_number, 1 + int(rng.expovariate(0.2)), read))
+            else:
+                fasta.write(">read_%d\n%s\n"%(read_number, read))
+
+def get_synthetic_tags(tag_count):
+    """
+    yields (tag, tag length, count) tuples - tags start with the TGCA cut site, and are padded with poly-A to 64 bases
+    """
+    rng = Random(SYNTHETIC_SEED + 2)
+    for read in get_synthetic_reads(tag_count):
+        tag_length = rng.randrange(40, 65)
+        tag = "TGCA" + read[4:tag_length]
+        yield (tag + "A" * (64 - tag_length), tag_length, 1 + int(rng.expovariate(0.2)))
+
+def write_synthetic_tag_counts(filename, tag_count):
+    """
+    writes the text listing of a tassel tag count file - these are read with a driver script that just lists the 
+    file (see get_tag_count_driver)
+    """
+    with open(filename, "w") as tags:
+        for tag_tuple in get_synthetic_tags(tag_count):
+            tags.write("%s\t%d\t%d\n"%tag_tuple)
+
+def get_tag_count_driver(workdir):
+    """
+    returns a driver script (see kmer_prism.py -x) which lists a synthetic tag count file
+    """
+    driver = os.path.join(workdir, "cat_synthetic_tag_count.sh")
+    if not os.path.exists(driver):
+        with open(driver, "w") as driver_file:
+            driver_file.write("#!/bin/sh\ncat \"$1\"\n")
+        os.chmod(driver, 0o755)
+    return driver
+
+def get_synthetic_inputs(workdir, sizes, input_types):
+    """
+    returns a list of input dicts (name, filename, type, reads, bases, and kmer_prism.py arguments needed to read the input)
+    """
+    inputs = []
+    for (read_count, input_type) in itertools.product(sizes, input_types):
+        name = "synthetic_%s_%d"%(input_type, read_count)
+        input_args = []
+        bases = read_count * SYNTHETIC_READ_LENGTH
+        if input_type == "fastq":
+            filename = os.path.join(workdir, "%s.fastq.gz"%name)
+            writer = lambda filename : write_synthetic_fastq(filename, read_count)
+        elif input_type == "fasta":
+            filename = os.path.join(workdir, "%s.fasta"%name)
+            writer = lambda filename : write_synthetic_fasta(filename, read_count)
+        elif input_type == "weighted_fasta":
+            filename = os.path.join(workdir, "%s.fasta"%name)
+            writer = lambda filename : write_synthetic_fasta(filename, read_count, weighted=True)
+            input_args = ["--weighting_method", "tag_count"]
+        elif input_type == "cnt":
+            filename = os.path.join(workdir, "%s.cnt"%name)
+            writer = lambda filename : write_synthetic_tag_counts(filename, read_count)
+            input_args = ["-x", get_tag_count_driver(workdir)]
+            bases = sum( tag_length for (tag, tag_length, tag_count) in get_synthetic_tags(read_count) )
+        else:
+            raise benchmark_exception("unknown synthetic input type %s"%input_type)
+        if not os.path.exists(filename):
+            print("generating %s"%filename)
+            writer(filename)
+        inputs.append({"name" : name, "filename" : filename, "type" : input_type, "reads" : read_count, "bases" : bases, \
+                       "input_args" : input_args})
+    return inputs
+
+def get_file_input(filename, input_driver_config=None):
+    """
+    returns an input dict for an existing file (e.g. the test data), counting its reads (or tags) and bases
+    """
+    sys.path.insert(0, REPO_DIR)
+    import kmer_prism
+    input_args = []
+    if filename.endswith(".cnt"):
+        if input_driver_config is None:
+            raise benchmark_exception("tag count file %s needs an input driver config (--input_driver_config)"%filename)
+        input_args = ["-x", input_driver_config]
+        (reads, bases) = (0, 0)
+        for (tag, tag_count) in kmer_prism.tag_count_from_tag_count_file(filename, input_driver_config, None):
+            reads += 1
+            bases += len(tag)
+    else:
+        (reads, bases) = (0, 0)
+        for record in kmer_prism.seq_from_sequence_file(filename, kmer_prism.get_file_type(filename), None, "raw", False):
+            reads += 1
+            bases += len(record.seq)
+    name = re.sub("\\.(fastq|fq|fasta|fa|cnt)(\\.gz)?$", "", os.path.basename(filename))
+    return {"name" : name, "filename" : os.path.abspath(filename), "type" : "file", "reads" : reads, "bases" : bases, "input_args" : input_args}
+
+#********************************************************************
+# cases. Each case is a kmer_prism.py command line, run in a fresh
+# process (so that its peak memory is its own) with a fresh build folder
+# (so that no cached spectra are re-used). The child process times the
+# build and summary stages separately, and writes its results as json
+#********************************************************************
+
+def get_cases(inputs, kmer_sizes, engines, process_counts, sampling_proportions, summary_type):
+    cases = []
+    for (benchmark_input, kmer_size, engine, num_processes, sampling_proportion) in itertools.product(inputs, kmer_sizes, engines, process_counts, sampling_proportions):
+        args = ["-t", summary_type, "-k", str(kmer_size), "-e", engine, "-p", str(num_processes)] + benchmark_input["input_args"]
+        if sampling_proportion is not None:
+            args += ["-s", str(sampling_proportion), "--sampling_seed", "1"]
+        weighting_method = "tag_count" if "--weighting_method" in benchmark_input["input_args"] else None
+        name = "%s.k%d.%s.p%d.s%s"%(benchmark_input["name"], kmer_size, engine, num_processes, "all" if sampling_proportion is None else sampling_proportion)
+        cases.append({"name" : name, "input" : benchmark_input["name"], "input_type" : benchmark_input["type"], "reads" : benchmark_input["reads"], \
+                      "bases" : benchmark_input["bases"], "kmer_size" : kmer_size, "engine" : engine, "num_processes" : num_processes, \
+                      "sampling_proportion" : sampling_proportion, "weighting_method" : weighting_method, "summary_type" : summary_type, \
+                      "args" : args, "filename" : benchmark_input["filename"]})
+    return cases
+
+def get_peak_rss_mb():
+    """
+    returns the peak resident memory (MB) of this process and its (waited for) children, e.g. pool workers
+    """
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        return peak_rss / (1024.0 * 1024.0)   # bytes
+    return peak_rss / 1024.0                   # KB
+
+def run_case_in_process(case, builddir, result_filename):
+    """
+    (child process) runs the build and summary of a case, and writes the timings to result_filename
+    """
+    sys.path.insert(0, REPO_DIR)
+    import kmer_prism
+    output_filename = os.path.join(builddir, "summary.txt")
+    sys.argv = ["kmer_prism.py"] + case["args"] + ["-b", builddir, "-o", output_filename, case["filename"]]
+    options = kmer_prism.get_options()
+
+    start_time = time.time()
+    distributions = kmer_prism.build_kmer_spectra(options)
+    build_time = time.time()
+    kmer_prism.summarise_spectra(distributions, options)
+    summary_time = time.time()
+
+    with open(result_filename, "w") as result_file:
+        json.dump({"build_seconds" : build_time - start_time, "summary_seconds" : summary_time - build_time, "peak_rss_mb" : get_peak_rss_mb()}, result_file)
+
+def run_case(case, workdir, python):
+    """
+    runs a case in a child process, and returns its results
+    """
+    builddir = tempfile.mkdtemp(prefix="benchmark_", dir=workdir)
+    result_filename = os.path.join(builddir, "result.json")
+    log_filename = os.path.join(builddir, "kmer_prism.log")
+    try:
+        start_time = time.time()
+        with open(log_filename, "w") as log:
+            returncode = subprocess.call([python, os.path.abspath(__file__), "--run_case", json.dumps(case), "--builddir", builddir, \
+                                          "--result_file", result_filename], stdout=log, stderr=subprocess.STDOUT)
+        wall_seconds = time.time() - start_time
+        result = dict(case)
+        del result["args"]
+        del result["filename"]
+        if returncode != 0:
+            with open(log_filename, "r") as log:
+                result.update({"error" : "returncode %d : %s"%(returncode, log.read()[-2000:])})
+            return result
+        with open(result_filename, "r") as result_file:
+            result.update(json.load(result_file))
+        result.update({"wall_seconds" : wall_seconds, "reads_per_second" : case["reads"] / max(wall_seconds, 1e-9), \
+                       "bases_per_second" : case["bases"] / max(wall_seconds, 1e-9)})
+        return result
+    finally:
+        shutil.rmtree(builddir, ignore_errors=True)
+
+def get_run_info(python):
+    """
+    returns details of the run (recorded with each result, so that runs can be compared)
+    """
+    commit = None
+    try:
+        commit = subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], stderr=open(os.devnull, "w")).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    python_version = subprocess.check_output([python, "-c", "import sys; print('%d.%d.%d'%sys.version_info[0:3])"]).decode("ascii").strip()
+    return {"commit" : commit, "host" : socket.gethostname(), "python" : python_version, "cpu_count" : os.sysconf("SC_NPROCESSORS_ONLN"), \
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+#********************************************************************
+# comparison of runs
+#********************************************************************
+
+def read_results(results_filename):
+    with open(results_filename, "r") as results_file:
+        return [ json.loads(record) for record in results_file if len(record.strip()) > 0 ]
+
+def compare_results(baseline_results, results, outfile):
+    """
+    prints the speedup (ratio of wall times) and memory ratio of each case in results against the same case in the baseline
+    """
+    baseline = dict((result["name"], result) for result in baseline_results if "error" not in result)
+    print("case\tbaseline_wall_seconds\twall_seconds\tspeedup\tbaseline_peak_rss_mb\tpeak_rss_mb\tmemory_ratio", file=outfile)
+    for result in results:
+        if result["name"] not in baseline or "error" in result:
+            continue
+        before = baseline[result["name"]]
+        print("%s\t%.3f\t%.3f\t%.2f\t%.1f\t%.1f\t%.2f"%(result["name"], before["wall_seconds"], result["wall_seconds"], before["wall_seconds"] / max(result["wall_seconds"], 1e-9), \
+                                                        before["peak_rss_mb"], result["peak_rss_mb"], result["peak_rss_mb"] / max(before["peak_rss_mb"], 1e-9)), file=outfile)
+
+def get_list(list_string, item_type):
+    return [ None if item.lower() == "none" else item_type(item) for item in list_string.split(",") ]
+
+def get_options():
+    description = """
+    This script benchmarks kmer_prism.py - it runs the build and summary of kmer spectra over the test data and over synthetic
+    fasta, fastq and tag count inputs of several sizes, for combinations of kmer size, counting engine, number of processes and
+    sampling proportion (and weighting method, via the weighted fasta input). Each case is run in a fresh process with a fresh build
+    folder, and the results (reads/sec, bases/sec, peak RSS, and wall, build and summary times) are written as one json record per case,
+    so that runs can be compared (--compare)
+    """
+    long_description = """
+examples :
+
+# default suite, results to benchmark.jsonl
+test/benchmark_kmer_prism.py -o benchmark.jsonl
+
+# a quick run at one size, then compare with an earlier run
+test/benchmark_kmer_prism.py --sizes 20000 --kmer_sizes 6 --process_counts 1 -o after.jsonl --compare before.jsonl
+
+# include a real tag count file, read with a tassel driver script
+test/benchmark_kmer_prism.py --input_files /dataset/.../G88687_C6JURANXX_1_124_X4.cnt --input_driver_config cat_tag_count.sh -o benchmark.jsonl
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output_filename' , dest='output_filename', default=None, type=str, help="file to append json results to (default standard output)")
+    parser.add_argument('-w', '--workdir' , dest='workdir', default=None, type=str, help="folder for synthetic inputs and build folders (default a temporary folder, removed afterwards)")
+    parser.add_argument('--sizes' , dest='sizes', default="10000,100000", type=str, help="comma separated numbers of reads (or tags) of synthetic inputs (default 10000,100000)")
+    parser.add_argument('--input_types' , dest='input_types', default="fastq,fasta,weighted_fasta,cnt", type=str, help="comma separated synthetic input types (default fastq,fasta,weighted_fasta,cnt)")
+    parser.add_argument('--input_files' , dest='input_files', default=os.path.join(TEST_DIR, "T867.fastq.gz"), type=str, help="comma separated real input files (default test/T867.fastq.gz)")
+    parser.add_argument('--input_driver_config' , dest='input_driver_config', default=None, type=str, help="driver script for real tag count (.cnt) input files")
+    parser.add_argument('--kmer_sizes' , dest='kmer_sizes', default="6,12", type=str, help="comma separated kmer sizes (default 6,12)")
+    parser.add_argument('--engines' , dest='engines', default="string,packed", type=str, help="comma separated counting engines (default string,packed)")
+    parser.add_argument('--process_counts' , dest='process_counts', default="1,4", type=str, help="comma separated numbers of processes (default 1,4)")
+    parser.add_argument('--sampling_proportions' , dest='sampling_proportions', default="none,0.1", type=str, help="comma separated sampling proportions - none means all records (default none,0.1)")
+    parser.add_argument('-t', '--summary_type' , dest='summary_type', default="zipfian", choices=["frequency", "entropy", "ranks", "zipfian"], help="summary type (default zipfian)")
+    parser.add_argument('--python' , dest='python', default=sys.executable, type=str, help="python interpreter to run kmer_prism.py with (default this one)")
+    parser.add_argument('--compare' , dest='compare', default=None, type=str, help="optionally compare the results with those of an earlier run (a json results file)")
+    parser.add_argument('--run_case' , dest='run_case', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--builddir' , dest='builddir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file' , dest='result_file', default=None, help=argparse.SUPPRESS)
+
+    args = vars(parser.parse_args())
+    if args["run_case"] is None:
+        try:
+            args["sizes"] = get_list(args["sizes"], int)
+            args["kmer_sizes"] = get_list(args["kmer_sizes"], int)
+            args["process_counts"] = get_list(args["process_counts"], int)
+            args["sampling_proportions"] = get_list(args["sampling_proportions"], float)
+        except ValueError as e:
+            parser.error("could not parse list option (%s)"%str(e))
+        args["input_types"] = [ input_type for input_type in args["input_types"].split(",") if len(input_type) > 0 ]
+        args["input_files"] = [ input_file for input_file in args["input_files"].split(",") if len(input_file) > 0 ]
+        args["engines"] = args["engines"].split(",")
+        for input_file in args["input_files"]:
+            if not os.path.isfile(input_file):
+                parser.error("could not find %s"%input_file)
+    return args
+
+def main():
+    options = get_options()
+
+    if options["run_case"] is not None:
+        run_case_in_process(json.loads(options["run_case"]), options["builddir"], options["result_file"])
+        return
+
+    workdir = options["workdir"]
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="kmer_prism_benchmark_")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    try:
+        inputs = [ get_file_input(input_file, options["input_driver_config"]) for input_file in options["input_files"] ]
+        inputs += get_synthetic_inputs(workdir, options["sizes"], options["input_types"])
+        cases = get_cases(inputs, options["kmer_sizes"], options["engines"], options["process_counts"], options["sampling_proportions"], options["summary_type"])
+        run_info = get_run_info(options["python"])
+
+        outfile = sys.stdout
+        if options["output_filename"] is not None:
+            outfile = open(options["output_filename"], "a")
+        results = []
+        for (case_number, case) in enumerate(cases):
+            print("(%d/%d) %s"%(case_number + 1, len(cases), case["name"]), file=sys.stderr)
+            result = run_case(case, workdir, options["python"])
+            result.update(run_info)
+            results.append(result)
+            print(json.dumps(result, sort_keys=True), file=outfile)
+            outfile.flush()
+            if "error" in result:
+                print("  failed : %s"%result["error"], file=sys.stderr)
+            else:
+                print("  %.2fs, %.0f reads/sec, %.0f bases/sec, peak RSS %.1f MB"%(result["wall_seconds"], result["reads_per_second"], result["bases_per_second"], result["peak_rss_mb"]), file=sys.stderr)
+        if outfile is not sys.stdout:
+            outfile.close()
+
+        if options["compare"] is not None:
+            compare_results(read_results(options["compare"]), results, sys.stderr)
+    finally:
+        if options["workdir"] is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# behavioural tests for blast_results.py, using a small hand-made blast results file (-outfmt 7, with
+# custom fields). Run from the repository (or test) folder using
+#
+# python -m pytest -q test
+#
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import blast_results
+
+# fields : query id, subject id, % identity, evalue, bit score, kingdom, family
+TEST_RESULTS = """# BLASTN 2.6.0+
+# Query: q1 count=3
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, kingdom, family
+# 3 hits found
+q1	s1	99.0	1e-30	120	Bacteria	Enterobacteriaceae
+q1	s2	98.0	1e-30	125	Bacteria	Vibrionaceae
+q1	s3	100.0	1e-10	80	Eukaryota	Bovidae
+# BLASTN 2.6.0+
+# Query: q2 count=5
+# Database: /data/blast/nt.fasta
+# 0 hits found
+# BLASTN 2.6.0+
+# Query: q3 count=1.5
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, kingdom, family
+# 3 hits found
+q3	s4	97.0	1e-20	100	Bacteria	Enterobacteriaceae
+q3	s5	97.0	1e-20	100	Bacteria	Enterobacteriaceae
+q3	s6	97.0	1e-20	100	Bacteria	Pasteurellaceae
+# BLASTN 2.6.0+
+# Query: q4
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, kingdom, family
+# 1 hits found
+q4	s7
+# BLAST processed 4 queries
+"""
+
+OUTPUT_COLUMNS = [0, 5, 6]
+(PIDENT_COLUMN, EVALUE_COLUMN, BITSCORE_COLUMN) = (2, 3, 4)
+
+class results_file(object):
+    """
+    writes the test results to a temporary file
+    """
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "test.results")
+        with open(self.filename, "w") as results:
+            results.write(TEST_RESULTS)
+        return self.filename
+    def __exit__(self, *args):
+        shutil.rmtree(self.tempdir)
+
+#********************************************************************
+# parser
+#********************************************************************
+def test_query_blocks():
+    with results_file() as filename:
+        blocks = list(blast_results.query_blocks_from_file(filename, OUTPUT_COLUMNS, "tag_count"))
+    assert [ block.query for block in blocks ] == ["q1 count=3", "q2 count=5", "q3 count=1.5", "q4"]
+    assert [ block.database for block in blocks ] == 4 * ["/data/blast/nt.fasta"]
+    assert [ block.weight for block in blocks ] == [3.0, 5.0, 1.5, 1]
+    assert [ block.no_hits for block in blocks ] == [False, True, False, False]
+    assert blocks[0].hits == [("q1", "Bacteria", "Enterobacteriaceae"), ("q1", "Bacteria", "Vibrionaceae"), ("q1", "Eukaryota", "Bovidae")]
+    assert blocks[1].hits == []
+    assert blocks[2].hits == [("q3", "Bacteria", "Enterobacteriaceae"), ("q3", "Bacteria", "Enterobacteriaceae"), ("q3", "Bacteria", "Pasteurellaceae")]
+    assert blocks[3].hits == [("q4", None, None)]    # missing columns
+
+def test_unweighted_query_blocks():
+    with results_file() as filename:
+        blocks = list(blast_results.query_blocks_from_file(filename, [1], default_weight=2))
+    assert [ block.weight for block in blocks ] == [2, 2, 2, 2]
+    assert blocks[0].hits == [("s1",), ("s2",), ("s3",)]
+
+def test_chunks_parse_as_whole_file():
+    with results_file() as filename:
+        whole_file_blocks = list(blast_results.query_blocks_from_file(filename, OUTPUT_COLUMNS))
+        for num_chunks in (1, 2, 3, 10):
+            chunk_blocks = []
+            for chunk in blast_results.get_file_chunks(filename, num_chunks):
+                chunk_blocks += list(blast_results.query_blocks_from_file(chunk, OUTPUT_COLUMNS))
+            assert chunk_blocks == whole_file_blocks, "%d chunks"%num_chunks
+
+#********************************************************************
+# best hit selection, optionally with the LCA of tied hits
+#********************************************************************
+def get_selected_hits(criterion, lca=False):
+    selector = blast_results.best_hit_selector(criterion, evalue_column=EVALUE_COLUMN, bitscore_column=BITSCORE_COLUMN, pident_column=PIDENT_COLUMN, lca=lca)
+    with results_file() as filename:
+        items = []
+        for block in blast_results.query_blocks_from_file(filename, OUTPUT_COLUMNS + selector.get_score_columns(), "tag_count"):
+            if block.no_hits:
+                items.append(((block.query.split()[0], "No hits", "No hits"), block.weight))
+            items += [ (hit, block.weight) for hit in block.hits ]
+        return list(selector.select(items, len(OUTPUT_COLUMNS)))
+
+def test_best_hit_selection():
+    no_hits = [(("q2", "No hits", "No hits"), 5.0)]
+    unscored = [(("q4", None, None), 1)]
+    assert get_selected_hits("evalue") == [(("q1", "Bacteria", "Enterobacteriaceae"), 3.0)] + no_hits + \
+                                         [(("q3", "Bacteria", "Enterobacteriaceae"), 1.5)] + unscored
+    assert get_selected_hits("bitscore")[0] == (("q1", "Bacteria", "Vibrionaceae"), 3.0)
+    assert get_selected_hits("pident")[0] == (("q1", "Eukaryota", "Bovidae"), 3.0)
+    assert get_selected_hits("combined")[0] == (("q1", "Bacteria", "Vibrionaceae"), 3.0)
+
+def test_best_hit_lca():
+    no_hits = [(("q2", "No hits", "No hits"), 5.0)]
+    unscored = [(("q4", blast_results.LCA_UNRESOLVED, blast_results.LCA_UNRESOLVED), 1)]    # (missing ranks are unresolved)
+    assert get_selected_hits("evalue", lca=True) == [(("q1", "Bacteria", blast_results.LCA_UNRESOLVED), 3.0)] + no_hits + \
+                                                   [(("q3", "Bacteria", blast_results.LCA_UNRESOLVED), 1.5)] + unscored
+    # the bit score breaks the q1 tie, but not the q3 one
+    assert get_selected_hits("combined", lca=True) == [(("q1", "Bacteria", "Vibrionaceae"), 3.0)] + no_hits + \
+                                                     [(("q3", "Bacteria", blast_results.LCA_UNRESOLVED), 1.5)] + unscored
+
+def test_common_lineage():
+    assert blast_results.get_common_lineage(["Bacteria", "Vibrionaceae"], ("Bacteria", "Vibrionaceae")) == ["Bacteria", "Vibrionaceae"]
+    assert blast_results.get_common_lineage(["Bacteria", "Vibrionaceae"], ("Bacteria", "Bovidae")) == ["Bacteria", None]
+    assert blast_results.get_common_lineage(["Bacteria", "Vibrionaceae"], ("Eukaryota", "Vibrionaceae")) == [None, None]
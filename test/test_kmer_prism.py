@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+#
+# behavioural tests for kmer_prism.py - each of the faster paths is checked against the reference
+# path it replaces. Run from the repository (or test) folder using
+#
+# python -m pytest -q test
+#
+from __future__ import print_function
+import os
+import sys
+import re
+import gzip
+import glob
+import shutil
+import subprocess
+import tempfile
+from random import Random
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = os.path.join(REPO_DIR, "test")
+sys.path.insert(0, REPO_DIR)
+
+import kmer_prism
+
+T867_FASTQ = os.path.join(TEST_DIR, "T867.fastq.gz")
+
+def get_random_sequence(rng, length):
+    return "".join(rng.choice("ACGT") for i in range(length))
+
+def write_test_fasta(filename, rng, record_count, line_length=60):
+    """
+    writes a wrapped fasta file of records of very different lengths (some much longer than a
+    read block, so that a record spans many blocks)
+    """
+    with open(filename, "w") as fasta:
+        for record_number in range(record_count):
+            sequence = get_random_sequence(rng, rng.choice([5, 50, 500, 5000]))
+            fasta.write(">contig_%d\n"%record_number)
+            for start in range(0, len(sequence), line_length):
+                fasta.write(sequence[start:start + line_length] + "\n")
+
+def write_test_fastq(filename, rng, record_count):
+    """
+    writes a fastq file in which quality lines often start with @
+    """
+    with open(filename, "w") as fastq:
+        for record_number in range(record_count):
+            sequence = get_random_sequence(rng, rng.randint(1, 300))
+            quality = "".join(rng.choice("@@@+IJ#") for base in sequence)
+            fastq.write("@read_%d\n%s\n+\n%s\n"%(record_number, sequence, quality))
+
+def get_whole_file_records(datafile, filetype):
+    return list(kmer_prism.RAW_RECORD_FILETYPES[filetype](kmer_prism.raw_lines_from_file(datafile), True, datafile))
+
+def get_partitioned_records(datafile, filetype, num_partitions):
+    records = []
+    for partition in kmer_prism.get_file_partitions(datafile, num_partitions):
+        records += list(kmer_prism.get_partition_records(datafile, filetype, partition, None, True))
+    return records
+
+def get_test_records(rng, record_count):
+    """
+    returns raw records of random sequence, with some repeats (so that overlapping kmers occur), Ns and soft-masked (lower case) bases
+    """
+    records = []
+    for record_number in range(record_count):
+        sequence = get_random_sequence(rng, rng.randint(0, 120))
+        if rng.random() < 0.3:
+            sequence = sequence[:20] + rng.choice("ACGT") * rng.randint(5, 15) + sequence[20:]
+        if rng.random() < 0.2:
+            sequence = sequence.replace(rng.choice("ACGT"), "N", 1)
+        if rng.random() < 0.1:
+            sequence = sequence[:10] + sequence[10:20].lower() + sequence[20:]
+        records.append(kmer_prism.raw_sequence_record(sequence.encode("ascii"), None))
+    return records
+
+def add_kmer_counts(kmer_counts, kmer_count_iter):
+    for (count, kmer) in kmer_count_iter:
+        kmer_counts[kmer] = count + kmer_counts.get(kmer, 0)
+    return kmer_counts
+
+#********************************************************************
+# raw record reader - gives the same sequences and descriptions as
+# Bio.SeqIO
+#********************************************************************
+def get_sequences_and_descriptions(datafile, filetype, record_reader):
+    return [ (kmer_prism.get_sequence_string(record), record.description) for record in \
+             kmer_prism.seq_from_sequence_file(datafile, filetype, None, record_reader, True) ]
+
+def test_raw_reader_matches_seqio_fastq():
+    raw_records = get_sequences_and_descriptions(T867_FASTQ, "fastq", "raw")
+    assert len(raw_records) > 0
+    assert raw_records == get_sequences_and_descriptions(T867_FASTQ, "fastq", "biopython")
+
+def test_raw_reader_matches_seqio_fasta():
+    tempdir = tempfile.mkdtemp()
+    try:
+        fasta_file = os.path.join(tempdir, "contigs.fa")
+        write_test_fasta(fasta_file, Random(3), 40)
+        for datafile in (fasta_file, fasta_file + ".gz"):
+            if datafile.endswith(".gz"):
+                with open(fasta_file, "rb") as plain:
+                    with gzip.open(datafile, "wb") as compressed:
+                        compressed.write(plain.read())
+            assert get_sequences_and_descriptions(datafile, "fasta", "raw") == get_sequences_and_descriptions(datafile, "fasta", "biopython")
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# sampling - skip-ahead sampling in the raw reader picks the same records
+# as sampling the records read by Bio.SeqIO, and reservoir sampling 
+# gives a uniform sample of at least the minimum size
+#********************************************************************
+def test_skip_ahead_sample_matches_seqio_sample():
+    for sampling_proportion in (0.01, 0.3, 1):
+        sampler = kmer_prism.get_record_sampler(sampling_proportion, seed=17)
+        raw_sample = [ (kmer_prism.get_sequence_string(record), record.description) for record in \
+                       kmer_prism.seq_from_sequence_file(T867_FASTQ, "fastq", sampling_proportion, "raw", True, sampler) ]
+        seqio_sample = [ (kmer_prism.get_sequence_string(record), record.description) for record in \
+                         kmer_prism.seq_from_sequence_file(T867_FASTQ, "fastq", sampling_proportion, "biopython", True, sampler) ]
+        assert len(raw_sample) > 0
+        assert raw_sample == seqio_sample
+
+def test_skip_ahead_sample_proportion():
+    records = list(range(20000))
+    sample = list(kmer_prism.get_record_sampler(0.1, seed=3).sample(records))
+    assert sample == sorted(set(sample))
+    assert abs(len(sample) - 2000) < 200
+    assert list(kmer_prism.get_record_sampler(1, seed=3).sample(records)) == records
+    assert list(kmer_prism.get_record_sampler(0, seed=3).sample(records)) == []
+    assert sample == list(kmer_prism.get_record_sampler(0.1, seed=3).sample(records))
+
+def test_reservoir_sample():
+    records = list(range(20))
+    # the proportional sample is too small, so a uniform sample of the minimum size is taken
+    index_counts = dict((record, 0) for record in records)
+    for seed in range(4000):
+        sample = list(kmer_prism.get_record_sampler(0.0001, minimum_sample_size=5, seed=seed).sample(records))
+        assert len(sample) == 5 and len(set(sample)) == 5
+        for record in sample:
+            index_counts[record] += 1
+    assert min(index_counts.values()) > 850 and max(index_counts.values()) < 1150    # each record is expected 1000 times
+    # the proportional sample is big enough, so is used as it is 
+    assert list(kmer_prism.get_record_sampler(1, minimum_sample_size=5, seed=1).sample(records)) == records
+    # fewer records than the minimum sample size - all are sampled
+    assert sorted(kmer_prism.get_record_sampler(0.0001, minimum_sample_size=50, seed=1).sample(records)) == records
+
+#********************************************************************
+# packed kmer counting - the packed engine gives the same spectrum 
+# as the string engine
+#********************************************************************
+def test_packed_counts_match_string_counts():
+    records = get_test_records(Random(1), 400)
+    for kmer_size in (1, 2, 6, [1, 3]):
+        for reverse_complement in (False, True):
+            string_counts = {}
+            for record in records:
+                add_kmer_counts(string_counts, kmer_prism.kmer_count_from_sequence(record, reverse_complement, kmer_size, 1))
+            packed_counts = {}
+            for batch in kmer_prism.get_batch_iter(records, 37):
+                add_kmer_counts(packed_counts, kmer_prism.kmer_count_from_sequence_batch(batch, reverse_complement, kmer_size, 1, False, False))
+            assert packed_counts == string_counts, "kmer size %s"%str(kmer_size)
+
+#********************************************************************
+# motif counting - the automaton counts each literal / IUPAC pattern 
+# as the regular expression search for it does
+#********************************************************************
+def get_motif_regexp(pattern):
+    return "".join( "[%s]"%"".join(kmer_prism.IUPAC_CODES[letter]) for letter in pattern )
+
+def test_motif_automaton_matches_regexps():
+    patterns = ["ACGT", "TTTTTT", "GCWGC", "CAN", "A", "RYRY", "ACGTACGT"]
+    records = [ record for record in get_test_records(Random(2), 300) if kmer_prism.get_sequence_string(record) == kmer_prism.get_sequence_string(record).upper() ]
+    for count_overlapping in (False, True):
+        automaton = kmer_prism.motif_automaton(patterns, count_overlapping)
+        automaton_counts = {}
+        for record in records:
+            add_kmer_counts(automaton_counts, kmer_prism.kmer_count_from_sequence(record, False, None, 1, automaton))
+        regexp_counts = {}
+        for pattern in patterns:
+            regexp = get_motif_regexp(pattern)
+            if count_overlapping:
+                regexp = "(?=(%s))"%regexp   # (a lookahead, to count overlapping matches)
+            for record in records:
+                match_count = len(re.findall(regexp, kmer_prism.get_sequence_string(record)))
+                if match_count > 0:
+                    regexp_counts[pattern] = match_count + regexp_counts.get(pattern, 0)
+            if not count_overlapping:
+                # the regular expression path of kmer_count_from_sequence itself (which counts each matched sequence)
+                matched_counts = {}
+                for record in records:
+                    add_kmer_counts(matched_counts, kmer_prism.kmer_count_from_sequence(record, False, None, 1, regexp))
+                assert sum(matched_counts.values()) == regexp_counts.get(pattern, 0)
+        assert automaton_counts == regexp_counts, "count_overlapping %s"%count_overlapping
+
+#********************************************************************
+# partitioned reading - the records read from the partitions
+# of a file, taken together, are the records of the whole file
+#********************************************************************
+class small_read_size(object):
+    """
+    shrinks the bulk read size, so that records span many blocks and partition boundaries
+    """
+    def __init__(self, read_size):
+        self.read_size = read_size
+    def __enter__(self):
+        (self.saved_read_size, kmer_prism.RAW_READ_SIZE) = (kmer_prism.RAW_READ_SIZE, self.read_size)
+    def __exit__(self, *args):
+        kmer_prism.RAW_READ_SIZE = self.saved_read_size
+
+def test_partition_union_is_whole_file():
+    tempdir = tempfile.mkdtemp()
+    try:
+        rng = Random(7)
+        fasta_file = os.path.join(tempdir, "contigs.fa")
+        fastq_file = os.path.join(tempdir, "reads.fastq")
+        write_test_fasta(fasta_file, rng, 60)
+        write_test_fastq(fastq_file, rng, 300)
+        with small_read_size(97):
+            for (datafile, filetype) in ((fasta_file, "fasta"), (fastq_file, "fastq")):
+                whole_file_records = get_whole_file_records(datafile, filetype)
+                for num_partitions in (1, 2, 3, 7, 50):
+                    assert get_partitioned_records(datafile, filetype, num_partitions) == whole_file_records, \
+                        "%s read in %d partitions"%(filetype, num_partitions)
+    finally:
+        shutil.rmtree(tempdir)
+
+def write_test_bgzf(filename, datafile, lines_per_block):
+    """
+    writes a bgzf copy of a file, with a compressed block every few lines (so that records span blocks)
+    """
+    from Bio import bgzf
+    writer = bgzf.BgzfWriter(filename, "wb")
+    with open(datafile, "rb") as plain:
+        for (line_number, line) in enumerate(plain):
+            writer.write(line)
+            if (line_number + 1) % lines_per_block == 0:
+                writer.flush()
+    writer.close()
+
+def test_bgzf_partition_union_is_whole_file():
+    tempdir = tempfile.mkdtemp()
+    try:
+        rng = Random(5)
+        fasta_file = os.path.join(tempdir, "contigs.fa")
+        fastq_file = os.path.join(tempdir, "reads.fastq")
+        write_test_fasta(fasta_file, rng, 60)
+        write_test_fastq(fastq_file, rng, 300)
+        for (datafile, filetype) in ((fasta_file, "fasta"), (fastq_file, "fastq")):
+            write_test_bgzf(datafile + ".bgz", datafile, 7)
+            assert kmer_prism.get_raw_file_format(datafile + ".bgz") == "bgzf"
+            whole_file_records = get_whole_file_records(datafile, filetype)
+            for num_partitions in (1, 2, 3, 7, 50):
+                assert get_partitioned_records(datafile + ".bgz", filetype, num_partitions) == whole_file_records, \
+                    "bgzf %s read in %d partitions"%(filetype, num_partitions)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_gzip_record_blocks_are_whole_records():
+    tempdir = tempfile.mkdtemp()
+    try:
+        rng = Random(11)
+        fasta_file = os.path.join(tempdir, "contigs.fa")
+        write_test_fasta(fasta_file, rng, 60)
+        with open(fasta_file, "rb") as plain:
+            contents = plain.read()
+        with gzip.open(fasta_file + ".gz", "wb") as compressed:
+            compressed.write(contents)
+        with small_read_size(97):
+            blocks = list(kmer_prism.record_blocks_from_gzip(fasta_file + ".gz", "fasta"))
+        assert b"".join(blocks) == contents
+        assert all(block[0:1] == b">" for block in blocks)
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# binary spectra - counts are looked up by kmer, including kmers (e.g. 
+# patterns) which can't be coded
+#********************************************************************
+def test_spectrum_counts_of_longer_kmers():
+    from kmer_spectrum import kmer_spectrum
+    tempdir = tempfile.mkdtemp()
+    try:
+        spectrum_file = os.path.join(tempdir, "patterns.kmerdist.spectrum")
+        kmer_spectrum.from_kmer_counts({"GAATTC" : 5, "GGNCC" : 2}).save(spectrum_file)
+        spectrum = kmer_spectrum.load(spectrum_file)
+        assert spectrum.get_counts(["GAATTC", "GAATTCC", "GAATTCCA", "GGNCC", "GGNCCA", "GAATT"]).tolist() == [5, 0, 0, 2, 0, 0]
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# paired-end reads - the combined spectrum of a pair is the sum of the
+# spectra of its mates, and trimming the overlap of the mates drops
+# the overlapping end of R2
+#********************************************************************
+def get_reverse_complement(sequence):
+    return "".join({"A" : "T", "C" : "G", "G" : "C", "T" : "A"}[base] for base in reversed(sequence))
+
+def write_test_pair(tempdir, rng, pair_count, read_length=40, overlap=20):
+    """
+    writes R1 and R2 fasta files of pairs of mates, in which every other pair is from a fragment short enough 
+    that the 3' ends of the mates overlap (by overlap bases), and returns the filenames and the trimmed R2 sequences
+    """
+    (r1_sequences, r2_sequences, trimmed_r2_sequences) = ([], [], [])
+    for pair_number in range(pair_count):
+        if pair_number % 2 == 0:
+            fragment = get_random_sequence(rng, 2 * read_length - overlap)
+            r1_sequences.append(fragment[0:read_length])
+            r2_sequences.append(get_reverse_complement(fragment)[0:read_length])
+            trimmed_r2_sequences.append(r2_sequences[-1][0:read_length - overlap])
+        else:
+            r1_sequences.append(get_random_sequence(rng, read_length))
+            r2_sequences.append(get_random_sequence(rng, read_length))
+            trimmed_r2_sequences.append(r2_sequences[-1])
+    filenames = []
+    for (name, sequences) in (("s1_R1.fa", r1_sequences), ("s1_R2.fa", r2_sequences), ("s1_R2_trimmed.fa", trimmed_r2_sequences)):
+        filenames.append(os.path.join(tempdir, name))
+        with open(filenames[-1], "w") as fasta:
+            for (sequence_number, sequence) in enumerate(sequences):
+                fasta.write(">read_%d\n%s\n"%(sequence_number, sequence))
+    return filenames
+
+def get_built_counts(tempdir, build_name, input_files, *args):
+    """
+    builds binary spectra of the input files in their own build folder, and returns the kmer counts of each spectrum
+    """
+    from kmer_spectrum import kmer_spectrum
+    builddir = os.path.join(tempdir, build_name)
+    os.mkdir(builddir)
+    run_kmer_prism("-t", "frequency", "-k", "4", "-b", builddir, "--spectrum_format", "binary", "-o", os.path.join(builddir, "summary.txt"), \
+                   *(list(args) + input_files))
+    return dict( (os.path.basename(filename), kmer_spectrum.load(filename).get_kmer_counts()) \
+                 for filename in glob.glob(os.path.join(builddir, "*.kmerdist.spectrum")) )
+
+def get_summed_counts(*kmer_counts_list):
+    summed_counts = {}
+    for kmer_counts in kmer_counts_list:
+        for (kmer, count) in kmer_counts.items():
+            summed_counts[kmer] = summed_counts.get(kmer, 0) + count
+    return summed_counts
+
+def test_paired_spectra():
+    rng = Random(15)
+    tempdir = tempfile.mkdtemp()
+    try:
+        (r1_file, r2_file, trimmed_r2_file) = write_test_pair(tempdir, rng, 20)
+        r2_totals = []
+        for (build_name, trim_args, expected_r2_file) in (("untrimmed", [], r2_file), ("trimmed", ["--trim_mate_overlap", "--minimum_mate_overlap", "10"], trimmed_r2_file)):
+            unpaired = get_built_counts(tempdir, build_name + "_unpaired", [r1_file, expected_r2_file])
+            mates = get_built_counts(tempdir, build_name + "_mates", [r1_file, r2_file], "--paired", "mates", *trim_args)
+            combined = get_built_counts(tempdir, build_name + "_combined", [r1_file, r2_file], "--paired", "combined", *trim_args)
+            assert sorted(mates.keys()) == ["s1_R1.fa.kmerdist.spectrum", "s1_R2.fa.kmerdist.spectrum"]
+            assert mates["s1_R1.fa.kmerdist.spectrum"] == unpaired["s1_R1.fa.kmerdist.spectrum"]
+            assert mates["s1_R2.fa.kmerdist.spectrum"] == unpaired[os.path.basename(expected_r2_file) + ".kmerdist.spectrum"], build_name
+            assert list(combined.keys()) == ["s1_R1.fa.paired.kmerdist.spectrum"]
+            assert combined["s1_R1.fa.paired.kmerdist.spectrum"] == get_summed_counts(*mates.values()), build_name
+            r2_totals.append(sum(mates["s1_R2.fa.kmerdist.spectrum"].values()))
+        assert r2_totals[1] < r2_totals[0]     # (the kmers of the overlapping ends of R2 are not counted)
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# summaries - the matrix engine measures and ranks kmers as the prism
+# engine does, including tied kmers, and kmers absent from a sample
+#********************************************************************
+def get_summary_section(summary_file, heading):
+    """
+    returns the lines of a section (e.g. *** ranks *** :) of a ranks or zipfian summary
+    """
+    with open(summary_file) as summary:
+        lines = summary.read().splitlines()
+    section_start = lines.index(heading) + 1
+    section_end = section_start
+    while section_end < len(lines) and not lines[section_end].startswith("***"):
+        section_end += 1
+    return lines[section_start:section_end]
+
+def get_summary_table(summary_file, heading=None):
+    """
+    returns the rows of a table (the whole of a frequency or entropy summary, or a section of a ranks or zipfian
+    summary) as (name, values) - the first row is the header, the values of the other rows are floats
+    """
+    if heading is None:
+        with open(summary_file) as summary:
+            lines = summary.read().splitlines()
+    else:
+        lines = get_summary_section(summary_file, heading)
+    rows = [ line.split("\t") for line in lines ]
+    return [ (rows[0][0], rows[0][1:]) ] + [ (row[0], [ float(value) for value in row[1:] ]) for row in rows[1:] ]
+
+def assert_tables_match(table, other_table):
+    assert [ name for (name, values) in table ] == [ name for (name, values) in other_table ]
+    for ((name, values), (other_name, other_values)) in zip(table, other_table):
+        assert len(values) == len(other_values), name
+        assert max([0.0] + [ abs(value - other_value) for (value, other_value) in zip(values, other_values) ]) < 1e-9, name
+
+def write_tied_samples(tempdir):
+    """
+    writes samples in which many kmers have the same count (and some are absent from one sample but not another)
+    """
+    sample_files = [ os.path.join(tempdir, "tied_%d.fa"%sample_number) for sample_number in range(3) ]
+    for (sample_file, sequences) in zip(sample_files, (["ACGTACGTACGT", "TTTTGGGG"], ["AAAACCCC", "GGGGTTTT", "ACGT"], ["ACACACAC"])):
+        with open(sample_file, "w") as fasta:
+            for (sequence_number, sequence) in enumerate(sequences):
+                fasta.write(">seq_%d\n%s\n"%(sequence_number, sequence))
+    return sample_files
+
+def run_kmer_prism(*args):
+    subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "kmer_prism.py")] + list(args), stdout=open(os.devnull, "w"))
+
+def get_engine_summaries(tempdir, sample_files, summary_type, *args):
+    """
+    summarises pickled spectra of the samples using the prism engine (the reference) and the matrix engine, and 
+    binary spectra of the samples (which are summarised using the matrix engine), and returns the summary files
+    """
+    summary_files = []
+    for (spectrum_format, summary_engine) in (("pickle", "prism"), ("pickle", "matrix"), ("binary", "prism")):
+        summary_files.append(os.path.join(tempdir, "%s_%s_%s.txt"%(summary_type, spectrum_format, summary_engine)))
+        run_kmer_prism("-t", summary_type, "-k", "2", "-p", "1", "-b", tempdir, "--spectrum_format", spectrum_format, "--summary_engine", summary_engine, \
+                       "-o", summary_files[-1], *(list(args) + sample_files))
+    return summary_files
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="the prism summary engine requires python 2")
+def test_matrix_engine_ranks_match_prism_with_ties():
+    tempdir = tempfile.mkdtemp()
+    try:
+        summary_files = get_engine_summaries(tempdir, write_tied_samples(tempdir), "ranks")
+        for summary_file in summary_files[1:]:
+            assert get_summary_section(summary_files[0], "*** ranks *** :") == get_summary_section(summary_file, "*** ranks *** :")
+    finally:
+        shutil.rmtree(tempdir)
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="the prism summary engine requires python 2")
+def test_matrix_engine_entropies_match_prism():
+    tempdir = tempfile.mkdtemp()
+    try:
+        sample_files = write_tied_samples(tempdir)
+        for alphabet in ("ACGT", "ACT"):
+            summary_files = get_engine_summaries(tempdir, sample_files, "entropy", "-a", alphabet)
+            prism_table = get_summary_table(summary_files[0])
+            for summary_file in summary_files[1:]:
+                matrix_table = get_summary_table(summary_file)
+                assert prism_table[0] == matrix_table[0]
+                assert_tables_match(prism_table[1:], matrix_table[1:])
+            for summary_file in summary_files:
+                os.remove(summary_file)
+    finally:
+        shutil.rmtree(tempdir)
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="the prism summary engine requires python 2")
+def test_matrix_engine_zipfian_summary_matches_prism():
+    tempdir = tempfile.mkdtemp()
+    try:
+        summary_files = get_engine_summaries(tempdir, write_tied_samples(tempdir), "zipfian")
+        for heading in ("*** ranks *** :", "*** entropies *** :", "*** distances *** :"):
+            prism_table = get_summary_table(summary_files[0], heading)
+            for summary_file in summary_files[1:]:
+                matrix_table = get_summary_table(summary_file, heading)
+                assert prism_table[0] == matrix_table[0]
+                assert_tables_match(prism_table[1:], matrix_table[1:])
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# zipfian distances - the numpy distance engine (blocked, optionally
+# over a pool of processes) gives the distance matrix of prism
+#********************************************************************
+def get_test_measures(rng, sample_count, kmer_count):
+    """
+    returns (measures, ranks) of random spectra, in which some kmers are absent and many counts are tied
+    """
+    import numpy
+    from kmer_spectrum import get_measure_matrix, get_rank_matrix
+    counts = numpy.array([ [ rng.choice([0, 0, 1, 2, 2, 3, rng.randint(1, 100)]) for kmer_number in range(kmer_count) ] for sample_number in range(sample_count) ])
+    measures = get_measure_matrix(counts, counts.sum(axis=1).astype(float), "unsigned_information")
+    return (measures, get_rank_matrix(measures))
+
+def get_prism_distance_matrix(measures, ranks, sample_names):
+    """
+    returns the prism zipfian distance matrix of a samples x kmers measure matrix, in the sample order given
+    """
+    from data_prism import prism
+    measure_iter = iter([tuple(sample_names)] + [ tuple(row) for row in measures.T.tolist() ])
+    rank_iter = iter([tuple(sample_names)] + [ tuple(row) for row in ranks.T.tolist() ])
+    (distance_matrix, point_names_sorted) = prism.get_zipfian_distance_matrix(measure_iter, rank_iter)
+    name_index = dict((name, index) for (index, name) in enumerate(point_names_sorted))
+    return [ [ distance_matrix[name_index[name]][name_index[other_name]] for other_name in sample_names ] for name in sample_names ]
+
+def test_zipfian_distances_match_prism():
+    import kmer_spectrum
+    rng = Random(10)
+    for (sample_count, kmer_count) in ((2, 1), (3, 16), (9, 64), (12, 256)):
+        (measures, ranks) = get_test_measures(rng, sample_count, kmer_count)
+        sample_names = [ "sample_%d"%sample_number for sample_number in range(sample_count) ]
+        prism_distances = get_prism_distance_matrix(measures, ranks, sample_names)
+        assert_tables_match(list(zip(sample_names, kmer_spectrum.get_zipfian_distance_matrix(measures, ranks).tolist())), list(zip(sample_names, prism_distances)))
+
+        # blocked, over a pool of processes, and only the later rows
+        block_elements = kmer_spectrum.DISTANCE_BLOCK_ELEMENTS
+        kmer_spectrum.DISTANCE_BLOCK_ELEMENTS = 2 * sample_count * kmer_count
+        try:
+            for num_processes in (1, 2):
+                distances = kmer_spectrum.get_zipfian_distance_matrix(measures, ranks, num_processes)
+                assert_tables_match(list(zip(sample_names, distances.tolist())), list(zip(sample_names, prism_distances)))
+            later_distances = kmer_spectrum.get_zipfian_distance_matrix(measures, ranks, 1, first_row = sample_count // 2)
+            assert_tables_match(list(zip(sample_names[sample_count // 2:], later_distances.tolist())), list(zip(sample_names, prism_distances))[sample_count // 2:])
+        finally:
+            kmer_spectrum.DISTANCE_BLOCK_ELEMENTS = block_elements
+
+def test_binary_distance_matrix():
+    import kmer_spectrum
+    (measures, ranks) = get_test_measures(Random(11), 5, 32)
+    sample_names = [ "sample_%d"%sample_number for sample_number in range(5) ]
+    distances = kmer_spectrum.get_zipfian_distance_matrix(measures, ranks)
+    tempdir = tempfile.mkdtemp()
+    try:
+        distance_file = os.path.join(tempdir, "distances.bin")
+        kmer_spectrum.save_distance_matrix(distances, sample_names, distance_file)
+        (saved_distances, saved_names) = kmer_spectrum.load_distance_matrix(distance_file)
+        assert saved_names == sample_names
+        assert saved_distances.tolist() == distances.tolist()
+    finally:
+        shutil.rmtree(tempdir)
+
+#********************************************************************
+# summary state - updating a state with more spectra gives the same 
+# summary (including distances) as summarising them from scratch, and
+# the state is rebuilt if a spectrum changes or is dropped
+#********************************************************************
+def write_test_spectra(tempdir, rng, sample_names, kmer_size=3):
+    """
+    writes binary spectra of random kmer counts (each sample has a different subset of the kmers), and returns their filenames
+    """
+    from kmer_spectrum import kmer_spectrum
+    filenames = []
+    for sample_name in sample_names:
+        kmer_counts = dict( (get_random_sequence(rng, kmer_size), rng.randint(1, 20)) for kmer_number in range(rng.randint(1, 30)) )
+        filenames.append(os.path.join(tempdir, "%s.kmerdist.spectrum"%sample_name))
+        kmer_spectrum.from_kmer_counts(kmer_counts).save(filenames[-1])
+    return filenames
+
+def get_state_summary(state):
+    """
+    returns the kmers, counts and zipfian distances of a summary state
+    """
+    from kmer_spectrum import get_measure_matrix, get_rank_matrix
+    measures = get_measure_matrix(state.counts, state.totals, "unsigned_information")
+    distances = state.get_zipfian_distance_matrix(measures, get_rank_matrix(measures))
+    return (state.kmers, state.counts.tolist(), distances)
+
+def test_summary_state_update_matches_scratch():
+    from kmer_spectrum import summary_state, get_summary_state
+    rng = Random(12)
+    tempdir = tempfile.mkdtemp()
+    try:
+        state_filename = os.path.join(tempdir, "state.npz")
+        filenames = write_test_spectra(tempdir, rng, [ "sample_%d"%sample_number for sample_number in range(8) ])
+        for alphabet in (None, "ACG"):
+            if os.path.exists(state_filename):
+                os.remove(state_filename)
+            state = get_summary_state(state_filename, filenames[:5], alphabet)
+            get_state_summary(state)
+            state.save(state_filename)
+
+            # add spectra (with kmers not in the state), and re-order the existing ones
+            summary_filenames = [filenames[6], filenames[2], filenames[0], filenames[7], filenames[4], filenames[1], filenames[5], filenames[3]]
+            state = get_summary_state(state_filename, summary_filenames, alphabet)
+            assert state.distances is not None and len(state.distance_filenames) == 5
+            (kmers, counts, distances) = get_state_summary(state)
+            (scratch_kmers, scratch_counts, scratch_distances) = get_state_summary(summary_state.from_spectra(summary_filenames, alphabet))
+            assert len(kmers) > len(summary_state.load(state_filename).kmers)
+            assert (kmers, counts) == (scratch_kmers, scratch_counts)
+            assert_tables_match(list(zip(summary_filenames, distances.tolist())), list(zip(summary_filenames, scratch_distances.tolist())))
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_summary_state_stale_reasons():
+    from kmer_spectrum import summary_state, kmer_spectrum
+    rng = Random(13)
+    tempdir = tempfile.mkdtemp()
+    try:
+        filenames = write_test_spectra(tempdir, rng, [ "sample_%d"%sample_number for sample_number in range(4) ])
+        state = summary_state.from_spectra(filenames[:3])
+        get_state_summary(state)
+        assert state.get_stale_reason(filenames, None) is None
+        assert state.get_stale_reason(filenames, "ACG") == "the alphabet has changed"
+        assert state.get_stale_reason(filenames[1:], None) == "1 spectra are no longer summarised"
+
+        # rewrite a spectrum (with a later modification time, in case the file system's times are coarse)
+        kmer_spectrum.from_kmer_counts({"ACG" : 1000}).save(filenames[1])
+        file_stat = os.stat(filenames[1])
+        os.utime(filenames[1], (file_stat.st_atime, file_stat.st_mtime + 10))
+        assert state.get_stale_reason(filenames, None) == "1 spectra have changed"
+
+        # the rebuilt state summarises the changed spectrum, and has no distances to update
+        updated_state = state.update(filenames)
+        assert updated_state.distances is None
+        assert updated_state.counts.tolist() == summary_state.from_spectra(filenames).counts.tolist()
+        assert "ACG" in updated_state.kmers and updated_state.counts[1, updated_state.kmers.index("ACG")] == 1000
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_summary_state_summary_matches_scratch():
+    rng = Random(14)
+    tempdir = tempfile.mkdtemp()
+    try:
+        sample_files = []
+        for sample_number in range(5):
+            sample_files.append(os.path.join(tempdir, "sample_%d.fa"%sample_number))
+            with open(sample_files[-1], "w") as fasta:
+                for record_number in range(rng.randint(1, 4)):
+                    fasta.write(">seq_%d\n%s\n"%(record_number, get_random_sequence(rng, rng.randint(2, 40))))
+        state_filename = os.path.join(tempdir, "state.npz")
+        for (summary_number, summary_files) in enumerate((sample_files[:3], sample_files)):
+            run_kmer_prism("-t", "zipfian", "-k", "2", "-b", tempdir, "--spectrum_format", "binary", "--summary_state", state_filename, \
+                           "-o", os.path.join(tempdir, "state_summary_%d.txt"%summary_number), *summary_files)
+        run_kmer_prism("-t", "zipfian", "-k", "2", "-b", tempdir, "--spectrum_format", "binary", "-o", os.path.join(tempdir, "summary.txt"), *sample_files)
+        for heading in ("*** ranks *** :", "*** entropies *** :", "*** distances *** :"):
+            (state_table, table) = [ get_summary_table(os.path.join(tempdir, summary_file), heading) for summary_file in ("state_summary_1.txt", "summary.txt") ]
+            assert state_table[0] == table[0]
+            assert_tables_match(state_table[1:], table[1:])
+    finally:
+        shutil.rmtree(tempdir)
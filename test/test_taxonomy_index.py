@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# behavioural tests for taxonomy_index.py, using a small hand-made taxdump (test/taxdump - nodes.dmp, names.dmp,
+# merged.dmp and an accession2taxid file). Run from the repository (or test) folder using
+#
+# python -m pytest -q test
+#
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAXDUMP_DIR = os.path.join(REPO_DIR, "test", "taxdump")
+ACCESSION_FILES = [os.path.join(TAXDUMP_DIR, "nucl.accession2taxid")]
+sys.path.insert(0, REPO_DIR)
+
+import taxonomy_index
+
+RANKS = ["superkingdom", "family", "genus"]
+ECOLI_LINEAGE = ("Bacteria", "Enterobacteriaceae", "Escherichia")
+HUMAN_LINEAGE = ("Eukaryota", "Hominidae", "Homo")
+STAPH_LINEAGE = ("Bacteria", None, "Staphylococcus")      # (a genus with no family)
+NO_LINEAGE = (None, None, None)
+
+class built_index(object):
+    """
+    builds the test index in a temporary folder - sorting the accessions in runs of run_size (smaller than the number
+    of accessions, so that the runs are merged)
+    """
+    def __init__(self, run_size=3):
+        self.run_size = run_size
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.tempdir, "index")
+        self.metadata = taxonomy_index.build_taxonomy_index(self.index_dir, TAXDUMP_DIR, ACCESSION_FILES, self.run_size, self.tempdir)
+        return self.index_dir
+    def __exit__(self, *args):
+        shutil.rmtree(self.tempdir)
+
+#********************************************************************
+# building and using the index
+#********************************************************************
+def test_accession_lineages():
+    for run_size in (2, 3, 100):
+        with built_index(run_size) as index_dir:
+            index = taxonomy_index.taxonomy_index(index_dir)
+            assert index.metadata["accession_count"] == 6
+            assert os.listdir(os.path.dirname(index_dir)) == ["index"]     # (the runs are removed)
+            lineages = index.get_accession_lineages(["NC_000001.11", "AP019724.1", "gi|688443106|emb|LL194098.1|", "ref|NC_000001.11|", \
+                                                     "XX000000.1", "FP929045.1", "CP036491.1"], RANKS)
+            # (LL194098 has a merged taxid, and FP929045 a taxid which is not in nodes.dmp)
+            assert lineages == [HUMAN_LINEAGE, STAPH_LINEAGE, ECOLI_LINEAGE, HUMAN_LINEAGE, NO_LINEAGE, NO_LINEAGE, ECOLI_LINEAGE], "run size %d"%run_size
+
+def test_first_taxid_of_accession():
+    # CP036491 and AB000001 are each listed twice, in different runs (and CP036491 in the same run when run_size is 100)
+    for run_size in (2, 3, 100):
+        with built_index(run_size) as index_dir:
+            index = taxonomy_index.taxonomy_index(index_dir)
+            assert index.get_accession_taxids(["CP036491", "AB000001", "AB000001", "XX000000"]).tolist() == [562, 9606, 9606, 0], "run size %d"%run_size
+
+def test_lineage_ranks():
+    with built_index() as index_dir:
+        index = taxonomy_index.taxonomy_index(index_dir)
+        assert index.get_lineages([9606], taxonomy_index.LINEAGE_RANKS) == [("Eukaryota", "Chordata", "Mammalia", "Primates", "Hominidae", "Homo", "Homo sapiens")]
+        assert index.get_lineages([9605, 0, 1], ["domain", "species"]) == [("Eukaryota", None), (None, None), (None, None)]
+        try:
+            index.get_lineages([9606], ["kingdom"])
+            assert False, "expected an unknown rank error"
+        except taxonomy_index.taxonomy_index_exception:
+            pass
+
+#********************************************************************
+# resolving blast hits (as used by taxonomy_prism.py)
+#********************************************************************
+def test_resolve_hits():
+    with built_index() as index_dir:
+        resolver = taxonomy_index.lineage_resolver(index_dir, ["superkingdom", "family"], batch_size=2)
+        items = [ (("q1", "9606", "CP036491.1", "1e-30"), 3.0),
+                  (("q2", "No hits", "No hits"), 5.0),
+                  (("q3", "N/A", "CP036491.1"), 1.0),           # no taxid - resolved from the accession
+                  (("q4", "562;9606", "XX000000.1"), 2.0),      # the first taxid is used
+                  (("q5", "0", "XX000000.1"), 1.0) ]
+        assert list(resolver.resolve_hits(iter(items))) == [ (("q1", "Eukaryota", "Hominidae", "1e-30"), 3.0),
+                                                             (("q2", "No hits", "No hits"), 5.0),
+                                                             (("q3", "Bacteria", "Enterobacteriaceae"), 1.0),
+                                                             (("q4", "Bacteria", "Enterobacteriaceae"), 2.0),
+                                                             (("q5", "Unknown", "Unknown"), 1.0) ]
+
+#********************************************************************
+# command line lookup
+#********************************************************************
+def test_lookup_files():
+    with built_index() as index_dir:
+        lookup_filename = os.path.join(os.path.dirname(index_dir), "accessions.txt")
+        with open(lookup_filename, "w") as lookup_file:
+            lookup_file.write("879 CP036491.1\n880 XX000000.1\n")
+        for (result_format, expected) in (("taxa", ["879\tCP036491.1\tBacteria\tEnterobacteriaceae", "880\tXX000000.1\tNA\tNA"]), \
+                                          ("taxid", ["879\tCP036491.1\t562", "880\tXX000000.1\tNA"])):
+            output = subprocess.check_output([sys.executable, os.path.join(REPO_DIR, "taxonomy_index.py"), "--index_dir", index_dir, "--column", "1", \
+                                              "--ranks", "superkingdom,family", "--result_format", result_format, lookup_filename])
+            assert output.decode("utf-8").splitlines() == expected
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# behavioural tests for taxonomy_prism.py (which requires python 2), using small hand-made blast results files
+# and the hand-made taxdump in test/taxdump. Run from the repository (or test) folder using
+#
+# python -m pytest -q test
+#
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from test_taxonomy_index import built_index
+
+# fields : query id, subject id, % identity, evalue, bit score, subject tax ids
+TEST_RESULTS = """# BLASTN 2.6.0+
+# Query: q1 count=3
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids
+# 3 hits found
+q1	CP036491.1	99.0	1e-30	120	N/A
+q1	NC_000001.11	98.0	1e-30	125	9606
+q1	AP019724.1	100.0	1e-10	80	1279
+# BLASTN 2.6.0+
+# Query: q2 count=5
+# Database: /data/blast/nt.fasta
+# 0 hits found
+# BLASTN 2.6.0+
+# Query: q3 count=2
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids
+# 2 hits found
+q3	AP019724.1	97.0	1e-20	100	1279
+q3	LL194098.1	97.0	1e-20	100	N/A
+# BLAST processed 3 queries
+"""
+
+(PIDENT_COLUMN, EVALUE_COLUMN, BITSCORE_COLUMN, TAXID_COLUMN, ACCESSION_COLUMN) = (2, 3, 4, 5, 1)
+RANKS = ["superkingdom", "family"]
+
+# fields : query id, subject id, % identity, evalue, bit score, subject tax ids, common names, super kingdom (as summarised by default)
+SAMPLE_RESULTS = [ """# BLASTN 2.6.0+
+# Query: q1 count=3
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids, subject com names, subject super kingdoms
+# 2 hits found
+q1	CP036491.1	99.0	1e-30	120	562	E. coli	Bacteria
+q1	NC_000001.11	98.0	1e-30	125	9606	human	Eukaryota
+# BLASTN 2.6.0+
+# Query: q2 count=5
+# Database: /data/blast/nt.fasta
+# 0 hits found
+# BLASTN 2.6.0+
+# Query: q3 count=2
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids, subject com names, subject super kingdoms
+# 1 hits found
+q3	AP019724.1	97.0	1e-20	100	1279	Staphylococcus	Bacteria
+# BLAST processed 3 queries
+""", """# BLASTN 2.6.0+
+# Query: q1 count=7
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids, subject com names, subject super kingdoms
+# 1 hits found
+q1	NC_000001.11	98.0	1e-30	125	9606	human	Eukaryota
+# BLASTN 2.6.0+
+# Query: q2 count=1
+# Database: /data/blast/nt.fasta
+# Fields: query id, subject id, % identity, evalue, bit score, subject tax ids, subject com names, subject super kingdoms
+# 1 hits found
+q2	CP036491.1	99.0	1e-30	120	562	E. coli	Bacteria
+# BLAST processed 2 queries
+""" ]
+
+def write_results(tempdir, name="test.results", results=TEST_RESULTS):
+    filename = os.path.join(tempdir, name)
+    with open(filename, "w") as results_file:
+        results_file.write(results)
+    return filename
+
+#********************************************************************
+# resolving the lineages of hits with a taxonomy index
+#********************************************************************
+def get_resolver(index_dir):
+    """
+    returns a lineage resolver which also records the hits it resolves
+    """
+    from taxonomy_index import lineage_resolver
+    class recording_resolver(lineage_resolver):
+        def resolve_hits(self, item_iter, no_hits="No hits"):
+            self.resolved_queries = []
+            for (hit, weight) in super(recording_resolver, self).resolve_hits(item_iter, no_hits):
+                self.resolved_queries.append(hit[0])
+                yield (hit, weight)
+    return recording_resolver(index_dir, RANKS, TAXID_COLUMN, ACCESSION_COLUMN)
+
+def get_provided_hits(provider, resolver, *xargs):
+    tempdir = tempfile.mkdtemp()
+    try:
+        return list(provider(write_results(tempdir), "tag_count", resolver, *(list(xargs) + [0] + resolver.get_hit_columns())))
+    finally:
+        shutil.rmtree(tempdir)
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="taxonomy_prism requires python 2")
+def test_first_hits_resolved_after_grouping():
+    import taxonomy_prism
+    with built_index() as index_dir:
+        resolver = get_resolver(index_dir)
+        assert get_provided_hits(taxonomy_prism.my_top_hit_provider, resolver) == [(("q1", "Bacteria", "Enterobacteriaceae"), 3.0), \
+                                                                                   (("q2 count=5", "No hits", "No hits"), 5.0), \
+                                                                                   (("q3", "Bacteria", "Unknown"), 2.0)]
+        assert resolver.resolved_queries == ["q1", "q2 count=5", "q3"]     # (only the first hit of each query)
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="taxonomy_prism requires python 2")
+def test_best_hits_resolved():
+    import taxonomy_prism
+    from blast_results import best_hit_selector, LCA_UNRESOLVED
+    with built_index() as index_dir:
+        # without the LCA, only the selected hits are resolved
+        resolver = get_resolver(index_dir)
+        selector = best_hit_selector("combined", evalue_column=EVALUE_COLUMN, bitscore_column=BITSCORE_COLUMN, pident_column=PIDENT_COLUMN)
+        assert get_provided_hits(taxonomy_prism.my_best_hit_provider, resolver, selector) == [(("q1", "Eukaryota", "Hominidae"), 3.0), \
+                                                                                             (("q2 count=5", "No hits", "No hits"), 5.0), \
+                                                                                             (("q3", "Bacteria", "Unknown"), 2.0)]
+        assert len(resolver.resolved_queries) == 3
+
+        # the LCA of the tied q3 hits is taken over their lineages, so every hit is resolved
+        resolver = get_resolver(index_dir)
+        selector = best_hit_selector("evalue", evalue_column=EVALUE_COLUMN, lca=True)
+        assert get_provided_hits(taxonomy_prism.my_best_hit_provider, resolver, selector) == [(("q1", LCA_UNRESOLVED, LCA_UNRESOLVED), 3.0), \
+                                                                                             (("q2 count=5", "No hits", "No hits"), 5.0), \
+                                                                                             (("q3", "Bacteria", LCA_UNRESOLVED), 2.0)]
+        assert len(resolver.resolved_queries) == 6
+
+#********************************************************************
+# summarising samples in a pool of processes gives the same spectra
+# and summaries as summarising them serially
+#********************************************************************
+def get_sample_summaries(tempdir, build_name, num_processes):
+    """
+    summarises the sample results files in their own folder, and returns the spectrum of each sample, and the
+    contents of the summary files
+    """
+    import taxonomy_prism
+    from data_prism import prism
+    builddir = os.path.join(tempdir, build_name)
+    os.mkdir(builddir)
+    filenames = [ write_results(builddir, "sample%d.results"%sample_number, results) for (sample_number, results) in enumerate(SAMPLE_RESULTS) ]
+    taxonomy_prism.summarise_samples(filenames, "tag_count", num_processes = num_processes)
+    spectra = [ sorted(prism.load("%s.tax.pickle"%filename).get_spectrum().items()) for filename in filenames ]
+    summaries = {}
+    for summary_name in os.listdir(builddir):
+        if summary_name.endswith("_summary.txt"):
+            with open(os.path.join(builddir, summary_name), "r") as summary_file:
+                summaries[summary_name] = summary_file.read()
+    return (spectra, summaries)
+
+@pytest.mark.skipif(sys.version_info >= (3,0), reason="taxonomy_prism requires python 2")
+def test_pooled_summaries_match_serial():
+    tempdir = tempfile.mkdtemp()
+    try:
+        (serial_spectra, serial_summaries) = get_sample_summaries(tempdir, "serial", 1)
+        (pooled_spectra, pooled_summaries) = get_sample_summaries(tempdir, "pooled", 2)
+        assert sorted(serial_summaries.keys()) == ["sample0.results.family_Bacteria_summary.txt", "sample0.results.family_No_hits_summary.txt", \
+                                                   "sample0.results.kingdom_summary.txt", "sample1.results.family_Bacteria_summary.txt", \
+                                                   "sample1.results.family_Eukaryota_summary.txt", "sample1.results.kingdom_summary.txt"]
+        assert pooled_spectra == serial_spectra
+        assert pooled_summaries == serial_summaries
+    finally:
+        shutil.rmtree(tempdir)